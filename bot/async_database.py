@@ -0,0 +1,506 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import database
+from database import Page, Stats
+from config import logger, DB_POOL_SIZE, WRITE_MAX_BATCH, WRITE_MAX_LINGER
+from metrics import QUEUE_DEPTH
+
+
+# Чтение выполняется в нескольких потоках, пачки записей - в одном
+# выделенном потоке / Reads run on several threads, write batches on one
+# dedicated thread
+_read_executor = ThreadPoolExecutor(max_workers=max(1, DB_POOL_SIZE - 1),
+                                    thread_name_prefix='db-read')
+_write_executor = ThreadPoolExecutor(max_workers=1,
+                                     thread_name_prefix='db-write')
+
+
+async def _run(executor: ThreadPoolExecutor, func: Callable[..., Any],
+               *args: Any) -> Any:
+    """
+    Выполняет синхронную функцию базы данных вне цикла событий.
+    Runs a synchronous database function outside the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, partial(func, *args))
+
+
+class GroupCommitWriter:
+    """
+    Единственная задача записи: собирает операции записи от параллельных
+    обработчиков в пачки и фиксирует каждую пачку одной транзакцией.
+    Вызывающий получает результат после фиксации своей пачки.
+    The single writer task: collects write operations from concurrent
+    handlers into batches and commits each batch in one transaction. The
+    caller gets its result once its batch is committed.
+    """
+
+    def __init__(self, max_batch: int, max_linger: float) -> None:
+        self._max_batch = max_batch
+        self._max_linger = max_linger
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.writes = 0
+
+    def _ensure_started(self) -> None:
+        """
+        Запускает задачу записи в текущем цикле событий.
+        Starts the writer task in the current event loop.
+        """
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._writer(),
+                                             name='db-writer')
+
+    @property
+    def depth(self) -> int:
+        """
+        Количество операций, ожидающих записи.
+        Number of operations waiting to be written.
+        """
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, operation: Callable[..., Any],
+                     *args: Any) -> Any:
+        """
+        Ставит операцию записи в очередь и ждёт фиксации её пачки.
+        Queues a write operation and waits until its batch is committed.
+        """
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((operation, args, future))
+        return await future
+
+    async def stop(self) -> None:
+        """
+        Записывает оставшиеся операции и останавливает задачу записи.
+        Writes the remaining operations and stops the writer task.
+        """
+        if self._task is None or self._task.done():
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    async def _collect(self, batch: List[Any]) -> None:
+        """
+        Собирает пачку в batch: ждёт первую операцию, затем добирает
+        остальные, пока пачка не заполнится или не истечёт время ожидания.
+        Collects a batch into batch: waits for the first operation, then
+        takes more until the batch is full or the linger time is over.
+        """
+        batch.append(await self._queue.get())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self._max_linger
+
+        while len(batch) < self._max_batch and batch[-1] is not None:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(),
+                                                    timeout))
+            except asyncio.TimeoutError:
+                break
+
+    async def _writer(self) -> None:
+        """
+        Основной цикл задачи записи. Если задача прерывается, ожидающие
+        операции завершаются ошибкой, а не остаются в брошенной очереди.
+        The main loop of the writer task. If the task dies, the waiting
+        operations fail instead of staying in an abandoned queue.
+        """
+        batch: List[Any] = []
+        try:
+            while True:
+                batch = []
+                await self._collect(batch)
+                stopping = batch[-1] is None
+                if stopping:
+                    batch.pop()
+
+                if batch:
+                    await self._commit(batch)
+                if stopping:
+                    return
+        except BaseException as e:
+            self._fail_pending(batch, e)
+            raise
+
+    def _fail_pending(self, batch: List[Any], cause: BaseException) -> None:
+        """
+        Завершает ошибкой операции текущей пачки и всей очереди.
+        Fails the operations of the current batch and of the whole queue.
+        """
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        futures = [item[2] for item in batch
+                   if item is not None and not item[2].done()]
+        if not futures:
+            return
+
+        logger.error('Database writer stopped with %d pending writes: %r',
+                     len(futures), cause)
+        error = RuntimeError('Database writer stopped')
+        error.__cause__ = cause
+        for future in futures:
+            future.set_exception(error)
+
+    async def _commit(self, batch: List[Any]) -> None:
+        """
+        Фиксирует пачку и передаёт результаты ожидающим.
+        Commits a batch and hands the results to the waiters.
+        """
+        operations = [(operation, args) for operation, args, _ in batch]
+        try:
+            results = await _run(_write_executor, database.run_write_batch,
+                                 operations)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.writes += len(batch)
+        for (_, _, future), (ok, value) in zip(batch, results):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+
+_writer = GroupCommitWriter(WRITE_MAX_BATCH, WRITE_MAX_LINGER)
+QUEUE_DEPTH.set_function(lambda: _writer.depth, 'db_writes')
+
+
+async def shutdown() -> None:
+    """
+    Завершает запись: фиксирует операции, оставшиеся в очереди.
+    Shuts down writing: commits the operations left in the queue.
+    """
+    await _writer.stop()
+
+
+def peek_user_language(user_id: int) -> Optional[str]:
+    """
+    Язык пользователя из кэша без обращения к базе (None при промахе).
+    The user's language from the cache without a database access (None on a
+    miss).
+    """
+    return database.peek_user_language(user_id)
+
+
+async def get_user_language(user_id: int) -> str:
+    """
+    Асинхронное получение языка пользователя.
+    Asynchronously getting the user's language.
+    """
+    return await _run(_read_executor, database.get_user_language, user_id)
+
+
+async def save_user(user: Any) -> None:
+    """
+    Асинхронное сохранение информации о пользователе.
+    Asynchronously saving user information.
+    """
+    await _writer.submit(database._save_user, user)
+
+
+async def update_user_language(user_id: int, language: str) -> None:
+    """
+    Асинхронное обновление языка пользователя.
+    Asynchronously updating the user's language.
+    """
+    await _writer.submit(database._update_user_language, user_id, language)
+
+
+async def user_has_active_message(user_id: int) -> bool:
+    """
+    Асинхронная проверка наличия активного сообщения у пользователя.
+    Отрицательный ответ берётся из множества в памяти прямо в цикле
+    событий; база читается только для его подтверждения.
+    Asynchronously checking if the user has an active message. A negative
+    answer comes from the in-memory set right on the event loop; the
+    database is read only to confirm a positive one.
+    """
+    if not database.user_may_have_active_message(user_id):
+        return False
+    return await _run(_read_executor, database.user_has_active_message,
+                      user_id)
+
+
+async def reconcile_active_users() -> None:
+    """
+    Асинхронная загрузка или сверка с базой множества пользователей с
+    активным сообщением.
+    Asynchronously loading or reconciling with the database the set of
+    users with an active message.
+    """
+    await _writer.submit(database._reconcile_active_users)
+
+
+async def set_user_active_message(user_id: int, has_active: bool) -> None:
+    """
+    Асинхронная установка флага активного сообщения.
+    Asynchronously setting the active message flag.
+    """
+    await _writer.submit(database._set_user_active_message, user_id,
+                         has_active)
+
+
+async def submit_message(user: Any, message_type: str,
+                         message_text: str) -> Optional[int]:
+    """
+    Асинхронное сохранение сообщения от пользователя без активного
+    сообщения; None, если активное уже есть.
+    Asynchronously saving a message from a user without an active message;
+    None if there is an active one already.
+    """
+    return await _writer.submit(database._submit_message, user,
+                                message_type, message_text)
+
+
+async def save_reply(message_id: int, reply_text: str) -> None:
+    """
+    Асинхронное сохранение ответа администратора.
+    Asynchronously saving the administrator's reply.
+    """
+    await _writer.submit(database._save_reply, message_id, reply_text)
+
+
+async def get_stats(days: int) -> Stats:
+    """
+    Асинхронное получение статистики за последние days дней.
+    Asynchronously getting the statistics for the last days days.
+    """
+    return await _run(_read_executor, database.get_stats, days)
+
+
+async def get_message_details(message_id: int) -> Optional[Tuple[Any, ...]]:
+    """
+    Асинхронное получение сообщения вместе с данными отправителя.
+    Asynchronously getting a message together with the sender's data.
+    """
+    return await _run(_read_executor, database.get_message_details,
+                      message_id)
+
+
+async def get_message_user_id(message_id: int) -> Optional[int]:
+    """
+    Асинхронное получение ID отправителя сообщения.
+    Asynchronously getting the ID of the message sender.
+    """
+    return await _run(_read_executor, database.get_message_user_id,
+                      message_id)
+
+
+async def get_last_unanswered_message_id(user_id: int) -> Optional[int]:
+    """
+    Асинхронное получение ID последнего неотвеченного сообщения.
+    Asynchronously getting the ID of the latest unanswered message.
+    """
+    return await _run(_read_executor,
+                      database.get_last_unanswered_message_id, user_id)
+
+
+async def get_unanswered_inbox(cursor_message_id: Optional[int] = None,
+                               backward: bool = False) -> Tuple[Page, int]:
+    """
+    Асинхронное получение страницы неотвеченных сообщений и их количества.
+    Asynchronously getting a page of unanswered messages and their count.
+    """
+    return await _run(_read_executor, database.get_unanswered_inbox,
+                      cursor_message_id, backward)
+
+
+async def get_users_page(cursor_user_id: Optional[int] = None,
+                         backward: bool = False) -> Page:
+    """
+    Асинхронное получение страницы пользователей, отправивших сообщения.
+    Asynchronously getting a page of users who have sent messages.
+    """
+    return await _run(_read_executor, database.get_users_page,
+                      cursor_user_id, backward)
+
+
+async def get_user_messages_page(user_id: int,
+                                 cursor_message_id: Optional[int] = None,
+                                 backward: bool = False) -> Page:
+    """
+    Асинхронное получение страницы истории сообщений пользователя.
+    Asynchronously getting a page of the user's message history.
+    """
+    return await _run(_read_executor, database.get_user_messages_page,
+                      user_id, cursor_message_id, backward)
+
+
+async def load_persistent_data(kind: str) -> Dict[int, Tuple[str, int]]:
+    """
+    Асинхронная загрузка всего сохранённого состояния вида kind.
+    Asynchronously loading all stored state of the given kind.
+    """
+    return await _run(_read_executor, database.load_persistent_data, kind)
+
+
+async def get_newer_persistent_data(
+        kind: str, key: int, version: int) -> Optional[Tuple[str, int]]:
+    """
+    Асинхронное получение состояния по ключу, если оно новее версии.
+    Asynchronously getting the state for a key if it is newer than the
+    version.
+    """
+    return await _run(_read_executor, database.get_newer_persistent_data,
+                      kind, key, version)
+
+
+async def save_persistent_data(kind: str, key: int, data: str,
+                               version: Optional[int]) -> Optional[int]:
+    """
+    Асинхронное сохранение состояния по ключу, если сохранённая версия всё
+    ещё равна version. Возвращает новую версию или None при конфликте.
+    Asynchronously storing the state for a key if the stored version still
+    equals version. Returns the new version, or None on a conflict.
+    """
+    return await _writer.submit(database._save_persistent_data, kind, key,
+                                data, version)
+
+
+async def delete_persistent_data(kind: str, key: int, version: int) -> bool:
+    """
+    Асинхронное удаление состояния по ключу, если его версия не изменилась.
+    Asynchronously deleting the state for a key if its version is unchanged.
+    """
+    return await _writer.submit(database._delete_persistent_data, kind, key,
+                                version)
+
+
+async def search_messages(text: str, message_type: Optional[str] = None,
+                          date_from: Optional[str] = None,
+                          date_to: Optional[str] = None,
+                          before: Optional[int] = None
+                          ) -> Tuple[List[Tuple[Any, ...]], bool]:
+    """
+    Асинхронный полнотекстовый поиск по сообщениям и ответам.
+    Asynchronous full-text search over messages and replies.
+    """
+    return await _run(_read_executor, database.search_messages, text,
+                      message_type, date_from, date_to, before)
+
+
+async def backfill_search_index(chunk: int) -> bool:
+    """
+    Асинхронное добавление очередной порции старых строк в поисковый
+    индекс. Возвращает True, пока остались строки.
+    Asynchronously adding the next chunk of old rows to the search index.
+    Returns True while rows remain.
+    """
+    return await _writer.submit(database._backfill_search_index, chunk)
+
+
+async def archive_messages(age_days: int, chunk: int) -> int:
+    """
+    Асинхронный перенос порции старых отвеченных сообщений в архив: сначала
+    копирование, затем отдельной транзакцией удаление из оперативной базы.
+    Возвращает число перенесённых сообщений.
+    Asynchronously moving a chunk of old answered messages to the archive:
+    first copying, then deleting from the hot tier in a separate
+    transaction. Returns the number of moved messages.
+    """
+    message_ids = await _writer.submit(database._copy_to_archive, age_days,
+                                       chunk)
+    if not message_ids:
+        return 0
+    return await _writer.submit(database._delete_archived, message_ids)
+
+
+async def incremental_vacuum(pages: int) -> int:
+    """
+    Асинхронное освобождение до pages страниц, оставшихся после архивации.
+    Возвращает число оставшихся свободных страниц.
+    Asynchronously freeing up to pages pages left after archiving. Returns
+    the number of free pages left.
+    """
+    return await _writer.submit(database._incremental_vacuum, pages)
+
+
+async def create_broadcast(text: str) -> Tuple[int, int]:
+    """
+    Асинхронное создание рассылки. Возвращает её ID и число получателей.
+    Asynchronously creating a broadcast. Returns its ID and the number of
+    recipients.
+    """
+    return await _writer.submit(database._create_broadcast, text)
+
+
+async def set_broadcast_status(broadcast_id: int, status: str) -> bool:
+    """
+    Асинхронное завершение идущей рассылки.
+    Asynchronously finishing a running broadcast.
+    """
+    return await _writer.submit(database._set_broadcast_status, broadcast_id,
+                                status)
+
+
+async def set_recipient_status(broadcast_id: int, user_id: int, status: str,
+                               error: Optional[str] = None) -> None:
+    """
+    Асинхронное сохранение результата доставки рассылки получателю.
+    Asynchronously storing the broadcast delivery result for a recipient.
+    """
+    await _writer.submit(database._set_recipient_status, broadcast_id,
+                         user_id, status, error)
+
+
+async def get_broadcast(broadcast_id: int) -> Optional[Tuple[str, str]]:
+    """
+    Асинхронное получение текста и статуса рассылки.
+    Asynchronously getting the text and status of a broadcast.
+    """
+    return await _run(_read_executor, database.get_broadcast, broadcast_id)
+
+
+async def get_running_broadcasts() -> List[int]:
+    """
+    Асинхронное получение ID незавершённых рассылок.
+    Asynchronously getting the IDs of unfinished broadcasts.
+    """
+    return await _run(_read_executor, database.get_running_broadcasts)
+
+
+async def get_latest_broadcast_id() -> Optional[int]:
+    """
+    Асинхронное получение ID последней рассылки.
+    Asynchronously getting the ID of the latest broadcast.
+    """
+    return await _run(_read_executor, database.get_latest_broadcast_id)
+
+
+async def get_pending_recipients(broadcast_id: int, after_user_id: int,
+                                 limit: int) -> List[int]:
+    """
+    Асинхронное получение следующей порции получателей рассылки.
+    Asynchronously getting the next chunk of broadcast recipients.
+    """
+    return await _run(_read_executor, database.get_pending_recipients,
+                      broadcast_id, after_user_id, limit)
+
+
+async def get_broadcast_counts(broadcast_id: int) -> Dict[str, int]:
+    """
+    Асинхронное получение числа получателей рассылки по статусам.
+    Asynchronously getting the number of broadcast recipients by status.
+    """
+    return await _run(_read_executor, database.get_broadcast_counts,
+                      broadcast_id)
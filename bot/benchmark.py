@@ -0,0 +1,329 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, List
+import config
+
+
+# ID администратора в тестовом прогоне / Admin ID in the benchmark run
+ADMIN_ID = 1
+FIRST_USER_ID = 1000
+
+
+class FakeBot:
+    """
+    Подмена Bot без сети: каждый вызов API просто ждёт заданную задержку.
+    Offline stand-in for Bot: every API call just waits for the given
+    latency.
+    """
+    defaults = None
+
+    def __init__(self, latency: float) -> None:
+        self.latency = latency
+        self.calls = 0
+
+    async def _call(self, **kwargs: Any) -> bool:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return True
+
+    async def send_message(self, **kwargs: Any) -> bool:
+        return await self._call(**kwargs)
+
+    async def edit_message_text(self, **kwargs: Any) -> bool:
+        return await self._call(**kwargs)
+
+    async def answer_callback_query(self, **kwargs: Any) -> bool:
+        return await self._call(**kwargs)
+
+    async def delete_message(self, **kwargs: Any) -> bool:
+        return await self._call(**kwargs)
+
+
+class FakeContext:
+    """
+    Минимальный контекст обработчика: бот и user_data.
+    Minimal handler context: the bot and user_data.
+    """
+
+    def __init__(self, bot: FakeBot) -> None:
+        self.bot = bot
+        self.user_data: Dict[str, Any] = {}
+
+
+class Recorder:
+    """
+    Собирает задержки вызовов обработчиков.
+    Collects handler call latencies.
+    """
+
+    def __init__(self) -> None:
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+
+    async def call(self, name: str, handler: Callable, update: Any,
+                   context: FakeContext) -> None:
+        started = time.perf_counter()
+        await handler(update, context)
+        self.latencies[name].append(time.perf_counter() - started)
+
+    def report(self, elapsed: float) -> Dict[str, Dict[str, float]]:
+        """
+        Считает пропускную способность и перцентили по каждому обработчику.
+        Computes throughput and percentiles for each handler.
+        """
+        result = {}
+        for name, values in sorted(self.latencies.items()):
+            values = sorted(values)
+
+            def percentile(p: float) -> float:
+                index = min(len(values) - 1, int(p * len(values)))
+                return values[index] * 1000
+
+            result[name] = {
+                'calls': len(values),
+                'throughput': len(values) / elapsed if elapsed else 0.0,
+                'p50_ms': percentile(0.50),
+                'p95_ms': percentile(0.95),
+                'p99_ms': percentile(0.99),
+                'max_ms': values[-1] * 1000
+            }
+        return result
+
+
+_update_ids = itertools.count(1)
+
+
+def _user(user_id: int) -> Dict[str, Any]:
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}',
+            'username': f'user{user_id}'}
+
+
+def make_message_update(bot: FakeBot, user_id: int, text: str) -> Any:
+    """
+    Создаёт синтетическое обновление с текстовым сообщением.
+    Creates a synthetic update with a text message.
+    """
+    from telegram import Update
+
+    update_id = next(_update_ids)
+    message = {
+        'message_id': update_id, 'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': _user(user_id), 'text': text
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0,
+                                'length': len(text.split()[0])}]
+    return Update.de_json({'update_id': update_id, 'message': message}, bot)
+
+
+def make_callback_update(bot: FakeBot, user_id: int, data: str) -> Any:
+    """
+    Создаёт синтетическое обновление с нажатием инлайн-кнопки.
+    Creates a synthetic update with an inline button press.
+    """
+    from telegram import Update
+
+    update_id = next(_update_ids)
+    query = {
+        'id': str(update_id), 'from': _user(user_id), 'chat_instance': '0',
+        'data': data,
+        'message': {'message_id': update_id, 'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'}, 'text': '-'}
+    }
+    return Update.de_json({'update_id': update_id, 'callback_query': query},
+                          bot)
+
+
+def seed_database(users: int, messages: int) -> None:
+    """
+    Заполняет базу историей: пользователями и отвеченными сообщениями.
+    Fills the database with history: users and answered messages.
+    """
+    import database
+
+    database.init_db()
+    history_users = range(FIRST_USER_ID + users,
+                          FIRST_USER_ID + users + max(1, messages // 10))
+    with database.db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''
+        INSERT OR IGNORE INTO users (user_id, username, first_name)
+        VALUES (?, ?, ?)
+        ''', [(user_id, f'user{user_id}', f'User{user_id}')
+              for user_id in history_users])
+        cursor.executemany('''
+        INSERT INTO messages (user_id, message_type, message_text,
+                              is_answered)
+        VALUES (?, ?, ?, TRUE)
+        ''', [(random.choice(history_users), 'message', f'history {i}')
+              for i in range(messages)])
+        cursor.execute('''
+        INSERT INTO replies (message_id, reply_text)
+        SELECT id, 'ok' FROM messages WHERE is_answered = TRUE
+        ''')
+        conn.commit()
+    database.load_active_users()
+
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    """
+    Прогоняет пользовательский и админский сценарии через настоящие
+    обработчики и возвращает отчёт.
+    Runs the user and admin scenarios through the real handlers and returns
+    a report.
+    """
+    import handlers
+    from config import get_message
+
+    bot = FakeBot(args.latency / 1000)
+    recorder = Recorder()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    button = get_message('message_types.message.button', 'ru')
+
+    async def user_scenario(user_id: int) -> None:
+        context = FakeContext(bot)
+        async with semaphore:
+            await recorder.call('start', handlers.start, make_message_update(
+                bot, user_id, '/start'), context)
+            for text in (button, f'Feedback from {user_id}',
+                         'One more message'):
+                await recorder.call(
+                    'handle_user_message', handlers.handle_user_message,
+                    make_message_update(bot, user_id, text), context)
+
+    async def admin_scenario(context: FakeContext, user_id: int) -> None:
+        async def callback(data: str) -> None:
+            await recorder.call(
+                'handle_admin_callback', handlers.handle_admin_callback,
+                make_callback_update(bot, ADMIN_ID, data), context)
+
+        await callback('unanswered')
+        await callback('history')
+        await callback(f'user_{user_id}_0')
+        await callback(f'reply_{user_id}')
+        await recorder.call(
+            'handle_admin_reply', handlers.handle_admin_reply,
+            make_message_update(bot, ADMIN_ID, f'Reply to {user_id}'),
+            context)
+
+    await handlers.start(make_message_update(bot, ADMIN_ID, '/start'),
+                         FakeContext(bot))
+    user_ids = range(FIRST_USER_ID, FIRST_USER_ID + args.users)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user_scenario(user_id) for user_id in user_ids))
+    admin_context = FakeContext(bot)
+    for user_id in list(user_ids)[:args.admin_rounds]:
+        await admin_scenario(admin_context, user_id)
+    elapsed = time.perf_counter() - started
+
+    import async_database
+    await async_database.shutdown()
+    from sender import outbox
+    await outbox.stop()
+
+    return {
+        'users': args.users,
+        'db_messages': args.db_messages,
+        'latency_ms': args.latency,
+        'elapsed_s': elapsed,
+        'api_calls': bot.calls,
+        'handlers': recorder.report(elapsed)
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    """
+    Разбор аргументов командной строки.
+    Parsing command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description='Offline load test of the bot handlers')
+    parser.add_argument('--users', type=int, default=200,
+                        help='number of simulated users')
+    parser.add_argument('--db-messages', type=int, default=10000,
+                        help='answered messages to seed the database with')
+    parser.add_argument('--latency', type=float, default=20.0,
+                        help='simulated Bot API latency, ms')
+    parser.add_argument('--concurrency', type=int, default=50,
+                        help='users processed at the same time')
+    parser.add_argument('--admin-rounds', type=int, default=20,
+                        help='admin view-and-reply rounds')
+    parser.add_argument('--real-limits', action='store_true',
+                        help='keep the outbound rate limits from config.py')
+    parser.add_argument('--json', action='store_true',
+                        help='print the report as JSON')
+    parser.add_argument('--max-p95', type=float, default=None,
+                        help='fail if any handler p95 exceeds this, ms')
+    return parser.parse_args()
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    """
+    Печатает отчёт таблицей.
+    Prints the report as a table.
+    """
+    print(f"users={report['users']} db_messages={report['db_messages']} "
+          f"api_latency={report['latency_ms']}ms "
+          f"elapsed={report['elapsed_s']:.2f}s "
+          f"api_calls={report['api_calls']}")
+    print(f"{'handler':<24}{'calls':>7}{'upd/s':>10}{'p50 ms':>10}"
+          f"{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, stats in report['handlers'].items():
+        print(f"{name:<24}{stats['calls']:>7}{stats['throughput']:>10.1f}"
+              f"{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}"
+              f"{stats['p99_ms']:>10.2f}{stats['max_ms']:>10.2f}")
+
+
+def main() -> int:
+    """
+    Запуск нагрузочного теста. Возвращает код выхода для CI.
+    Runs the load test. Returns the exit code for CI.
+    """
+    args = parse_args()
+
+    # Настройки подменяются до импорта модулей бота, которые читают их при
+    # загрузке / Settings are overridden before importing the bot modules,
+    # which read them on load
+    workdir = tempfile.mkdtemp(prefix='feedback-bench-')
+    config.DATABASE_PATH = os.path.join(workdir, 'feedback_bot.db')
+    config.ARCHIVE_DATABASE_PATH = os.path.join(workdir,
+                                                'feedback_bot_archive.db')
+    config.YOUR_CHAT_ID = ADMIN_ID
+    if not args.real_limits:
+        config.SEND_GLOBAL_RATE = config.SEND_CHAT_RATE = 1e9
+        config.SEND_CHAT_BURST = 1e9
+
+    try:
+        seed_database(args.users, args.db_messages)
+        report = asyncio.run(run_benchmark(args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+    if args.max_p95 is not None:
+        slow = [name for name, stats in report['handlers'].items()
+                if stats['p95_ms'] > args.max_p95]
+        if slow:
+            print(f'p95 above {args.max_p95}ms: {", ".join(slow)}',
+                  file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
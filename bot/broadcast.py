@@ -0,0 +1,225 @@
+import asyncio
+import time
+from functools import partial
+from typing import Any, Dict, List
+from telegram.error import BadRequest, Forbidden
+from config import (
+    logger, get_message, YOUR_CHAT_ID, BROADCAST_CONCURRENCY, BROADCAST_CHUNK
+)
+from async_database import (
+    get_user_language, set_broadcast_status, set_recipient_status,
+    get_broadcast, get_running_broadcasts, get_pending_recipients,
+    get_broadcast_counts
+)
+from sender import outbox, PRIORITY_LOW
+from metrics import SEND_SECONDS, SEND_ERRORS
+
+
+# Статусы доставки получателю / Recipient delivery statuses
+PENDING = 'pending'
+SENT = 'sent'
+BLOCKED = 'blocked'
+FAILED = 'failed'
+
+
+async def format_broadcast_status(broadcast_id: int, status: str,
+                                  lang: str) -> str:
+    """
+    Формирует текст о ходе рассылки.
+    Builds the broadcast progress text.
+    """
+    counts = await get_broadcast_counts(broadcast_id)
+    return get_message('broadcast_status', lang, id=broadcast_id,
+                       status=status, sent=counts.get(SENT, 0),
+                       pending=counts.get(PENDING, 0),
+                       blocked=counts.get(BLOCKED, 0),
+                       failed=counts.get(FAILED, 0))
+
+
+class Broadcaster:
+    """
+    Рассылки: получатели читаются порциями по возрастанию ID и доставляются
+    ограниченным числом параллельных обработчиков через очередь исходящих с
+    низким приоритетом, поэтому ответы пользователям идут первыми, а
+    глобальный и поштучный лимиты Telegram соблюдаются. Результат каждой
+    доставки сохраняется, и после перезапуска рассылка продолжается с
+    необработанных получателей.
+    Broadcasts: recipients are read in chunks by ascending ID and delivered
+    by a bounded number of concurrent workers through the outbound queue at
+    low priority, so replies to users go first and the global and per-chat
+    Telegram limits are respected. The result of every delivery is stored,
+    and after a restart a broadcast continues from the pending recipients.
+    """
+
+    def __init__(self, concurrency: int, chunk: int) -> None:
+        self._concurrency = concurrency
+        self._chunk = chunk
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._stopping = False
+
+    def start(self, bot: Any, broadcast_id: int) -> None:
+        """
+        Запускает доставку рассылки в фоновой задаче.
+        Starts delivering a broadcast in a background task.
+        """
+        if broadcast_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(bot, broadcast_id),
+                                   name=f'broadcast-{broadcast_id}')
+        self._tasks[broadcast_id] = task
+        task.add_done_callback(
+            lambda _: self._tasks.pop(broadcast_id, None))
+
+    async def resume(self, bot: Any) -> None:
+        """
+        Продолжает рассылки, прерванные остановкой бота.
+        Resumes broadcasts interrupted by a bot shutdown.
+        """
+        for broadcast_id in await get_running_broadcasts():
+            logger.info('Resuming broadcast %s', broadcast_id)
+            self.start(bot, broadcast_id)
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        """
+        Отменяет рассылку: недоставленные получатели не получат сообщение.
+        Cancels a broadcast: undelivered recipients will not get the message.
+        """
+        cancelled = await set_broadcast_status(broadcast_id, 'cancelled')
+        task = self._tasks.get(broadcast_id)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        return cancelled
+
+    async def stop(self, timeout: float = 5.0) -> None:
+        """
+        Останавливает задачи рассылок, не меняя их статус: после запуска
+        они продолжатся. Уже начатые доставки успевают сохранить результат,
+        чтобы получатели не получили сообщение повторно.
+        Stops the broadcast tasks without changing their status: they
+        continue after the next start. Deliveries already started get to
+        store their result, so recipients do not get the message twice.
+        """
+        tasks = list(self._tasks.values())
+        if not tasks:
+            return
+        self._stopping = True
+        try:
+            await asyncio.wait(tasks, timeout=timeout)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            self._stopping = False
+
+    async def _run(self, bot: Any, broadcast_id: int) -> None:
+        """
+        Доставляет рассылку всем необработанным получателям.
+        Delivers a broadcast to all pending recipients.
+        """
+        broadcast = await get_broadcast(broadcast_id)
+        if broadcast is None:
+            return
+        text, _ = broadcast
+
+        # Очередь ограничена, поэтому в памяти не больше пары порций /
+        # The queue is bounded, so no more than a couple of chunks are held
+        # in memory
+        recipients: asyncio.Queue = asyncio.Queue(maxsize=self._chunk)
+        workers: List[asyncio.Task] = [
+            asyncio.create_task(self._worker(bot, broadcast_id, text,
+                                             recipients))
+            for _ in range(self._concurrency)
+        ]
+        started = time.monotonic()
+        try:
+            after_user_id = 0
+            while not self._stopping:
+                user_ids = await get_pending_recipients(
+                    broadcast_id, after_user_id, self._chunk)
+                if not user_ids:
+                    break
+                for user_id in user_ids:
+                    if self._stopping:
+                        break
+                    await recipients.put(user_id)
+                after_user_id = user_ids[-1]
+
+            # При остановке получатели из очереди остаются необработанными,
+            # а ждать нужно только начатые доставки / On stop the queued
+            # recipients stay pending, and only the started deliveries are
+            # waited for
+            while self._stopping and not recipients.empty():
+                recipients.get_nowait()
+                recipients.task_done()
+            await recipients.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+        if self._stopping:
+            return
+        if not await set_broadcast_status(broadcast_id, 'done'):
+            return
+        logger.info('Broadcast %s finished in %.1fs', broadcast_id,
+                    time.monotonic() - started)
+        await self._notify_admin(bot, broadcast_id)
+
+    async def _worker(self, bot: Any, broadcast_id: int, text: str,
+                      recipients: asyncio.Queue) -> None:
+        while True:
+            user_id = await recipients.get()
+            try:
+                await self._deliver(bot, broadcast_id, text, user_id)
+            except Exception as e:
+                # Получатель остаётся необработанным и получит сообщение
+                # после перезапуска / The recipient stays pending and gets
+                # the message after a restart
+                logger.error('Broadcast %s to %s failed: %s', broadcast_id,
+                             user_id, e)
+            finally:
+                recipients.task_done()
+
+    async def _deliver(self, bot: Any, broadcast_id: int, text: str,
+                       user_id: int) -> None:
+        """
+        Отправляет сообщение рассылки одному получателю и сохраняет итог.
+        Sends the broadcast message to one recipient and stores the outcome.
+        """
+        status, error = SENT, None
+        started = time.perf_counter()
+        try:
+            await outbox.send(user_id, partial(
+                bot.send_message, chat_id=user_id, text=text,
+                parse_mode=None), PRIORITY_LOW)
+        except (Forbidden, BadRequest) as e:
+            # Бот заблокирован, аккаунт удалён или чат не найден / The bot
+            # is blocked, the account is deleted or the chat is not found
+            unreachable = (isinstance(e, Forbidden)
+                           or 'chat not found' in e.message.lower())
+            status, error = (BLOCKED if unreachable else FAILED), e.message
+            SEND_ERRORS.inc('broadcast', type(e).__name__)
+        except Exception as e:
+            status, error = FAILED, str(e)
+            SEND_ERRORS.inc('broadcast', type(e).__name__)
+        finally:
+            SEND_SECONDS.observe(time.perf_counter() - started, 'broadcast')
+
+        await set_recipient_status(broadcast_id, user_id, status, error)
+
+    async def _notify_admin(self, bot: Any, broadcast_id: int) -> None:
+        """
+        Сообщает администратору итоги рассылки.
+        Reports the broadcast results to the administrator.
+        """
+        try:
+            lang = await get_user_language(YOUR_CHAT_ID)
+            text = await format_broadcast_status(broadcast_id, 'done', lang)
+            await outbox.send(YOUR_CHAT_ID, partial(
+                bot.send_message, chat_id=YOUR_CHAT_ID, text=text))
+        except Exception as e:
+            logger.error('Failed to report broadcast %s: %s', broadcast_id, e)
+
+
+broadcaster = Broadcaster(BROADCAST_CONCURRENCY, BROADCAST_CHUNK)
@@ -0,0 +1,205 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Iterable, Optional, Set, Tuple
+
+
+class LRUCache:
+    """
+    Потокобезопасный ограниченный LRU-кэш со счётчиками попаданий. С ttl
+    запись устаревает через ttl секунд после сохранения и читается заново,
+    так что изменения из других процессов видны не позже чем через ttl.
+    Thread-safe bounded LRU cache with hit/miss counters. With ttl an entry
+    expires ttl seconds after it was stored and is read again, so changes
+    made by other processes show up within ttl.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None) -> None:
+        self._maxsize = maxsize
+        self._ttl = ttl
+        # Ключ -> (момент устаревания, значение) / Key -> (expiry time,
+        # value)
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def version(self) -> int:
+        """
+        Номер версии, увеличивающийся при каждом изменении кэша записью.
+        Version number that grows on every write to the cache.
+        """
+        return self._version
+
+    def _lookup(self, key: Hashable) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires is not None and expires <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Возвращает значение по ключу или None при промахе.
+        Returns the value for the key or None on a miss.
+        """
+        with self._lock:
+            value = self._lookup(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """
+        Возвращает значение без учёта в статистике и порядке вытеснения.
+        Returns the value without touching the stats or eviction order.
+        """
+        with self._lock:
+            return self._lookup(key)
+
+    def _store(self, key: Hashable, value: Any) -> None:
+        expires = time.monotonic() + self._ttl \
+            if self._ttl is not None else None
+        self._data[key] = (expires, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """
+        Записывает значение (после успешной записи в базу).
+        Stores a value (after a successful database write).
+        """
+        with self._lock:
+            self._version += 1
+            self._store(key, value)
+
+    def put_if_unchanged(self, key: Hashable, value: Any,
+                         version: int) -> None:
+        """
+        Записывает прочитанное из базы значение, только если с момента
+        чтения не было записей - иначе значение могло устареть.
+        Stores a value read from the database only if nothing was written
+        since the read - otherwise the value may be stale.
+        """
+        with self._lock:
+            if self._version == version:
+                self._store(key, value)
+
+    def update(self, key: Hashable, **fields: Any) -> None:
+        """
+        Обновляет поля закэшированной записи (namedtuple), если она есть.
+        Updates fields of a cached entry (namedtuple) if it is present.
+        """
+        with self._lock:
+            self._version += 1
+            value = self._lookup(key)
+            if value is not None:
+                self._data[key] = (self._data[key][0],
+                                   value._replace(**fields))
+
+    def invalidate(self, key: Hashable) -> None:
+        """
+        Удаляет запись из кэша.
+        Removes an entry from the cache.
+        """
+        with self._lock:
+            self._version += 1
+            self._data.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Возвращает статистику кэша.
+        Returns cache statistics.
+        """
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self._maxsize,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+
+class ActiveUserSet:
+    """
+    Потокобезопасное множество ID пользователей с активным сообщением.
+    Меняется только после фиксации записи. Другой процесс может снять флаг
+    в базе, поэтому наличие ID в множестве нужно подтверждать по базе, а
+    отсутствие - нет: поставить флаг другому процессу не даёт атомарная
+    отправка сообщения.
+    Thread-safe set of IDs of users with an active message. It changes only
+    after a write is committed. Another process may clear the flag in the
+    database, so presence in the set must be confirmed against the
+    database, while absence need not be: the atomic message submission
+    keeps another process from setting it.
+    """
+
+    def __init__(self) -> None:
+        self._users: Set[int] = set()
+        self._lock = threading.Lock()
+        self._version = 0
+        self.loaded = False
+
+    @property
+    def version(self) -> int:
+        """
+        Номер версии, увеличивающийся при каждом изменении множества.
+        Version number that grows on every change of the set.
+        """
+        return self._version
+
+    def __contains__(self, user_id: int) -> bool:
+        with self._lock:
+            return user_id in self._users
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._users)
+
+    def set(self, user_id: int, active: bool) -> None:
+        """
+        Отмечает пользователя активным или неактивным.
+        Marks the user as active or inactive.
+        """
+        with self._lock:
+            self._version += 1
+            if active:
+                self._users.add(user_id)
+            else:
+                self._users.discard(user_id)
+
+    def discard_if_unchanged(self, user_id: int, version: int) -> None:
+        """
+        Убирает пользователя по результату чтения из базы, только если с
+        момента чтения множество не менялось.
+        Removes a user based on a database read only if the set has not
+        changed since the read.
+        """
+        with self._lock:
+            if self._version == version:
+                self._users.discard(user_id)
+
+    def reconcile(self, user_ids: Iterable[int]) -> Tuple[Set[int], Set[int]]:
+        """
+        Заменяет содержимое снимком из базы. Возвращает расхождение: ID,
+        которых не хватало, и лишние ID.
+        Replaces the contents with a snapshot from the database. Returns the
+        drift: the missing IDs and the extra IDs.
+        """
+        snapshot = set(user_ids)
+        with self._lock:
+            missing = snapshot - self._users
+            extra = self._users - snapshot
+            self._users = snapshot
+            self._version += 1
+            self.loaded = True
+        return missing, extra
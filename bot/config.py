@@ -1,23 +1,146 @@
 import os
 import logging
-from typing import Union
-
-
-# Настройки логгирования / Logging settings
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
-)
+from string import Formatter
+from typing import Any, Dict, List, Optional, Tuple, Union
+from logs import setup_logging
+
+
+# Настройки логгирования: файл сменяется по размеру и раз в LOG_ROTATE_INTERVAL
+# секунд, LOG_JSON пишет файл строками JSON / Logging settings: the file is
+# rotated by size and every LOG_ROTATE_INTERVAL seconds, LOG_JSON writes the
+# file as JSON lines
+LOG_FILE = 'bot.log'
+LOG_LEVEL = logging.INFO
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_ROTATE_INTERVAL = 24 * 3600  # секунды / seconds
+LOG_BACKUP_COUNT = 7
+LOG_JSON = False
+
+# Запись журнала идёт в фоновом потоке / Log writing runs on a background
+# thread
+setup_logging(LOG_FILE, LOG_LEVEL, LOG_FORMAT, LOG_MAX_BYTES,
+              LOG_ROTATE_INTERVAL, LOG_BACKUP_COUNT, LOG_JSON)
 logger = logging.getLogger(__name__)
 
 # Конфигурация бота / Bot configuration
 YOUR_CHAT_ID = '!!!⚠️ your chat id ⚠️!!!'
 TELEGRAM_BOT_TOKEN = '!!!⚠️ your bot token ⚠️!!!'
 MAX_MESSAGE_LENGTH = 4000
+HISTORY_PAGE_SIZE = 5
+UNANSWERED_PAGE_SIZE = 10
+SEARCH_PAGE_SIZE = 8
+KEYBOARD_CACHE_SIZE = 256
+
+# Настройки базы данных / Database settings
+DATABASE_PATH = 'feedback_bot.db'
+DB_POOL_SIZE = 5
+DB_BUSY_TIMEOUT = 5.0
+DB_STATEMENT_CACHE_SIZE = 256
+DB_CACHE_SIZE_KIB = 20000
+DB_MMAP_SIZE = 256 * 1024 * 1024
+USER_CACHE_SIZE = 10000
+# Кэш пользователей у каждого процесса свой: язык, изменённый другим
+# процессом, виден не позже чем через USER_CACHE_TTL секунд (None - кэш не
+# устаревает, подходит только для одного процесса) / Every process has its
+# own user cache: a language changed by another process shows up within
+# USER_CACHE_TTL seconds (None - entries never expire, only suitable for a
+# single process)
+USER_CACHE_TTL = 300
+
+# Архив: отвеченные сообщения старше ARCHIVE_AFTER_DAYS дней переносятся в
+# отдельный файл (None - не переносить) / Archive: answered messages older
+# than ARCHIVE_AFTER_DAYS days are moved to a separate file (None - do not
+# move)
+ARCHIVE_DATABASE_PATH = 'feedback_bot_archive.db'
+ARCHIVE_AFTER_DAYS = 180
+ARCHIVE_CHUNK = 500
+ARCHIVE_INTERVAL = 3600  # секунды / seconds
+ARCHIVE_PAUSE = 0.1  # секунды / seconds
+ARCHIVE_VACUUM_PAGES = 1000
+
+# Профилирование запросов: время каждого запроса и журнал медленных /
+# Query profiling: timing of every statement and a slow-query log
+DB_PROFILE = False
+DB_SLOW_QUERY_MS = 50
+DB_PROFILE_TOP = 20
+
+# Хранение состояния диалогов в базе данных. PERSISTENCE_SHARED включается,
+# когда несколько процессов бота работают с одной базой / Storing the
+# conversation state in the database. PERSISTENCE_SHARED is enabled when
+# several bot processes share one database
+PERSISTENCE_ENABLED = True
+PERSISTENCE_UPDATE_INTERVAL = 1.0  # секунды / seconds
+PERSISTENCE_SHARED = False
+
+# Постепенное заполнение поискового индекса для существующих данных /
+# Gradual filling of the search index for existing data
+SEARCH_BACKFILL_CHUNK = 2000
+SEARCH_BACKFILL_PAUSE = 0.05  # секунды / seconds
+
+# Выгрузка истории: строк за одно чтение и максимальный размер документа,
+# который можно отправить ботом / History export: rows per fetch and the
+# maximum document size a bot can send
+EXPORT_FETCH_SIZE = 1000
+EXPORT_MAX_DOCUMENT_SIZE = 50 * 1024 * 1024  # байты / bytes
+
+# Рассылки: одновременных отправок и получателей за одно чтение из базы.
+# Скорость ограничивают SEND_GLOBAL_RATE и SEND_CHAT_RATE / Broadcasts:
+# concurrent sends and recipients per database read. The rate is limited by
+# SEND_GLOBAL_RATE and SEND_CHAT_RATE
+BROADCAST_CONCURRENCY = 30
+BROADCAST_CHUNK = 1000
+
+# Ограничение частоты обновлений от одного пользователя по типу
+# обработчика: (обновлений в секунду, всплеск). Лишние обновления
+# отклоняются до обращения к базе / Per-user update rate limits by handler
+# type: (updates per second, burst). Excess updates are rejected before any
+# database access
+USER_RATE_LIMITS = {
+    'message': (1.0, 5),
+    'command': (0.5, 3),
+    'callback': (2.0, 10)
+}
+USER_RATE_IDLE = 600  # секунды / seconds
+
+# Статистика /stats: период по умолчанию и наибольший в днях / /stats
+# statistics: the default and the longest period in days
+STATS_DEFAULT_DAYS = 7
+STATS_MAX_DAYS = 90
+
+# Сверка множества пользователей с активным сообщением с базой /
+# Reconciling the set of users with an active message with the database
+ACTIVE_USERS_RECONCILE_INTERVAL = 300  # секунды / seconds
+
+# Групповая фиксация записей / Group commit of writes
+WRITE_MAX_BATCH = 100
+WRITE_MAX_LINGER = 0.002  # секунды / seconds
+
+# Режим получения обновлений: 'polling' или 'webhook' / Update receiving
+# mode: 'polling' or 'webhook'
+BOT_MODE = 'polling'
+CONCURRENT_UPDATES = 32
+
+# Настройки вебхука / Webhook settings
+WEBHOOK_LISTEN = '127.0.0.1'
+WEBHOOK_PORT = 8443
+WEBHOOK_URL_PATH = 'telegram'
+WEBHOOK_URL = None  # Например / For example 'https://example.com/telegram'
+WEBHOOK_SECRET_TOKEN = None
+WEBHOOK_MAX_CONNECTIONS = 40
+
+# Ограничения исходящих запросов к Telegram / Outgoing Telegram request
+# limits
+SEND_GLOBAL_RATE = 30  # запросов в секунду / requests per second
+SEND_CHAT_RATE = 1  # запросов в секунду на чат / requests per second per chat
+SEND_CHAT_BURST = 3
+SEND_WORKERS = 8
+SEND_MAX_RETRIES = 3
+
+# Метрики Prometheus (None - не запускать) / Prometheus metrics (None - do not
+# start)
+METRICS_LISTEN = '127.0.0.1'
+METRICS_PORT = None  # Например / For example 9100
 
 if YOUR_CHAT_ID is None or TELEGRAM_BOT_TOKEN is None:
     raise ValueError('Required environment variables are not set')
@@ -32,6 +155,7 @@ LOCALES = {
         'message_too_long': 'Сообщение слишком длинное. '
                 'Максимум {max_length} символов.',
         'no_name': 'Без имени',
+        'slow_down': '⏳ Слишком много сообщений. Подождите немного.',
 
         # Сообщения пользователя
         'start_user': 'Привет, {name}! Выберите тип сообщения:',
@@ -52,7 +176,50 @@ LOCALES = {
         'no_history': 'Нет истории переписок.',
         'enter_reply': '✉️ Введите ваш ответ:',
         'unanswered_messages': '📨 Неотвеченные сообщения:',
+        'unanswered_count': '📨 Неотвеченные сообщения: {shown} из {total}',
         'message_history': '📂 История переписки:',
+        'sqlstats_disabled': 'Профилирование запросов выключено '
+                '(DB_PROFILE = False).',
+        'sqlstats_empty': 'Статистика запросов пока пуста.',
+        'search_usage': '🔎 Поиск: /search слова [type:{types}] '
+                '[from:ГГГГ-ММ-ДД] [to:ГГГГ-ММ-ДД]\n'
+                'Слово со * в конце ищется по началу: достав*',
+        'search_results': '🔎 «{query}» - страница {page}:',
+        'search_nothing': '🔎 По запросу «{query}» ничего не найдено.',
+        'export_usage': '📤 Выгрузка: /export [csv|jsonl] [gz] '
+                '[type:{types}] [from:ГГГГ-ММ-ДД] [to:ГГГГ-ММ-ДД]',
+        'export_started': '📤 Готовлю выгрузку...',
+        'export_done': '📤 Сообщений в выгрузке: {count}',
+        'export_too_large': '📤 Файл выгрузки ({size} МБ) больше лимита '
+                'Telegram. Добавьте gz, сузьте фильтры или запустите '
+                'export.py на сервере.',
+        'broadcast_usage': '📣 Рассылка всем пользователям: /broadcast текст\n'
+                'Остановить текущую: /broadcast stop',
+        'broadcast_started': '📣 Рассылка #{id} запущена, получателей: '
+                '{count}.',
+        'broadcast_running': '📣 Рассылка #{id} ещё идёт.',
+        'broadcast_stopped': '📣 Рассылка #{id} остановлена.',
+        'broadcast_status': '📣 Рассылка #{id} ({status}): доставлено {sent}, '
+                'в очереди {pending}, заблокировали бота {blocked}, '
+                'ошибок {failed}.',
+        'stats_usage': '📊 Статистика: /stats [дней], от 1 до {max_days}',
+        'stats_header': '📊 Статистика за {days} дн. (UTC)\n'
+                'Сообщений: {messages}, отвечено: {answered}, '
+                'ждут ответа: {unanswered}',
+        'stats_type': '{type}: {messages}',
+        'stats_response_time': '⏱ Время первого ответа: 50% - {p50}, '
+                '90% - {p90}, 99% - {p99}',
+        'stats_no_replies': '⏱ За период ответов не было',
+        'stats_days': 'По дням (сообщений / отвечено):',
+        'stats_day': '{day}: {messages} / {answered}',
+        'duration_within': 'до {duration}',
+        'duration_over': 'больше {duration}',
+        'duration_units': {
+            's': '{n} с',
+            'm': '{n} мин',
+            'h': '{n} ч',
+            'd': '{n} дн.'
+        },
         'new_message': '📩 Новое сообщение\n\n👤 Отправитель: '
                 '{username}\n📌 Тип: {type}\n✉️ Текст:\n{text}',
         'message_from': '📩 *Сообщение от {name}*\n\n📌 Тип: {type}\n✉️ '
@@ -99,6 +266,7 @@ LOCALES = {
         'message_too_long': 'Message is too long. '
                 'Maximum {max_length} characters.',
         'no_name': 'No name',
+        'slow_down': '⏳ Too many messages. Please wait a moment.',
 
         # User messages
         'start_user': 'Hello, {name}! Choose message type:',
@@ -119,7 +287,50 @@ LOCALES = {
         'no_history': 'No message history.',
         'enter_reply': '✉️ Enter your reply:',
         'unanswered_messages': '📨 Unanswered messages:',
+        'unanswered_count': '📨 Unanswered messages: {shown} of {total}',
         'message_history': '📂 Message history:',
+        'sqlstats_disabled': 'Query profiling is disabled '
+                '(DB_PROFILE = False).',
+        'sqlstats_empty': 'No query statistics yet.',
+        'search_usage': '🔎 Search: /search words [type:{types}] '
+                '[from:YYYY-MM-DD] [to:YYYY-MM-DD]\n'
+                'A word ending with * matches by prefix: deliver*',
+        'search_results': '🔎 "{query}" - page {page}:',
+        'search_nothing': '🔎 Nothing found for "{query}".',
+        'export_usage': '📤 Export: /export [csv|jsonl] [gz] '
+                '[type:{types}] [from:YYYY-MM-DD] [to:YYYY-MM-DD]',
+        'export_started': '📤 Preparing the export...',
+        'export_done': '📤 Messages exported: {count}',
+        'export_too_large': '📤 The export file ({size} MB) exceeds the '
+                'Telegram limit. Add gz, narrow the filters or run '
+                'export.py on the server.',
+        'broadcast_usage': '📣 Broadcast to all users: /broadcast text\n'
+                'Stop the current one: /broadcast stop',
+        'broadcast_started': '📣 Broadcast #{id} started, recipients: '
+                '{count}.',
+        'broadcast_running': '📣 Broadcast #{id} is still running.',
+        'broadcast_stopped': '📣 Broadcast #{id} stopped.',
+        'broadcast_status': '📣 Broadcast #{id} ({status}): delivered {sent}, '
+                'pending {pending}, blocked the bot {blocked}, '
+                'failed {failed}.',
+        'stats_usage': '📊 Statistics: /stats [days], 1 to {max_days}',
+        'stats_header': '📊 Statistics for {days} days (UTC)\n'
+                'Messages: {messages}, answered: {answered}, '
+                'awaiting reply: {unanswered}',
+        'stats_type': '{type}: {messages}',
+        'stats_response_time': '⏱ First response time: 50% {p50}, '
+                '90% {p90}, 99% {p99}',
+        'stats_no_replies': '⏱ No replies in this period',
+        'stats_days': 'Per day (messages / answered):',
+        'stats_day': '{day}: {messages} / {answered}',
+        'duration_within': 'within {duration}',
+        'duration_over': 'over {duration}',
+        'duration_units': {
+            's': '{n} s',
+            'm': '{n} min',
+            'h': '{n} h',
+            'd': '{n} d'
+        },
         'new_message': '📩 New message\n\n👤 From: {username}\n📌 '
                 'Type: {type}\n✉️ Text:\n{text}',
         'message_from': '📩 *Message from {name}*\n\n📌 Type: {type}\n✉️ '
@@ -161,37 +372,161 @@ LOCALES = {
 }
 
 
+DEFAULT_LANGUAGE = 'ru'
+
+# Кнопки, по тексту которых определяется действие пользователя: путь к
+# тексту кнопки -> (действие, параметр) / Buttons whose text determines the
+# user's action: path to the button text -> (action, argument)
+BUTTONS = {
+    'change_language': ('change_language', None),
+    'message_types.suggestion.button': ('message_type', 'suggestion'),
+    'message_types.complaint.button': ('message_type', 'complaint'),
+    'message_types.message.button': ('message_type', 'message')
+}
+
+
+class Template:
+    """
+    Заранее разобранная строка формата.
+    Pre-parsed format string.
+    """
+    __slots__ = ('text', 'chunks', 'fields')
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.chunks: List[Tuple[str, Optional[str]]] = []
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if spec or conversion:
+                raise ValueError(
+                    f'Format spec is not supported in "{text}"')
+            self.chunks.append((literal, field))
+        self.fields = frozenset(
+            field for _, field in self.chunks if field is not None)
+
+    def render(self, values: Dict[str, Any]) -> str:
+        """
+        Подставляет значения в шаблон.
+        Substitutes values into the template.
+        """
+        if not self.fields:
+            return self.text
+        return ''.join(
+            literal + ('' if field is None else str(values[field]))
+            for literal, field in self.chunks
+        )
+
+
+def _flatten(node: Dict[str, Any], errors: List[str],
+             prefix: str = '') -> Dict[str, Any]:
+    """
+    Раскладывает вложенный словарь локали в плоскую таблицу по ключам через
+    точку. Вложенные словари сохраняются как есть для запросов с subkey.
+    Flattens a nested locale dict into a flat table keyed by dotted paths.
+    Nested dicts are kept as they are for subkey lookups.
+    """
+    table: Dict[str, Any] = {}
+    for key, value in node.items():
+        path = f'{prefix}{key}'
+        if isinstance(value, dict):
+            table[path] = value
+            table.update(_flatten(value, errors, f'{path}.'))
+            continue
+        try:
+            table[path] = Template(value)
+        except ValueError as e:
+            errors.append(f'"{path}": {e}')
+    return table
+
+
+def _compile_locales(locales: Dict[str, Dict[str, Any]]
+                     ) -> Tuple[Dict[str, Dict[str, Any]],
+                                Dict[Tuple[str, str], Tuple[str, Any]]]:
+    """
+    Компилирует локали в плоские таблицы и обратный индекс текстов кнопок.
+    Проверяет, что во всех языках одинаковые ключи и параметры шаблонов.
+    Compiles locales into flat tables and a reverse index of button texts.
+    Checks that all languages have the same keys and template parameters.
+    """
+    errors: List[str] = []
+    catalog = {lang: _flatten(locale, errors)
+               for lang, locale in locales.items()}
+    reference = catalog[DEFAULT_LANGUAGE]
+
+    for lang, table in catalog.items():
+        for key in reference.keys() - table.keys():
+            errors.append(f'{lang}: missing key "{key}"')
+        for key in table.keys() - reference.keys():
+            errors.append(f'{lang}: unknown key "{key}"')
+        for key in reference.keys() & table.keys():
+            expected, actual = reference[key], table[key]
+            if isinstance(expected, Template) != isinstance(actual, Template):
+                errors.append(f'{lang}: "{key}" has a different structure')
+            elif (isinstance(expected, Template)
+                  and expected.fields != actual.fields):
+                errors.append(
+                    f'{lang}: "{key}" expects {sorted(expected.fields)}, '
+                    f'got {sorted(actual.fields)}')
+
+    buttons = {}
+    for lang, table in catalog.items():
+        for key, action in BUTTONS.items():
+            template = table.get(key)
+            if not isinstance(template, Template):
+                errors.append(f'{lang}: button "{key}" is not a string')
+                continue
+            if (lang, template.text) in buttons:
+                errors.append(f'{lang}: duplicate button "{template.text}"')
+            buttons[(lang, template.text)] = action
+
+    if errors:
+        raise ValueError('Invalid locales:\n' + '\n'.join(errors))
+    return catalog, buttons
+
+
+# Локали компилируются один раз при запуске / Locales are compiled once at
+# startup
+CATALOG, BUTTON_ACTIONS = _compile_locales(LOCALES)
+
+
 def get_message(key: str, lang: str = 'ru', **kwargs) -> Union[str, dict]:
     """
     Возвращает локализованное сообщение с подстановкой параметров.
     Returns a localized message with parameter substitution.
     """
-    locale = LOCALES.get(lang, LOCALES['ru'])
-    msg = locale
-
-    try:
-        # Обработка вложенных ключей через точку / Processing nested keys
-        # through dot
-        keys = key.split('.')
-        for k in keys:
-            msg = msg.get(k, {})
-
-        # Если запрашивается конкретный subkey / If a specific subkey
-        # is requested
-        if 'subkey' in kwargs:
-            subkey = kwargs['subkey']
-            return msg.get(subkey, {})
-
-        # Если результат - строка, форматируем её / If the result is a string,
-        # format it
-        if isinstance(msg, str):
-            return msg.format(**kwargs) if kwargs else msg
-
-        return msg
-    except Exception as e:
-        logger.error(f'Error getting message "{key}": {e}')
+    table = CATALOG.get(lang) or CATALOG[DEFAULT_LANGUAGE]
+    msg = table.get(key)
+
+    if msg is None:
+        logger.error('Unknown message key "%s"', key)
         return key
 
+    # Если запрашивается конкретный subkey / If a specific subkey
+    # is requested
+    if 'subkey' in kwargs:
+        return msg.get(kwargs['subkey'], {})
+
+    # Если результат - шаблон, подставляем параметры / If the result is
+    # a template, substitute the parameters
+    if isinstance(msg, Template):
+        if not kwargs:
+            return msg.text
+        try:
+            return msg.render(kwargs)
+        except KeyError as e:
+            logger.error('Error getting message "%s": missing %s', key, e)
+            return key
+
+    return msg
+
+
+def get_button_action(text: str, lang: str = 'ru'
+                      ) -> Optional[Tuple[str, Any]]:
+    """
+    Возвращает действие (и его параметр) для текста нажатой кнопки.
+    Returns the action (and its argument) for the text of a pressed button.
+    """
+    return BUTTON_ACTIONS.get((lang, text))
+
 
 def is_admin(chat_id: Union[int, str]) -> bool:
     """
@@ -1,7 +1,226 @@
+import atexit
+import heapq
+import json
+import queue
+import re
 import sqlite3
+import threading
+import time
 from contextlib import contextmanager
-from typing import Iterator, List, Tuple, Any
-from config import logger, MAX_MESSAGE_LENGTH
+from functools import partial
+from typing import (
+    Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple, Any
+)
+from cache import LRUCache, ActiveUserSet
+from profiler import ProfilingConnection
+from migrations import migrate, response_time_bucket, SEARCH_SOURCES
+from metrics import (
+    timed, register_cache, DB_QUERY_SECONDS, DB_WRITE_BATCH_SIZE
+)
+from config import (
+    logger, MAX_MESSAGE_LENGTH, DATABASE_PATH, DB_POOL_SIZE, DB_BUSY_TIMEOUT,
+    DB_STATEMENT_CACHE_SIZE, DB_CACHE_SIZE_KIB, DB_MMAP_SIZE, USER_CACHE_SIZE,
+    USER_CACHE_TTL, HISTORY_PAGE_SIZE, UNANSWERED_PAGE_SIZE, DB_PROFILE,
+    SEARCH_PAGE_SIZE, ARCHIVE_DATABASE_PATH
+)
+
+# Операция записи: функция (cursor, after_commit, *args) и её аргументы;
+# after_commit - список действий, выполняемых после фиксации / Write
+# operation: a function (cursor, after_commit, *args) and its arguments;
+# after_commit is a list of actions run after the commit
+AfterCommit = List[Callable[[], None]]
+WriteOperation = Tuple[Callable[..., Any], Tuple[Any, ...]]
+WriteResult = Tuple[bool, Any]
+
+# Сообщения обоих уровней хранения: оперативного (main) и архива (archive).
+# Строка, уже скопированная в архив, но ещё не удалённая из оперативной
+# базы, берётся один раз. Ответы присоединяются по уровням, см.
+# _with_replies / Messages of both storage tiers: hot (main) and archive. A
+# row already copied to the archive but not yet deleted from the hot tier is
+# taken once. Replies are joined per tier, see _with_replies
+ALL_MESSAGES = '''(
+    SELECT id, user_id, message_type, message_text, created_at, is_answered
+    FROM main.messages
+    UNION ALL
+    SELECT id, user_id, message_type, message_text, created_at, is_answered
+    FROM archive.messages a
+    WHERE NOT EXISTS (SELECT 1 FROM main.messages h WHERE h.id = a.id)
+)'''
+
+
+def _with_replies(messages: str) -> str:
+    """
+    Запрос, присоединяющий к выборке сообщений messages (id, message_type,
+    message_text, created_at) их ответы: (тип, текст, дата, текст ответа,
+    дата ответа, ID сообщения) по порядку сообщений и ответов. Ответы
+    каждого уровня хранения ищутся по своему индексу, без объединения всех
+    ответов в одну выборку.
+    A query joining the messages selection (id, message_type, message_text,
+    created_at) with their replies: (type, text, date, reply text, reply
+    date, message ID) in message and reply order. Replies of each storage
+    tier are looked up by their own index, without combining all replies
+    into one selection.
+    """
+    return f'''
+    WITH m AS ({messages})
+    SELECT message_type, message_text, created_at, reply_text, replied_at, id
+    FROM (
+        SELECT m.id, m.message_type, m.message_text, m.created_at,
+               r.id AS reply_id, r.reply_text, r.created_at AS replied_at
+        FROM m LEFT JOIN main.replies r ON r.message_id = m.id
+        WHERE r.id IS NOT NULL
+           OR NOT EXISTS (SELECT 1 FROM archive.replies a
+                          WHERE a.message_id = m.id)
+        UNION ALL
+        SELECT m.id, m.message_type, m.message_text, m.created_at,
+               a.id, a.reply_text, a.created_at
+        FROM m JOIN archive.replies a ON a.message_id = m.id
+        WHERE NOT EXISTS (SELECT 1 FROM main.replies h WHERE h.id = a.id)
+    )
+    ORDER BY created_at, id, reply_id'''
+
+# Статистика: строки (день, тип, сообщений, отвечено), гистограмма времени
+# ответа {корзина: число} и число неотвеченных / Statistics: (day, type,
+# messages, answered) rows, the response time histogram {bucket: count} and
+# the number of unanswered messages
+Stats = Tuple[List[Tuple[str, str, int, int]], Dict[int, int], int]
+
+# Страница выборки: строки и признаки наличия предыдущей и следующей
+# страниц / Query page: rows and whether previous and next pages exist
+Page = Tuple[List[Tuple[Any, ...]], bool, bool]
+
+
+class CachedUser(NamedTuple):
+    """
+    Закэшированная строка таблицы users.
+    Cached row of the users table.
+    """
+    language: str
+    username: Optional[str]
+    first_name: Optional[str]
+    last_name: Optional[str]
+
+
+# Строка для пользователей, которых ещё нет в базе / Row for users that are
+# not in the database yet
+_UNKNOWN_USER = CachedUser('ru', None, None, None)
+
+
+class PoolExhaustedError(sqlite3.OperationalError):
+    """
+    Все соединения пула заняты дольше DB_BUSY_TIMEOUT.
+    All pool connections have been busy for longer than DB_BUSY_TIMEOUT.
+    """
+
+
+class ConnectionPool:
+    """
+    Пул долгоживущих соединений с базой данных.
+    Pool of long-lived database connections.
+    """
+
+    def __init__(self, database: str, size: int, archive: str) -> None:
+        self._database = database
+        self._archive = archive
+        self._size = size
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._connections: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+
+    def open(self) -> sqlite3.Connection:
+        """
+        Открывает и настраивает новое соединение, не учитываемое в пуле.
+        Opens and configures a new connection not counted in the pool.
+        """
+        conn = sqlite3.connect(
+            self._database,
+            timeout=DB_BUSY_TIMEOUT,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE_SIZE,
+            factory=ProfilingConnection if DB_PROFILE else sqlite3.Connection
+        )
+        # auto_vacuum действует только для нового файла и только до
+        # включения WAL / auto_vacuum only applies to a new file and only
+        # before WAL is enabled
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA cache_size = -{DB_CACHE_SIZE_KIB}')
+        conn.execute(f'PRAGMA mmap_size = {DB_MMAP_SIZE}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+
+        # Архив старых сообщений подключается как схема archive / The archive
+        # of old messages is attached as the archive schema
+        conn.execute('ATTACH DATABASE ? AS archive', (self._archive,))
+        conn.execute('PRAGMA archive.auto_vacuum = INCREMENTAL')
+        conn.execute('PRAGMA archive.journal_mode = WAL')
+        conn.execute('PRAGMA archive.synchronous = NORMAL')
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        """
+        Берёт соединение из пула, при необходимости открывая новое.
+        Takes a connection from the pool, opening a new one if needed.
+        """
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if len(self._connections) < self._size:
+                conn = self.open()
+                self._connections.append(conn)
+                return conn
+
+        try:
+            return self._idle.get(timeout=DB_BUSY_TIMEOUT)
+        except queue.Empty:
+            raise PoolExhaustedError(
+                f'All {self._size} database connections have been busy for '
+                f'{DB_BUSY_TIMEOUT} s') from None
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        """
+        Возвращает соединение в пул, откатывая незавершённую транзакцию.
+        Returns the connection to the pool, rolling back an unfinished
+        transaction.
+        """
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close(self) -> None:
+        """
+        Закрывает все соединения пула.
+        Closes all pool connections.
+        """
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+            self._idle = queue.LifoQueue()
+
+
+_pool = ConnectionPool(DATABASE_PATH, DB_POOL_SIZE, ARCHIVE_DATABASE_PATH)
+atexit.register(_pool.close)
+
+_user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+register_cache('users', _user_cache.stats)
+
+# Пользователи с активным сообщением; загружается при запуске /
+# Users with an active message; loaded on startup
+_active_users = ActiveUserSet()
+
+
+def open_connection() -> sqlite3.Connection:
+    """
+    Открывает отдельное соединение вне пула для долгих операций, которые не
+    должны занимать соединения пула. Закрывает его вызывающий.
+    Opens a dedicated connection outside the pool for long operations that
+    must not hold pool connections. The caller closes it.
+    """
+    return _pool.open()
 
 
 @contextmanager
@@ -10,117 +229,216 @@ def db_connection() -> Iterator[sqlite3.Connection]:
     Контекстный менеджер для работы с базой данных.
     Context manager for working with the database.
     """
-    conn = None
+    conn = _pool.acquire()
     try:
-        conn = sqlite3.connect('feedback_bot.db')
         yield conn
     except sqlite3.Error as e:
-        logger.error(f'Database error: {e}')
+        logger.error('Database error: %s', e)
         raise
     finally:
-        if conn:
-            conn.close()
+        _pool.release(conn)
+
+
+def run_write_batch(operations: List[WriteOperation]) -> List[WriteResult]:
+    """
+    Выполняет пачку операций записи в одной транзакции (групповая фиксация).
+    Каждая операция выполняется в своей точке сохранения, поэтому ошибка
+    одной из них не отменяет остальные. Возвращает для каждой операции пару
+    (успех, результат или исключение).
+    Runs a batch of write operations in one transaction (group commit).
+    Each operation runs in its own savepoint, so a failure of one does not
+    undo the others. Returns an (ok, result or exception) pair for each
+    operation.
+    """
+    results: List[WriteResult] = []
+    after_commit: AfterCommit = []
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('BEGIN')
+
+        for operation, args in operations:
+            operation_hooks: AfterCommit = []
+            cursor.execute('SAVEPOINT write_op')
+            started = time.perf_counter()
+            try:
+                result = operation(cursor, operation_hooks, *args)
+            except Exception as e:
+                cursor.execute('ROLLBACK TO write_op')
+                cursor.execute('RELEASE write_op')
+                if isinstance(e, sqlite3.Error):
+                    logger.error('Database error in %s: %s',
+                                 operation.__name__, e)
+                results.append((False, e))
+            else:
+                cursor.execute('RELEASE write_op')
+                after_commit.extend(operation_hooks)
+                results.append((True, result))
+
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started,
+                                     operation.__name__.lstrip('_'))
+
+        conn.commit()
+    DB_WRITE_BATCH_SIZE.observe(len(operations))
+
+    # Кэш обновляется только после успешной фиксации; ошибка действия не
+    # отменяет зафиксированные операции / The cache is updated only after
+    # a successful commit; a failing action does not undo the committed
+    # operations
+    for hook in after_commit:
+        try:
+            hook()
+        except Exception as e:
+            logger.error('After-commit action %s failed: %s',
+                         getattr(hook, 'func', hook).__qualname__, e)
+    return results
+
+
+def run_write(operation: Callable[..., Any], *args: Any) -> Any:
+    """
+    Выполняет одну операцию записи в отдельной транзакции.
+    Runs a single write operation in its own transaction.
+    """
+    ok, result = run_write_batch([(operation, args)])[0]
+    if not ok:
+        raise result
+    return result
 
 
 def init_db() -> None:
     """
-    Инициализация базы данных.
-    Initializing the database.
+    Инициализация базы данных: применение недостающих миграций схемы.
+    Вызывается явно при запуске, а не при импорте модуля.
+    Initializing the database: applying the missing schema migrations.
+    Called explicitly on startup, not on module import.
     """
     with db_connection() as conn:
         cursor = conn.cursor()
 
-        # Таблица "пользователи" / Table "users"
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            language TEXT DEFAULT 'ru',
-            has_active_message BOOLEAN DEFAULT FALSE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
+        # Режим auto_vacuum файла, созданного до его включения, меняется
+        # только полным VACUUM / The auto_vacuum mode of a file created
+        # before it was enabled only changes with a full VACUUM
+        cursor.execute('PRAGMA main.auto_vacuum')
+        if cursor.fetchone()[0] != 2:
+            logger.info('Incremental vacuum is off for this database file, '
+                        'run VACUUM once to enable it')
 
-        # Таблица "сообщения" / Table "messages"
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            message_type TEXT,
-            message_text TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            is_answered BOOLEAN DEFAULT FALSE,
-            FOREIGN KEY (user_id) REFERENCES users (user_id)
-        )
-        ''')
+        migrate(conn)
 
-        # Таблица "ответы" / Table "replies"
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS replies (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            message_id INTEGER,
-            reply_text TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (message_id) REFERENCES messages (id)
-        )
-        ''')
 
-        # Индексы для оптимизации / Indexes for optimization
-        cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_users_user_id
-                       ON users(user_id)
-        ''')
-        cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_messages_user_id
-                       ON messages(user_id)
-        ''')
-        cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_messages_is_answered
-                       ON messages(is_answered)
-        ''')
+def _get_cached_user(user_id: int) -> CachedUser:
+    """
+    Получение строки пользователя из кэша или, при промахе, из базы данных.
+    Getting the user's row from the cache or, on a miss, from the database.
+    """
+    cached = _user_cache.get(user_id)
+    if cached is not None:
+        return cached
+
+    version = _user_cache.version
+    with db_connection() as conn:
+        cursor = conn.cursor()
         cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_messages_created_at
-                       ON messages(created_at)
-        ''')
+        SELECT language, username, first_name, last_name
+        FROM users WHERE user_id = ?
+        ''', (user_id,))
+        result = cursor.fetchone()
+
+    cached = CachedUser(*result) if result else _UNKNOWN_USER
+    _user_cache.put_if_unchanged(user_id, cached, version)
+    return cached
+
+
+@timed(DB_QUERY_SECONDS)
+def warm_user_cache() -> None:
+    """
+    Предварительная загрузка последних пользователей в кэш.
+    Preloading the most recent users into the cache.
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
         cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_replies_message_id
-                       ON replies(message_id)
-        ''')
+        SELECT user_id, language, username, first_name, last_name
+        FROM users ORDER BY created_at DESC LIMIT ?
+        ''', (USER_CACHE_SIZE,))
+        rows = cursor.fetchall()
 
-        conn.commit()
+    # Заполняем в обратном порядке, чтобы новые были последними в LRU /
+    # Filling in reverse order so the newest end up most recently used
+    for row in reversed(rows):
+        _user_cache.put(row[0], CachedUser(*row[1:]))
+    logger.info('User cache warmed with %d users', len(rows))
+
+
+def peek_user_language(user_id: int) -> Optional[str]:
+    """
+    Язык пользователя, если он есть в кэше; база данных не читается.
+    The user's language if it is cached; the database is not read.
+    """
+    cached = _user_cache.peek(user_id)
+    return cached.language if cached is not None else None
 
 
+@timed(DB_QUERY_SECONDS)
 def get_user_language(user_id: int) -> str:
     """
     Получение языка пользователя из базы данных.
     Getting the user's language from the database.
     """
-    with db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('SELECT language FROM users WHERE user_id = ?',
-                      (user_id,))
-        result = cursor.fetchone()
-        return result[0] if result else 'ru'
+    return _get_cached_user(user_id).language
 
 
-def save_user(user: Any) -> None:
+def _save_user(cursor: sqlite3.Cursor, after_commit: AfterCommit,
+               user: Any) -> None:
     """
-    Сохранение информации о пользователе в базу данных.
-    Saving user information to the database.
+    Операция записи для save_user().
+    Write operation for save_user().
     """
     if not isinstance(user.id, int) or user.id <= 0:
         raise ValueError('Invalid user ID')
 
-    with db_connection() as conn:
-        cursor = conn.cursor()
+    cursor.execute('''
+    INSERT OR IGNORE INTO users (user_id, username, first_name, last_name,
+                               language)
+    VALUES (?, ?, ?, ?, ?)
+    ''', (user.id, user.username, user.first_name, user.last_name, 'ru'))
+
+    if cursor.rowcount > 0:
+        after_commit.append(partial(_user_cache.put, user.id, CachedUser(
+            'ru', user.username, user.first_name, user.last_name)))
+    else:
+        # Написавший боту пользователь снова доступен для рассылок / A user
+        # who wrote to the bot is reachable by broadcasts again
         cursor.execute('''
-        INSERT OR IGNORE INTO users (user_id, username, first_name, last_name,
-                                   language)
-        VALUES (?, ?, ?, ?, ?)
-        ''', (user.id, user.username, user.first_name, user.last_name, 'ru'))
-        conn.commit()
+        UPDATE users SET is_blocked = FALSE
+        WHERE user_id = ? AND is_blocked = TRUE
+        ''', (user.id,))
+
+
+def save_user(user: Any) -> None:
+    """
+    Сохранение информации о пользователе в базу данных.
+    Saving user information to the database.
+    """
+    run_write(_save_user, user)
+
+
+def _update_user_language(cursor: sqlite3.Cursor, after_commit: AfterCommit,
+                          user_id: int, language: str) -> None:
+    """
+    Операция записи для update_user_language().
+    Write operation for update_user_language().
+    """
+    if not isinstance(user_id, int) or user_id <= 0:
+        return
+
+    cursor.execute('''
+    UPDATE users SET language = ? WHERE user_id = ?
+    ''', (language, user_id))
+
+    if cursor.rowcount > 0:
+        after_commit.append(partial(_user_cache.update, user_id,
+                                    language=language))
 
 
 def update_user_language(user_id: int, language: str) -> None:
@@ -128,81 +446,186 @@ def update_user_language(user_id: int, language: str) -> None:
     Обновление языка пользователя в базе данных.
     Updating user language in the database.
     """
-    if not isinstance(user_id, int) or user_id <= 0:
-        return
+    run_write(_update_user_language, user_id, language)
 
-    with db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-        UPDATE users SET language = ? WHERE user_id = ?
-        ''', (language, user_id))
-        conn.commit()
+
+def user_may_have_active_message(user_id: int) -> bool:
+    """
+    Быстрая проверка по множеству в памяти без обращения к базе: False
+    точен, True нужно подтвердить через user_has_active_message().
+    A quick check against the in-memory set without database access: False
+    is exact, True must be confirmed with user_has_active_message().
+    """
+    if not isinstance(user_id, int) or user_id <= 0:
+        return False
+    if not _active_users.loaded:
+        raise RuntimeError('load_active_users() must be called on startup')
+    return user_id in _active_users
 
 
+@timed(DB_QUERY_SECONDS)
 def user_has_active_message(user_id: int) -> bool:
     """
-    Проверка наличия активного сообщения у пользователя.
-    Check if the user has an active message.
+    Проверка наличия активного сообщения у пользователя. База читается,
+    только если пользователь есть в множестве в памяти: флаг мог снять
+    другой процесс.
+    Check if the user has an active message. The database is read only if
+    the user is in the in-memory set: another process may have cleared the
+    flag.
     """
-    if not isinstance(user_id, int) or user_id <= 0:
+    if not user_may_have_active_message(user_id):
         return False
 
+    version = _active_users.version
     with db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('''
         SELECT has_active_message FROM users WHERE user_id = ?
         ''', (user_id,))
         result = cursor.fetchone()
-        return result[0] if result else False
 
+    active = bool(result and result[0])
+    if not active:
+        _active_users.discard_if_unchanged(user_id, version)
+    return active
 
-def set_user_active_message(user_id: int, has_active: bool) -> None:
+
+def _apply_active_users(user_ids: List[int]) -> None:
     """
-    Установка флага активного сообщения для пользователя.
-    Sets the active message flag for the user.
+    Заменяет множество активных пользователей снимком из базы и сообщает о
+    расхождении, если множество уже было загружено.
+    Replaces the active user set with a snapshot from the database and
+    reports the drift if the set was already loaded.
+    """
+    loaded = _active_users.loaded
+    missing, extra = _active_users.reconcile(user_ids)
+    if not loaded:
+        logger.info('Loaded %d users with an active message', len(user_ids))
+    elif missing or extra:
+        logger.warning('Active user set drifted from the database: '
+                       '%d missing, %d extra; corrected', len(missing),
+                       len(extra))
+
+
+def _reconcile_active_users(cursor: sqlite3.Cursor,
+                            after_commit: AfterCommit) -> None:
+    """
+    Операция записи для load_active_users(). Выполняется как запись, чтобы
+    снимок и обработчики после фиксации других операций шли по порядку:
+    изменения, попавшие в снимок, уже применены к множеству, а более
+    поздние применятся после него.
+    Write operation for load_active_users(). It runs as a write so the
+    snapshot and the after-commit hooks of other operations stay ordered:
+    changes in the snapshot are already applied to the set, and later ones
+    are applied after it.
+    """
+    cursor.execute('''
+    SELECT user_id FROM users WHERE has_active_message = TRUE
+    ''')
+    user_ids = [row[0] for row in cursor.fetchall()]
+    after_commit.append(partial(_apply_active_users, user_ids))
+
+
+def load_active_users() -> None:
+    """
+    Загрузка (или сверка с базой) множества пользователей с активным
+    сообщением.
+    Loading (or reconciling with the database) the set of users with an
+    active message.
+    """
+    run_write(_reconcile_active_users)
+
+
+def _set_user_active_message(cursor: sqlite3.Cursor,
+                             after_commit: AfterCommit, user_id: int,
+                             has_active: bool) -> None:
+    """
+    Операция записи для set_user_active_message().
+    Write operation for set_user_active_message().
     """
     if not isinstance(user_id, int) or user_id <= 0:
         return
 
-    with db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-        UPDATE users SET has_active_message = ? WHERE user_id = ?
-        ''', (has_active, user_id))
-        conn.commit()
+    cursor.execute('''
+    UPDATE users SET has_active_message = ? WHERE user_id = ?
+    ''', (has_active, user_id))
 
+    if cursor.rowcount > 0:
+        after_commit.append(partial(_active_users.set, user_id,
+                                    bool(has_active)))
 
-def save_message(user_id: int, message_type: str, message_text: str) -> int:
+
+def set_user_active_message(user_id: int, has_active: bool) -> None:
     """
-    Сохранение сообщения от пользователя в базе данных.
-    Saving a message from a user to the database.
+    Установка флага активного сообщения для пользователя.
+    Sets the active message flag for the user.
     """
-    if not all([isinstance(user_id, int), isinstance(message_type, str),
+    run_write(_set_user_active_message, user_id, has_active)
+
+
+def _submit_message(cursor: sqlite3.Cursor, after_commit: AfterCommit,
+                    user: Any, message_type: str,
+                    message_text: str) -> Optional[int]:
+    """
+    Операция записи для submit_message(): флаг активного сообщения
+    проверяется и устанавливается одним условным UPDATE в той же
+    транзакции, что и вставка, поэтому из параллельных отправок одного
+    пользователя сохраняется ровно одна.
+    Write operation for submit_message(): the active message flag is
+    checked and set by one conditional UPDATE in the same transaction as
+    the insert, so exactly one of concurrent submissions from a user is
+    saved.
+    """
+    if not all([isinstance(message_type, str),
                isinstance(message_text, str)]):
         raise ValueError('Invalid input data')
 
     if len(message_text) > MAX_MESSAGE_LENGTH:
         raise ValueError('Message too long')
 
-    with db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-        INSERT INTO messages (user_id, message_type, message_text)
-        VALUES (?, ?, ?)
-        ''', (user_id, message_type, message_text))
-        message_id = cursor.lastrowid
+    # Строка пользователя нужна для условного UPDATE / The user's row is
+    # needed for the conditional UPDATE
+    _save_user(cursor, after_commit, user)
 
-        cursor.execute('''
-        UPDATE users SET has_active_message = TRUE WHERE user_id = ?
-        ''', (user_id,))
-        conn.commit()
-        return message_id
+    cursor.execute('''
+    UPDATE users SET has_active_message = TRUE
+    WHERE user_id = ? AND has_active_message = FALSE
+    ''', (user.id,))
+    if cursor.rowcount == 0:
+        return None
 
+    cursor.execute('''
+    INSERT INTO messages (user_id, message_type, message_text)
+    VALUES (?, ?, ?)
+    ''', (user.id, message_type, message_text))
 
-def save_reply(message_id: int, reply_text: str) -> None:
+    # Сводная статистика / Statistics rollup
+    cursor.execute('''
+    INSERT INTO stats_daily (day, message_type, messages)
+    VALUES (date('now'), ?, 1)
+    ON CONFLICT (day, message_type) DO UPDATE SET messages = messages + 1
+    ''', (message_type,))
+
+    after_commit.append(partial(_active_users.set, user.id, True))
+    return cursor.lastrowid
+
+
+def submit_message(user: Any, message_type: str,
+                   message_text: str) -> Optional[int]:
     """
-    Сохранение в базе данных ответа администратора на сообщение пользователя.
-    Saving the administrator's response to the user's message in the database.
+    Сохранение сообщения от пользователя, если у него нет активного.
+    Возвращает ID сообщения или None, если активное сообщение уже есть.
+    Saving a message from a user unless they already have an active one.
+    Returns the message ID, or None if there is an active message already.
+    """
+    return run_write(_submit_message, user, message_type, message_text)
+
+
+def _save_reply(cursor: sqlite3.Cursor, after_commit: AfterCommit,
+                message_id: int, reply_text: str) -> None:
+    """
+    Операция записи для save_reply().
+    Write operation for save_reply().
     """
     if not isinstance(message_id, int) or message_id <= 0 or not isinstance(
             reply_text, str):
@@ -211,79 +634,867 @@ def save_reply(message_id: int, reply_text: str) -> None:
     if len(reply_text) > MAX_MESSAGE_LENGTH:
         raise ValueError('Reply too long')
 
+    cursor.execute('''
+    INSERT INTO replies (message_id, reply_text)
+    VALUES (?, ?)
+    ''', (message_id, reply_text))
+
+    cursor.execute('''
+    UPDATE messages SET is_answered = TRUE
+    WHERE id = ? AND is_answered = FALSE
+    ''', (message_id,))
+
+    # Первый ответ попадает в сводную статистику / The first reply goes
+    # into the statistics rollup
+    if cursor.rowcount > 0:
+        cursor.execute('''
+        INSERT INTO stats_daily (day, message_type, answered)
+        SELECT date('now'), message_type, 1 FROM messages WHERE id = ?
+        ON CONFLICT (day, message_type) DO UPDATE SET answered = answered + 1
+        ''', (message_id,))
+        cursor.execute(f'''
+        INSERT INTO stats_response_times (day, bucket, count)
+        SELECT date('now'), {response_time_bucket("'now'", 'created_at')}, 1
+        FROM messages WHERE id = ?
+        ON CONFLICT (day, bucket) DO UPDATE SET count = count + 1
+        ''', (message_id,))
+
+    cursor.execute('''
+    SELECT user_id FROM messages WHERE id = ?
+    ''', (message_id,))
+    result = cursor.fetchone()
+    user_id = result[0] if result else None
+
+    cursor.execute('''
+    UPDATE users SET has_active_message = FALSE WHERE user_id = ?
+    ''', (user_id,))
+
+    if cursor.rowcount > 0:
+        after_commit.append(partial(_active_users.set, user_id, False))
+
+
+def save_reply(message_id: int, reply_text: str) -> None:
+    """
+    Сохранение в базе данных ответа администратора на сообщение пользователя.
+    Saving the administrator's response to the user's message in the database.
+    """
+    run_write(_save_reply, message_id, reply_text)
+
+
+@timed(DB_QUERY_SECONDS)
+def get_stats(days: int) -> Stats:
+    """
+    Статистика за последние days дней (UTC) из сводных таблиц: число строк
+    зависит только от числа дней, а не от размера истории.
+    Statistics for the last days days (UTC) from the rollup tables: the
+    number of rows read depends only on the number of days, not on the
+    history size.
+    """
+    since = f'-{days - 1} days'
     with db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-        INSERT INTO replies (message_id, reply_text)
-        VALUES (?, ?)
-        ''', (message_id, reply_text))
+        SELECT day, message_type, messages, answered FROM stats_daily
+        WHERE day >= date('now', ?)
+        ORDER BY day, message_type
+        ''', (since,))
+        daily = cursor.fetchall()
 
         cursor.execute('''
-        UPDATE messages SET is_answered = TRUE WHERE id = ?
-        ''', (message_id,))
+        SELECT bucket, SUM(count) FROM stats_response_times
+        WHERE day >= date('now', ?)
+        GROUP BY bucket
+        ''', (since,))
+        histogram = dict(cursor.fetchall())
 
         cursor.execute('''
-        UPDATE users SET has_active_message = FALSE
-        WHERE user_id = (SELECT user_id FROM messages WHERE id = ?)
+        SELECT COUNT(*) FROM messages WHERE is_answered = FALSE
+        ''')
+        unanswered = cursor.fetchone()[0]
+    return daily, histogram, unanswered
+
+
+@timed(DB_QUERY_SECONDS)
+def get_message_details(message_id: int) -> Optional[Tuple[Any, ...]]:
+    """
+    Получение сообщения вместе с данными отправителя.
+    Getting a message together with the sender's data.
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+        SELECT m.message_type, m.message_text, m.created_at,
+               u.username, u.first_name
+        FROM {ALL_MESSAGES} m
+        JOIN users u ON m.user_id = u.user_id
+        WHERE m.id = ?
         ''', (message_id,))
-        conn.commit()
+        return cursor.fetchone()
+
+
+@timed(DB_QUERY_SECONDS)
+def get_message_user_id(message_id: int) -> Optional[int]:
+    """
+    Получение ID отправителя сообщения.
+    Getting the ID of the message sender.
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'''
+        SELECT user_id FROM {ALL_MESSAGES} WHERE id = ?
+        ''', (message_id,))
+        result = cursor.fetchone()
+        return result[0] if result else None
 
 
-def get_unanswered_messages() -> List[Tuple[Any, ...]]:
+@timed(DB_QUERY_SECONDS)
+def get_last_unanswered_message_id(user_id: int) -> Optional[int]:
     """
-    Получение списка неотвеченных сообщений.
-    Getting a list of unanswered messages.
+    Получение ID последнего неотвеченного сообщения пользователя.
+    Getting the ID of the user's latest unanswered message.
     """
     with db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('''
+        SELECT id FROM messages
+        WHERE user_id = ? AND is_answered = FALSE
+        ORDER BY created_at DESC LIMIT 1
+        ''', (user_id,))
+        result = cursor.fetchone()
+        return result[0] if result else None
+
+
+@timed(DB_QUERY_SECONDS)
+def get_users_page(cursor_user_id: Optional[int] = None,
+                   backward: bool = False,
+                   limit: int = HISTORY_PAGE_SIZE) -> Page:
+    """
+    Получение страницы пользователей, отправивших сообщения, начиная после
+    (или, при backward, перед) пользователя-курсора.
+    Getting a page of users who have sent messages, starting after (or, with
+    backward, before) the cursor user.
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        params: Tuple[Any, ...] = ()
+        condition = ''
+
+        if cursor_user_id is not None:
+            cursor.execute('''
+            SELECT COALESCE(first_name, ''), user_id FROM users
+            WHERE user_id = ?
+            ''', (cursor_user_id,))
+            key = cursor.fetchone()
+            if key is None:
+                return [], False, False
+
+            # Условие по первому столбцу позволяет искать по индексу
+            # диапазоном / The condition on the first column lets the index
+            # be searched by range
+            op = '<' if backward else '>'
+            condition = f'''
+            AND COALESCE(u.first_name, '') {op}= ?
+            AND (COALESCE(u.first_name, ''), u.user_id) {op} (?, ?)'''
+            params = (key[0], key[0], key[1])
+
+        order = 'DESC' if backward else 'ASC'
+        cursor.execute(f'''
+        SELECT u.user_id, u.username, u.first_name, u.last_name, u.language
+        FROM users u
+        WHERE (EXISTS (SELECT 1 FROM main.messages m
+                       WHERE m.user_id = u.user_id)
+               OR EXISTS (SELECT 1 FROM archive.messages m
+                          WHERE m.user_id = u.user_id))
+        {condition}
+        ORDER BY COALESCE(u.first_name, '') {order}, u.user_id {order}
+        LIMIT ?
+        ''', params + (limit + 1,))
+        rows = cursor.fetchall()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+        return rows, has_more, True
+    return rows, cursor_user_id is not None, has_more
+
+
+@timed(DB_QUERY_SECONDS)
+def get_user_messages_page(user_id: int,
+                           cursor_message_id: Optional[int] = None,
+                           backward: bool = False,
+                           limit: int = HISTORY_PAGE_SIZE) -> Page:
+    """
+    Получение страницы истории сообщений пользователя, начиная после (или,
+    при backward, перед) сообщения-курсора. Последний столбец - ID сообщения.
+    Getting a page of the user's message history, starting after (or, with
+    backward, before) the cursor message. The last column is the message ID.
+    """
+    if not isinstance(user_id, int) or user_id <= 0:
+        return [], False, False
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        params: Tuple[Any, ...] = (user_id,)
+        condition = ''
+
+        if cursor_message_id is not None:
+            cursor.execute(f'''
+            SELECT created_at, id FROM {ALL_MESSAGES} WHERE id = ?
+            ''', (cursor_message_id,))
+            key = cursor.fetchone()
+            if key is None:
+                return [], False, False
+
+            op = '<' if backward else '>'
+            condition = f'''
+            AND created_at {op}= ? AND (created_at, id) {op} (?, ?)'''
+            params += (key[0], key[0], key[1])
+
+        # Сначала выбирается страница сообщений, затем к ней присоединяются
+        # ответы / The page of messages is selected first, then replies are
+        # joined to it
+        order = 'DESC' if backward else 'ASC'
+        cursor.execute(_with_replies(f'''
+        SELECT id, message_type, message_text, created_at
+        FROM {ALL_MESSAGES}
+        WHERE user_id = ? {condition}
+        ORDER BY created_at {order}, id {order}
+        LIMIT ?
+        '''), params + (limit + 1,))
+        rows = cursor.fetchall()
+
+    # Лишнее (limit + 1)-е сообщение только показывает, есть ли ещё страница
+    # / The extra (limit + 1)-th message only shows whether there is another
+    # page
+    message_ids = list(dict.fromkeys(row[5] for row in rows))
+    has_more = len(message_ids) > limit
+    if has_more:
+        extra_id = message_ids[0] if backward else message_ids[-1]
+        rows = [row for row in rows if row[5] != extra_id]
+
+    if backward:
+        return rows, has_more, True
+    return rows, cursor_message_id is not None, has_more
+
+
+@timed(DB_QUERY_SECONDS)
+def get_unanswered_inbox(cursor_message_id: Optional[int] = None,
+                         backward: bool = False,
+                         limit: int = UNANSWERED_PAGE_SIZE
+                         ) -> Tuple[Page, int]:
+    """
+    Получение страницы неотвеченных сообщений (после или, при backward, перед
+    сообщением-курсором) и их общего количества.
+    Getting a page of unanswered messages (after or, with backward, before
+    the cursor message) and their total count.
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        params: Tuple[Any, ...] = ()
+        condition = ''
+
+        if cursor_message_id is not None:
+            cursor.execute('''
+            SELECT created_at, id FROM messages WHERE id = ?
+            ''', (cursor_message_id,))
+            key = cursor.fetchone()
+            if key is not None:
+                op = '<' if backward else '>'
+                condition = f'''
+                AND m.created_at {op}= ?
+                AND (m.created_at, m.id) {op} (?, ?)'''
+                params = (key[0], key[0], key[1])
+            else:
+                cursor_message_id = None
+                backward = False
+
+        # Оба запроса обслуживаются частичным индексом idx_messages_unanswered
+        # / Both queries are served by the partial index
+        # idx_messages_unanswered
+        order = 'DESC' if backward else 'ASC'
+        cursor.execute(f'''
         SELECT m.id, u.user_id, u.username, u.first_name, m.message_type,
                m.message_text, m.created_at
         FROM messages m
         JOIN users u ON m.user_id = u.user_id
-        WHERE m.is_answered = FALSE
-        ORDER BY m.created_at
+        WHERE m.is_answered = FALSE {condition}
+        ORDER BY m.created_at {order}, m.id {order}
+        LIMIT ?
+        ''', params + (limit + 1,))
+        rows = cursor.fetchall()
+
+        cursor.execute('''
+        SELECT COUNT(*) FROM messages WHERE is_answered = FALSE
         ''')
-        return cursor.fetchall()
+        total = cursor.fetchone()[0]
 
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+        return (rows, has_more, True), total
+    return (rows, cursor_message_id is not None, has_more), total
 
-def get_user_messages(user_id: int) -> List[Tuple[Any, ...]]:
+
+@timed(DB_QUERY_SECONDS)
+def load_persistent_data(kind: str) -> Dict[int, Tuple[str, int]]:
     """
-    Получение истории сообщений пользователя.
-    Get user's message history.
+    Загрузка всего сохранённого состояния вида kind: {ключ: (JSON, версия)}.
+    Loading all stored state of the given kind: {key: (JSON, version)}.
     """
-    if not isinstance(user_id, int) or user_id <= 0:
-        return []
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT key, data, version FROM persistence WHERE kind = ?
+        ''', (kind,))
+        return {key: (data, version) for key, data, version in cursor}
+
 
+@timed(DB_QUERY_SECONDS)
+def get_newer_persistent_data(kind: str, key: int,
+                              version: int) -> Optional[Tuple[str, int]]:
+    """
+    Получение состояния по ключу, только если оно новее указанной версии.
+    Getting the state for a key only if it is newer than the given version.
+    """
     with db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-        SELECT m.message_type, m.message_text, m.created_at, r.reply_text,
-                r.created_at
-        FROM messages m
-        LEFT JOIN replies r ON m.id = r.message_id
-        WHERE m.user_id = ?
-        ORDER BY m.created_at
+        SELECT data, version FROM persistence
+        WHERE kind = ? AND key = ? AND version > ?
+        ''', (kind, key, version))
+        return cursor.fetchone()
+
+
+def _save_persistent_data(cursor: sqlite3.Cursor, after_commit: AfterCommit,
+                          kind: str, key: int, data: str,
+                          version: Optional[int]) -> Optional[int]:
+    """
+    Операция записи состояния по ключу, только если сохранённая версия всё
+    ещё равна version (None - строки ещё нет). Возвращает новую версию или
+    None, если другой процесс успел записать своё состояние.
+    Write operation storing the state for a key only if the stored version
+    still equals version (None - there is no row yet). Returns the new
+    version, or None if another process stored its state first.
+    """
+    if version is None:
+        cursor.execute('''
+        INSERT INTO persistence (kind, key, data) VALUES (?, ?, ?)
+        ON CONFLICT (kind, key) DO NOTHING
+        RETURNING version
+        ''', (kind, key, data))
+    else:
+        cursor.execute('''
+        UPDATE persistence SET data = ?, version = version + 1
+        WHERE kind = ? AND key = ? AND version = ?
+        RETURNING version
+        ''', (data, kind, key, version))
+    row = cursor.fetchone()
+    return row[0] if row is not None else None
+
+
+def _delete_persistent_data(cursor: sqlite3.Cursor, after_commit: AfterCommit,
+                            kind: str, key: int, version: int) -> bool:
+    """
+    Операция удаления состояния по ключу, только если сохранённая версия
+    всё ещё равна version. Возвращает, была ли строка удалена.
+    Write operation deleting the state for a key only if the stored version
+    still equals version. Returns whether the row was deleted.
+    """
+    cursor.execute('''
+    DELETE FROM persistence WHERE kind = ? AND key = ? AND version = ?
+    ''', (kind, key, version))
+    return cursor.rowcount > 0
+
+
+def _fts_query(text: str) -> Optional[str]:
+    """
+    Превращает ввод администратора в безопасный запрос FTS5: каждое слово
+    берётся в кавычки, '*' в конце слова означает поиск по префиксу.
+    Turns the administrator's input into a safe FTS5 query: every word is
+    quoted, a trailing '*' means a prefix search.
+    """
+    terms = []
+    for word in re.findall(r'\w+\*?', text):
+        prefix = word.endswith('*')
+        terms.append(f'"{word.rstrip("*")}"' + ('*' if prefix else ''))
+    return ' '.join(terms) or None
+
+
+# Граница ключа для первой страницы поиска и число совпадений в ответах,
+# читаемых за один запрос / The key bound for the first search page and the
+# number of reply matches read per query
+_MAX_ROWID = 2 ** 63 - 1
+_SEARCH_REPLY_BATCH = 200
+
+# Условия фильтров поиска по сообщению m / Search filter conditions on the
+# message m
+_SEARCH_FILTERS = '''
+    (:type IS NULL OR m.message_type = :type)
+    AND (:date_from IS NULL OR m.created_at >= :date_from)
+    AND (:date_to IS NULL OR m.created_at < :date_to)'''
+
+
+def _first_id_since(cursor: sqlite3.Cursor, table: str,
+                    created_at: str) -> Optional[int]:
+    """
+    Находит двоичным поиском по первичному ключу наименьший ID строки,
+    созданной не раньше created_at: ID растут вместе со временем создания.
+    Finds by binary search over the primary key the smallest ID of a row
+    created no earlier than created_at: IDs grow with the creation time.
+    """
+    cursor.execute(f'''
+    SELECT (SELECT MIN(id) FROM {table}), (SELECT MAX(id) FROM {table})
+    ''')
+    low, high = cursor.fetchone()
+    found = None
+    while low is not None and low <= high:
+        cursor.execute(f'''
+        SELECT id, created_at FROM {table} WHERE id >= ? ORDER BY id LIMIT 1
+        ''', ((low + high) // 2,))
+        row_id, row_created_at = cursor.fetchone()
+        if (row_created_at or '') >= created_at:
+            found, high = row_id, (low + high) // 2 - 1
+        else:
+            low = row_id + 1
+    return found
+
+
+def _search_id_bound(cursor: sqlite3.Cursor, created_at: str) -> int:
+    """
+    Наименьший ID сообщения обоих уровней, созданного не раньше created_at.
+    The smallest ID of a message in both tiers created no earlier than
+    created_at.
+    """
+    ids = [_first_id_since(cursor, f'{tier}.messages', created_at)
+           for tier in ('main', 'archive')]
+    return min((i for i in ids if i is not None), default=_MAX_ROWID)
+
+
+@timed(DB_QUERY_SECONDS)
+def search_messages(text: str, message_type: Optional[str] = None,
+                    date_from: Optional[str] = None,
+                    date_to: Optional[str] = None,
+                    before: Optional[int] = None,
+                    limit: int = SEARCH_PAGE_SIZE
+                    ) -> Tuple[List[Tuple[Any, ...]], bool]:
+    """
+    Полнотекстовый поиск по сообщениям и ответам на них в обоих уровнях
+    хранения, от новых сообщений к старым, начиная перед сообщением before.
+    Совпадение в ответе находит исходное сообщение. Возвращает строки (ID,
+    ID пользователя, username, имя, тип, текст, дата) и признак следующей
+    страницы. date_to не включается.
+    Full-text search over messages and their replies in both storage tiers,
+    from newer messages to older ones, starting before the message before.
+    A match in a reply finds the original message. Returns rows (ID, user
+    ID, username, first name, type, text, date) and whether there is a next
+    page. date_to is exclusive.
+    """
+    match = _fts_query(text)
+    if match is None:
+        return [], False
+
+    params = {'match': match, 'type': message_type, 'date_from': date_from,
+              'date_to': date_to, 'limit': limit + 1,
+              'before': _MAX_ROWID if before is None else before, 'after': 0}
+    # Найденные сообщения по ID; копия в архиве схлопывается с оригиналом /
+    # Found messages by ID; a copy in the archive collapses with the original
+    found: Dict[int, Tuple[Any, ...]] = {}
+
+    def bound() -> Optional[Tuple[Any, ...]]:
+        # Последнее сообщение, которое ещё может попасть в выдачу / The last
+        # message that can still make it into the results
+        if len(found) <= limit:
+            return None
+        return found[heapq.nlargest(limit + 1, found)[-1]]
+
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        # Период сужает диапазон ID, который просматривают индексы / The
+        # period narrows the ID range the indexes scan
+        if date_to is not None:
+            params['before'] = min(params['before'],
+                                   _search_id_bound(cursor, date_to))
+        if date_from is not None:
+            params['after'] = _search_id_bound(cursor, date_from)
+
+        # Индекс FTS5 отдаёт совпадения по убыванию rowid, то есть ID
+        # сообщения, поэтому запрос останавливается после limit + 1 строк /
+        # The FTS5 index yields matches by descending rowid, that is the
+        # message ID, so the query stops after limit + 1 rows
+        for tier in ('main', 'archive'):
+            cursor.execute(f'''
+            SELECT m.id, m.user_id, m.message_type, m.message_text,
+                   m.created_at
+            FROM {tier}.messages_fts f
+            JOIN {tier}.messages m ON m.id = f.rowid
+            WHERE f.messages_fts MATCH :match
+              AND f.rowid < :before AND f.rowid >= :after
+              AND {_SEARCH_FILTERS}
+            ORDER BY f.rowid DESC
+            LIMIT :limit
+            ''', params)
+            found.update((row[0], row) for row in cursor.fetchall())
+
+        # Ответ не старше своего сообщения, а ID растут со временем, поэтому
+        # ответы читаются от новых, пока они не старше последнего
+        # подходящего сообщения / A reply is not older than its message and
+        # IDs grow with time, so replies are read from newer ones while they
+        # are not older than the last eligible message
+        for tier in ('main', 'archive'):
+            last_reply = _MAX_ROWID
+            while True:
+                cursor.execute(f'''
+                SELECT r.id, r.message_id, r.created_at
+                FROM {tier}.replies_fts f
+                JOIN {tier}.replies r ON r.id = f.rowid
+                WHERE f.replies_fts MATCH :match AND f.rowid < :last_reply
+                  AND r.message_id < :before AND r.message_id >= :after
+                ORDER BY f.rowid DESC
+                LIMIT :batch
+                ''', dict(params, last_reply=last_reply,
+                          batch=_SEARCH_REPLY_BATCH))
+                replies = cursor.fetchall()
+                last = bound()
+                message_ids = {
+                    message_id for _, message_id, _ in replies
+                    if message_id not in found
+                    and (last is None or message_id > last[0])
+                }
+                if message_ids:
+                    for messages in ('main.messages', 'archive.messages'):
+                        cursor.execute(f'''
+                        SELECT m.id, m.user_id, m.message_type,
+                               m.message_text, m.created_at
+                        FROM {messages} m
+                        WHERE m.id IN (SELECT value FROM json_each(:ids))
+                          AND {_SEARCH_FILTERS}
+                        ''', dict(params, ids=json.dumps(list(message_ids))))
+                        found.update((row[0], row)
+                                     for row in cursor.fetchall())
+                    last = bound()
+
+                oldest = replies[-1][2] if replies else None
+                if (len(replies) < _SEARCH_REPLY_BATCH
+                        or (last is not None and oldest < last[4])
+                        or (date_from is not None and oldest < date_from)):
+                    break
+                last_reply = replies[-1][0]
+
+        page = [found[message_id]
+                for message_id in heapq.nlargest(limit + 1, found)]
+        cursor.execute('''
+        SELECT user_id, username, first_name FROM users
+        WHERE user_id IN (SELECT value FROM json_each(?))
+        ''', (json.dumps(list({row[1] for row in page})),))
+        users = {row[0]: row[1:] for row in cursor.fetchall()}
+
+    rows = [(row[0], row[1]) + users.get(row[1], (None, None)) + row[2:]
+            for row in page[:limit]]
+    return rows, len(page) > limit
+
+
+def iter_export_rows(conn: sqlite3.Connection,
+                     message_type: Optional[str] = None,
+                     date_from: Optional[str] = None,
+                     date_to: Optional[str] = None,
+                     fetch_size: int = 1000) -> Iterator[Tuple[Any, ...]]:
+    """
+    Построчно выдаёт сообщения обоих уровней хранения по возрастанию ID:
+    (ID, дата, ID пользователя, username, имя, фамилия, тип, текст,
+    отвечено, ответы в JSON). Строки читаются порциями из одного снимка
+    базы, без сортировки и без загрузки всей выборки в память. date_to не
+    включается.
+    Yields messages of both storage tiers by ascending ID: (ID, date, user
+    ID, username, first name, last name, type, text, answered, replies as
+    JSON). Rows are read in chunks from one database snapshot, without
+    sorting and without loading the whole result into memory. date_to is
+    exclusive.
+    """
+    params = {'type': message_type, 'date_from': date_from,
+              'date_to': date_to}
+    cursor = conn.cursor()
+    cursor.arraysize = fetch_size
+    cursor.execute('BEGIN')
+    try:
+        # Архив содержит более старые ID, поэтому идёт первым; ответы
+        # собираются по индексу из обоих уровней / The archive holds older
+        # IDs, so it goes first; replies are gathered by index from both
+        # tiers
+        for tier, skip_copied in (
+                ('archive', 'AND NOT EXISTS (SELECT 1 FROM main.messages h '
+                            'WHERE h.id = m.id)'),
+                ('main', '')):
+            cursor.execute(f'''
+            SELECT m.id, m.created_at, m.user_id, u.username, u.first_name,
+                   u.last_name, m.message_type, m.message_text,
+                   m.is_answered,
+                   (SELECT json_group_array(json_array(r.id, r.reply_text,
+                                                       r.created_at))
+                    FROM (SELECT id, reply_text, created_at
+                          FROM main.replies WHERE message_id = m.id
+                          UNION ALL
+                          SELECT id, reply_text, created_at
+                          FROM archive.replies a WHERE message_id = m.id
+                            AND NOT EXISTS (SELECT 1 FROM main.replies h
+                                            WHERE h.id = a.id)
+                          ORDER BY id) r)
+            FROM {tier}.messages m
+            LEFT JOIN users u ON u.user_id = m.user_id
+            WHERE (:type IS NULL OR m.message_type = :type)
+              AND (:date_from IS NULL OR m.created_at >= :date_from)
+              AND (:date_to IS NULL OR m.created_at < :date_to)
+              {skip_copied}
+            ORDER BY m.id
+            ''', params)
+            while True:
+                rows = cursor.fetchmany()
+                if not rows:
+                    break
+                yield from rows
+    finally:
+        conn.rollback()
+
+
+def _backfill_search_index(cursor: sqlite3.Cursor, after_commit: AfterCommit,
+                           chunk: int) -> bool:
+    """
+    Операция записи: добавляет в поисковый индекс очередную порцию строк,
+    существовавших до его создания. Возвращает True, пока остались строки.
+    Write operation: adds the next chunk of rows that existed before the
+    search index was created. Returns True while rows remain.
+    """
+    remaining = False
+    for schema in ('main', 'archive'):
+        cursor.execute(f'''
+        SELECT source, next_id, end_id FROM {schema}.search_backfill
+        ''')
+        for source, next_id, end_id in cursor.fetchall():
+            column = SEARCH_SOURCES[source]
+            cursor.execute(f'''
+            SELECT id, {column} FROM {schema}.{source}
+            WHERE id BETWEEN ? AND ? ORDER BY id LIMIT ?
+            ''', (next_id, end_id, chunk))
+            rows = cursor.fetchall()
+            cursor.executemany(f'''
+            INSERT INTO {schema}.{source}_fts (rowid, {column}) VALUES (?, ?)
+            ''', rows)
+
+            if len(rows) < chunk:
+                cursor.execute(f'''
+                DELETE FROM {schema}.search_backfill WHERE source = ?
+                ''', (source,))
+                logger.info('Search index backfill of %s.%s finished',
+                            schema, source)
+            else:
+                cursor.execute(f'''
+                UPDATE {schema}.search_backfill SET next_id = ?
+                WHERE source = ?
+                ''', (rows[-1][0] + 1, source))
+                remaining = True
+    return remaining
+
+
+def _copy_to_archive(cursor: sqlite3.Cursor, after_commit: AfterCommit,
+                     age_days: int, chunk: int) -> List[int]:
+    """
+    Операция записи: копирует в архив порцию отвеченных сообщений старше
+    age_days дней вместе с ответами. Возвращает ID скопированных сообщений.
+    Write operation: copies a chunk of answered messages older than
+    age_days days to the archive together with their replies. Returns the
+    IDs of the copied messages.
+    """
+    cursor.execute('''
+    SELECT id FROM main.messages
+    WHERE is_answered = TRUE AND created_at < datetime('now', ?)
+    ORDER BY created_at LIMIT ?
+    ''', (f'-{age_days} days', chunk))
+    message_ids = [row[0] for row in cursor.fetchall()]
+    if not message_ids:
+        return []
+
+    placeholders = ','.join('?' * len(message_ids))
+    cursor.execute(f'''
+    INSERT OR IGNORE INTO archive.messages
+    SELECT id, user_id, message_type, message_text, created_at, is_answered
+    FROM main.messages WHERE id IN ({placeholders})
+    ''', message_ids)
+    cursor.execute(f'''
+    INSERT OR IGNORE INTO archive.replies
+    SELECT id, message_id, reply_text, created_at
+    FROM main.replies WHERE message_id IN ({placeholders})
+    ''', message_ids)
+    return message_ids
+
+
+def _delete_archived(cursor: sqlite3.Cursor, after_commit: AfterCommit,
+                     message_ids: List[int]) -> int:
+    """
+    Операция записи: удаляет из оперативной базы сообщения и ответы, уже
+    находящиеся в архиве. Возвращает число удалённых сообщений.
+    Write operation: deletes messages and replies that are already in the
+    archive from the hot tier. Returns the number of deleted messages.
+    """
+    placeholders = ','.join('?' * len(message_ids))
+    cursor.execute(f'''
+    DELETE FROM main.replies
+    WHERE id IN (SELECT id FROM archive.replies
+                 WHERE message_id IN ({placeholders}))
+    ''', message_ids)
+    cursor.execute(f'''
+    DELETE FROM main.messages
+    WHERE id IN (SELECT id FROM archive.messages WHERE id IN ({placeholders}))
+    ''', message_ids)
+    return cursor.rowcount
+
+
+def _incremental_vacuum(cursor: sqlite3.Cursor, after_commit: AfterCommit,
+                        pages: int) -> int:
+    """
+    Операция записи: возвращает файловой системе до pages освободившихся
+    страниц каждого файла. Возвращает число оставшихся свободных страниц.
+    Write operation: returns up to pages freed pages of each file to the
+    file system. Returns the number of free pages left.
+    """
+    remaining = 0
+    for schema in ('main', 'archive'):
+        cursor.execute(f'PRAGMA {schema}.auto_vacuum')
+        if cursor.fetchone()[0] != 2:
+            continue
+        cursor.execute(f'PRAGMA {schema}.freelist_count')
+        free = cursor.fetchone()[0]
+
+        # Модуль sqlite3 выполняет прагму за один шаг, а каждый шаг
+        # освобождает одну страницу / The sqlite3 module runs the pragma for
+        # one step, and every step frees one page
+        for _ in range(min(free, pages)):
+            cursor.execute(f'PRAGMA {schema}.incremental_vacuum')
+        remaining += max(0, free - pages)
+    return remaining
+
+
+def _create_broadcast(cursor: sqlite3.Cursor, after_commit: AfterCommit,
+                      text: str) -> Tuple[int, int]:
+    """
+    Операция записи: создаёт рассылку всем незаблокированным пользователям.
+    Возвращает ID рассылки и число получателей.
+    Write operation: creates a broadcast to all users that are not blocked.
+    Returns the broadcast ID and the number of recipients.
+    """
+    cursor.execute('INSERT INTO broadcasts (text) VALUES (?)', (text,))
+    broadcast_id = cursor.lastrowid
+    cursor.execute('''
+    INSERT INTO broadcast_recipients (broadcast_id, user_id)
+    SELECT ?, user_id FROM users WHERE is_blocked = FALSE
+    ''', (broadcast_id,))
+    return broadcast_id, cursor.rowcount
+
+
+def _set_broadcast_status(cursor: sqlite3.Cursor, after_commit: AfterCommit,
+                          broadcast_id: int, status: str) -> bool:
+    """
+    Операция записи: завершает идущую рассылку со статусом status.
+    Возвращает False, если рассылка уже не шла.
+    Write operation: finishes a running broadcast with the given status.
+    Returns False if the broadcast was no longer running.
+    """
+    cursor.execute('''
+    UPDATE broadcasts SET status = ?, finished_at = CURRENT_TIMESTAMP
+    WHERE id = ? AND status = 'running'
+    ''', (status, broadcast_id))
+    return cursor.rowcount > 0
+
+
+def _set_recipient_status(cursor: sqlite3.Cursor, after_commit: AfterCommit,
+                          broadcast_id: int, user_id: int, status: str,
+                          error: Optional[str] = None) -> None:
+    """
+    Операция записи: сохраняет результат доставки получателю. Пользователь,
+    заблокировавший бота, помечается и пропускается следующими рассылками.
+    Write operation: stores the delivery result for a recipient. A user who
+    blocked the bot is marked and skipped by later broadcasts.
+    """
+    cursor.execute('''
+    UPDATE broadcast_recipients SET status = ?, error = ?
+    WHERE broadcast_id = ? AND user_id = ?
+    ''', (status, error, broadcast_id, user_id))
+    if status == 'blocked':
+        cursor.execute('''
+        UPDATE users SET is_blocked = TRUE WHERE user_id = ?
         ''', (user_id,))
-        return cursor.fetchall()
 
 
-def get_all_users() -> List[Tuple[Any, ...]]:
+@timed(DB_QUERY_SECONDS)
+def get_broadcast(broadcast_id: int) -> Optional[Tuple[str, str]]:
     """
-    Получение списка всех пользователей, отправивших сообщения.
-    Get a list of all users who have sent messages.
+    Получение текста и статуса рассылки.
+    Getting the text and status of a broadcast.
     """
     with db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute('''
-        SELECT DISTINCT u.user_id, u.username, u.first_name, u.last_name,
-               u.language
-        FROM users u
-        JOIN messages m ON u.user_id = m.user_id
-        ORDER BY u.first_name
+        SELECT text, status FROM broadcasts WHERE id = ?
+        ''', (broadcast_id,))
+        return cursor.fetchone()
+
+
+@timed(DB_QUERY_SECONDS)
+def get_running_broadcasts() -> List[int]:
+    """
+    Получение ID незавершённых рассылок.
+    Getting the IDs of unfinished broadcasts.
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id
         ''')
-        return cursor.fetchall()
+        return [row[0] for row in cursor.fetchall()]
+
+
+@timed(DB_QUERY_SECONDS)
+def get_latest_broadcast_id() -> Optional[int]:
+    """
+    Получение ID последней рассылки.
+    Getting the ID of the latest broadcast.
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('SELECT MAX(id) FROM broadcasts')
+        return cursor.fetchone()[0]
+
+
+@timed(DB_QUERY_SECONDS)
+def get_pending_recipients(broadcast_id: int, after_user_id: int,
+                           limit: int) -> List[int]:
+    """
+    Получение следующей порции получателей, которым рассылка ещё не
+    доставлялась, по возрастанию ID после after_user_id.
+    Getting the next chunk of recipients the broadcast has not been
+    delivered to yet, by ascending ID after after_user_id.
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT user_id FROM broadcast_recipients
+        WHERE broadcast_id = ? AND user_id > ? AND status = 'pending'
+        ORDER BY user_id LIMIT ?
+        ''', (broadcast_id, after_user_id, limit))
+        return [row[0] for row in cursor.fetchall()]
+
 
+@timed(DB_QUERY_SECONDS)
+def get_broadcast_counts(broadcast_id: int) -> Dict[str, int]:
+    """
+    Получение числа получателей рассылки по статусам доставки.
+    Getting the number of broadcast recipients by delivery status.
+    """
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+        SELECT status, COUNT(*) FROM broadcast_recipients
+        WHERE broadcast_id = ? GROUP BY status
+        ''', (broadcast_id,))
+        return dict(cursor.fetchall())
 
-# Инициализация базы данных / Initializing the database
-init_db()
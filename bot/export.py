@@ -0,0 +1,196 @@
+import argparse
+import asyncio
+import csv
+import gzip
+import io
+import json
+import sys
+from datetime import date, timedelta
+from functools import partial
+from typing import Any, BinaryIO, Callable, Dict, Iterable, Iterator, Optional
+from config import logger, EXPORT_FETCH_SIZE
+import database
+
+
+# Поля сообщения и ответа в выгрузке / Message and reply fields in the export
+MESSAGE_FIELDS = ('message_id', 'created_at', 'user_id', 'username',
+                  'first_name', 'last_name', 'message_type', 'message_text',
+                  'is_answered')
+REPLY_FIELDS = ('reply_id', 'reply_text', 'replied_at')
+
+Record = Dict[str, Any]
+
+
+def iter_records(rows: Iterable[tuple]) -> Iterator[Record]:
+    """
+    Превращает строки выборки в записи: поля сообщения и список ответов.
+    Turns query rows into records: the message fields and a list of replies.
+    """
+    for row in rows:
+        record = dict(zip(MESSAGE_FIELDS, row))
+        record['is_answered'] = bool(record['is_answered'])
+        record['replies'] = [dict(zip(REPLY_FIELDS, reply))
+                             for reply in json.loads(row[-1])]
+        yield record
+
+
+def iter_jsonl(records: Iterable[Record]) -> Iterator[str]:
+    """
+    JSON Lines: по объекту на сообщение, ответы вложены списком.
+    JSON Lines: one object per message, replies nested as a list.
+    """
+    for record in records:
+        yield json.dumps(record, ensure_ascii=False) + '\n'
+
+
+def iter_csv(records: Iterable[Record]) -> Iterator[str]:
+    """
+    CSV: по строке на ответ (сообщение без ответов - одна строка с пустыми
+    полями ответа).
+    CSV: one row per reply (a message without replies is one row with empty
+    reply fields).
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def take() -> str:
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    writer.writerow(MESSAGE_FIELDS + REPLY_FIELDS)
+    yield take()
+    no_reply = dict.fromkeys(REPLY_FIELDS)
+    for record in records:
+        message = [record[field] for field in MESSAGE_FIELDS]
+        for reply in record['replies'] or [no_reply]:
+            writer.writerow(message + [reply[field] for field in REPLY_FIELDS])
+        yield take()
+
+
+FORMATS: Dict[str, Callable[[Iterable[Record]], Iterator[str]]] = {
+    'csv': iter_csv,
+    'jsonl': iter_jsonl
+}
+
+
+def export_filename(export_format: str, compress: bool) -> str:
+    """
+    Имя файла выгрузки с текущей датой.
+    Export file name with the current date.
+    """
+    suffix = '.gz' if compress else ''
+    return f'feedback_{date.today().isoformat()}.{export_format}{suffix}'
+
+
+def write_export(output: BinaryIO, export_format: str = 'csv',
+                 compress: bool = False, message_type: Optional[str] = None,
+                 date_from: Optional[str] = None,
+                 date_to: Optional[str] = None) -> int:
+    """
+    Потоково записывает историю в output через отдельное соединение только
+    для чтения: строки -> записи -> текст -> (gzip) -> файл. Память не
+    зависит от размера базы. Возвращает число выгруженных сообщений.
+    date_to не включается.
+    Streams the history to output over a dedicated read-only connection:
+    rows -> records -> text -> (gzip) -> file. Memory use does not depend
+    on the database size. Returns the number of exported messages. date_to
+    is exclusive.
+    """
+    count = 0
+
+    def counted(records: Iterable[Record]) -> Iterator[Record]:
+        nonlocal count
+        for record in records:
+            count += 1
+            yield record
+
+    conn = database.open_connection()
+    try:
+        conn.execute('PRAGMA query_only = ON')
+        rows = database.iter_export_rows(conn, message_type, date_from,
+                                         date_to, EXPORT_FETCH_SIZE)
+        stream = (gzip.GzipFile(fileobj=output, mode='wb') if compress
+                  else output)
+        text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+        text.writelines(FORMATS[export_format](counted(iter_records(rows))))
+        text.flush()
+        text.detach()
+        if compress:
+            # Закрывает только поток gzip, но не сам файл / Closes only the
+            # gzip stream, not the file itself
+            stream.close()
+    finally:
+        conn.close()
+
+    logger.info('Exported %d messages as %s', count, export_format)
+    return count
+
+
+def export_to_file(path: str, *args: Any) -> int:
+    """
+    Выгрузка в файл по пути path, аргументы как у write_export.
+    Export to the file at path, arguments as in write_export.
+    """
+    with open(path, 'wb') as output:
+        return write_export(output, *args)
+
+
+async def export_to_file_async(path: str, *args: Any) -> int:
+    """
+    Выгрузка в файл в отдельном потоке, не блокируя цикл событий.
+    Export to a file on a separate thread without blocking the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(export_to_file, path,
+                                                    *args))
+
+
+def parse_args() -> argparse.Namespace:
+    """
+    Разбор аргументов командной строки.
+    Parsing command line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description='Stream the feedback history to CSV or JSON Lines')
+    parser.add_argument('-o', '--output', default='-',
+                        help='output file, - for stdout')
+    parser.add_argument('--format', choices=sorted(FORMATS), default='csv',
+                        help='output format')
+    parser.add_argument('--gzip', action='store_true',
+                        help='compress the output with gzip')
+    parser.add_argument('--type', dest='message_type', default=None,
+                        help='export only messages of this type')
+    parser.add_argument('--from', dest='date_from', default=None,
+                        type=date.fromisoformat,
+                        help='first day to export, YYYY-MM-DD')
+    parser.add_argument('--to', dest='date_to', default=None,
+                        type=date.fromisoformat,
+                        help='last day to export (inclusive), YYYY-MM-DD')
+    return parser.parse_args()
+
+
+def main() -> int:
+    """
+    Выгрузка из командной строки.
+    Export from the command line.
+    """
+    args = parse_args()
+    database.init_db()
+    date_from = args.date_from.isoformat() if args.date_from else None
+    # Граница to включается целиком / The to bound includes the whole day
+    date_to = ((args.date_to + timedelta(days=1)).isoformat()
+               if args.date_to else None)
+    options = (args.format, args.gzip, args.message_type, date_from, date_to)
+
+    if args.output == '-':
+        write_export(sys.stdout.buffer, *options)
+        sys.stdout.buffer.flush()
+    else:
+        export_to_file(args.output, *options)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
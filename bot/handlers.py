@@ -1,34 +1,218 @@
-from typing import List, Tuple, Any
+import asyncio
+import tempfile
+import time
+from datetime import date, timedelta
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple, Any
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from config import (
-    logger, get_message, is_admin, MAX_MESSAGE_LENGTH, YOUR_CHAT_ID
+    logger, get_message, get_button_action, is_admin, MAX_MESSAGE_LENGTH,
+    YOUR_CHAT_ID, DB_PROFILE, DB_PROFILE_TOP, LOCALES, DEFAULT_LANGUAGE,
+    EXPORT_MAX_DOCUMENT_SIZE, USER_RATE_LIMITS, USER_RATE_IDLE,
+    STATS_DEFAULT_DAYS, STATS_MAX_DAYS
 )
-from database import (
+from async_database import (
     save_user, get_user_language, update_user_language,
     user_has_active_message, set_user_active_message,
-    save_message, save_reply, get_unanswered_messages,
-    get_user_messages, get_all_users, db_connection
+    submit_message, save_reply, get_unanswered_inbox,
+    get_users_page, get_user_messages_page, get_message_details,
+    get_message_user_id, get_last_unanswered_message_id, search_messages,
+    create_broadcast, get_broadcast, get_running_broadcasts,
+    get_latest_broadcast_id, peek_user_language, Page
+)
+from sender import outbox, PRIORITY_HIGH, PRIORITY_NORMAL
+from export import (
+    FORMATS as EXPORT_FORMATS, export_filename, export_to_file_async
+)
+from broadcast import broadcaster, format_broadcast_status
+from stats import format_stats
+from profiler import statement_stats
+from ratelimit import KeyedRateLimiter
+from metrics import (
+    timed, HANDLER_SECONDS, HANDLER_ERRORS, SEND_SECONDS, SEND_ERRORS,
+    RATE_LIMITED, ADMIN_NOTIFY_FAILURES
 )
 from keyboards import (
     get_message_type_keyboard, get_admin_main_keyboard,
-    get_unanswered_message_keyboard, get_language_keyboard, add_back_button
+    get_unanswered_message_keyboard, get_language_keyboard, add_back_button,
+    serialize_markup
 )
 
 
-async def send_message_safe(bot: Any, chat_id: int,
-                            text: str, **kwargs) -> None:
+# Максимальная длина подписи кнопки результата поиска / Maximum length of a
+# search result button label
+SEARCH_BUTTON_LENGTH = 60
+
+# Ограничители частоты обновлений пользователей по типам обработчиков /
+# Per-user update rate limiters by handler type
+_rate_limiters = {
+    kind: KeyedRateLimiter(rate, burst, USER_RATE_IDLE)
+    for kind, (rate, burst) in USER_RATE_LIMITS.items()
+}
+
+# Уведомления админу, ещё стоящие в очереди исходящих / Admin
+# notifications still waiting in the outbound queue
+_admin_notifications: Set[asyncio.Task] = set()
+
+
+async def _send_tracked(chat_id: int, method: str, operation: Any,
+                        priority: int = PRIORITY_NORMAL) -> Any:
+    """
+    Отправляет запрос через очередь исходящих, записывая задержку и ошибки.
+    Sends a request through the outbound queue recording latency and errors.
+    """
+    started = time.perf_counter()
+    try:
+        return await outbox.send(chat_id, operation, priority)
+    except Exception as e:
+        SEND_ERRORS.inc(method, type(e).__name__)
+        raise
+    finally:
+        SEND_SECONDS.observe(time.perf_counter() - started, method)
+
+
+async def send_message_safe(bot: Any, chat_id: int, text: str,
+                            priority: int = PRIORITY_NORMAL,
+                            **kwargs) -> None:
+    """
+    Безопасная отправка сообщения через очередь исходящих с обработкой ошибок.
+    Sending messages safely through the outbound queue with error handling.
+    """
+    if 'reply_markup' in kwargs:
+        kwargs['reply_markup'] = serialize_markup(kwargs['reply_markup'])
+
+    try:
+        await _send_tracked(chat_id, 'send_message', partial(
+            bot.send_message, chat_id=chat_id, text=text, **kwargs), priority)
+    except Exception as e:
+        logger.error('Failed to send message to %s: %s', chat_id, e)
+        raise
+
+
+async def send_document_safe(bot: Any, chat_id: int, document: Any,
+                             **kwargs) -> None:
+    """
+    Безопасная отправка документа через очередь исходящих с обработкой
+    ошибок.
+    Sending a document safely through the outbound queue with error
+    handling.
+    """
+    try:
+        await _send_tracked(chat_id, 'send_document', partial(
+            bot.send_document, chat_id=chat_id, document=document, **kwargs))
+    except Exception as e:
+        logger.error('Failed to send document to %s: %s', chat_id, e)
+        raise
+
+
+async def edit_message_safe(query: Any, text: str, **kwargs) -> None:
     """
-    Безопасная отправка сообщения с обработкой ошибок.
-    Sending messages safely with error handling.
+    Безопасное редактирование сообщения через очередь исходящих.
+    Editing a message safely through the outbound queue.
     """
+    chat_id = query.message.chat.id
+    if 'reply_markup' in kwargs:
+        kwargs['reply_markup'] = serialize_markup(kwargs['reply_markup'])
+
     try:
-        await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        await _send_tracked(chat_id, 'edit_message_text', partial(
+            query.edit_message_text, text, **kwargs))
     except Exception as e:
-        logger.error(f'Failed to send message to {chat_id}: {e}')
+        logger.error('Failed to edit message in %s: %s', chat_id, e)
         raise
 
 
+async def _notify_admin(bot: Any, user_id: int, lang: str, message_id: int,
+                        text: str, **kwargs) -> None:
+    """
+    Отправляет админу уведомление о новом сообщении. При ошибке, как и
+    раньше, снимает флаг активного сообщения и сообщает пользователю об
+    ошибке, чтобы он мог отправить сообщение снова.
+    Sends the admin a notification about a new message. On failure, as
+    before, clears the active message flag and tells the user about the
+    error, so they can send the message again.
+    """
+    try:
+        await send_message_safe(bot, YOUR_CHAT_ID, text, **kwargs)
+    except Exception as e:
+        ADMIN_NOTIFY_FAILURES.inc(type(e).__name__)
+        logger.error('Admin was not notified about message %s: %s',
+                     message_id, e)
+        try:
+            await set_user_active_message(user_id, False)
+            await send_message_safe(bot, user_id, get_message('error', lang))
+        except Exception as e:
+            logger.error('Failed to report the error to %s: %s', user_id, e)
+
+
+def notify_admin(bot: Any, user_id: int, lang: str, message_id: int,
+                 text: str, **kwargs) -> None:
+    """
+    Ставит уведомление админу в очередь исходящих, не дожидаясь отправки:
+    чат админа получает не больше SEND_CHAT_RATE сообщений в секунду, и
+    обработчик не должен занимать слот обновления на это время.
+    Queues an admin notification without waiting for it to be sent: the
+    admin chat gets at most SEND_CHAT_RATE messages per second, and the
+    handler must not hold an update slot for that long.
+    """
+    task = asyncio.create_task(
+        _notify_admin(bot, user_id, lang, message_id, text, **kwargs),
+        name=f'notify-admin-{message_id}')
+    _admin_notifications.add(task)
+    task.add_done_callback(_admin_notifications.discard)
+
+
+async def wait_admin_notifications(timeout: float = 5.0) -> None:
+    """
+    Даёт уведомлениям админу время уйти перед остановкой очереди исходящих.
+    Gives the admin notifications time to go out before the outbound queue
+    stops.
+    """
+    if _admin_notifications:
+        await asyncio.wait(list(_admin_notifications), timeout=timeout)
+
+
+async def reject_flood(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                       kind: str) -> bool:
+    """
+    Проверяет лимит частоты обновлений пользователя, не обращаясь к базе.
+    Возвращает True, если обновление нужно отбросить; предупреждение
+    отправляется один раз за серию отклонённых обновлений.
+    Checks the user's update rate limit without touching the database.
+    Returns True if the update must be dropped; the warning is sent once
+    per run of rejected updates.
+    """
+    user = update.effective_user
+    if user is None or is_admin(user.id):
+        return False
+    limiter = _rate_limiters[kind]
+    if limiter.try_acquire(user.id) == 0:
+        return False
+
+    RATE_LIMITED.inc(kind)
+    if not limiter.should_warn(user.id):
+        return True
+
+    # Язык из кэша или из клиента Telegram / The language from the cache or
+    # from the Telegram client
+    lang = peek_user_language(user.id) or user.language_code
+    text = get_message('slow_down',
+                       lang if lang in LOCALES else DEFAULT_LANGUAGE)
+    try:
+        if update.callback_query is not None:
+            await update.callback_query.answer(text)
+        else:
+            await send_message_safe(context.bot, update.effective_chat.id,
+                                    text)
+    except Exception as e:
+        logger.error('Failed to warn %s about the rate limit: %s',
+                     user.id, e)
+    return True
+
+
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Обработчик команды /start.
@@ -37,10 +221,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.message or not update.message.from_user:
         logger.warning('Invalid start command received')
         return
+    if await reject_flood(update, context, 'command'):
+        return
 
     user = update.effective_user
-    save_user(user)
-    lang = get_user_language(user.id)
+    await save_user(user)
+    lang = await get_user_language(user.id)
 
     # Разделение логики для админа и обычных пользователей / Separation of
     # logic for admin and regular users
@@ -54,7 +240,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     else:
         # Проверка наличия неотвеченных сообщений у пользователя / Checking if
         # a user has any unanswered messages
-        if user_has_active_message(user.id):
+        if await user_has_active_message(user.id):
             await send_message_safe(
                 context.bot,
                 update.effective_chat.id,
@@ -70,14 +256,26 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             )
 
 
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
 async def set_language(update: Update,
                        context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Обработчик команды для смены языка.
     Command handler for changing language.
     """
+    if await reject_flood(update, context, 'command'):
+        return
+    await send_language_choice(update, context)
+
+
+async def send_language_choice(update: Update,
+                               context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Предлагает выбрать язык; лимит частоты проверяет вызывающий.
+    Offers to choose a language; the caller checks the rate limit.
+    """
     user = update.effective_user
-    lang = get_user_language(user.id)
+    lang = await get_user_language(user.id)
 
     if update.message:
         await update.message.delete()
@@ -90,12 +288,221 @@ async def set_language(update: Update,
     )
 
 
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
+async def sqlstats(update: Update,
+                   context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Обработчик команды /sqlstats: самые затратные SQL-запросы (только для
+    администратора).
+    /sqlstats command handler: the most expensive SQL statements (admin
+    only).
+    """
+    if not is_admin(update.effective_chat.id):
+        return
+
+    lang = await get_user_language(update.effective_user.id)
+    if not DB_PROFILE:
+        text = get_message('sqlstats_disabled', lang)
+    else:
+        text = (statement_stats.format(DB_PROFILE_TOP)
+                or get_message('sqlstats_empty', lang))
+
+    await send_message_safe(
+        context.bot,
+        update.effective_chat.id,
+        text[:MAX_MESSAGE_LENGTH],
+        parse_mode=None
+    )
+
+
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
+async def stats(update: Update,
+                context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Обработчик команды /stats [дней]: объём обращений и время ответа по
+    сводным таблицам (только для администратора).
+    /stats [days] command handler: feedback volume and response time from
+    the rollup tables (admin only).
+    """
+    if not is_admin(update.effective_chat.id):
+        return
+
+    lang = await get_user_language(update.effective_user.id)
+    args = context.args or []
+    days = STATS_DEFAULT_DAYS
+    if args:
+        days = int(args[0]) if args[0].isdigit() else 0
+    if len(args) > 1 or not 1 <= days <= STATS_MAX_DAYS:
+        await send_message_safe(
+            context.bot,
+            update.effective_chat.id,
+            get_message('stats_usage', lang, max_days=STATS_MAX_DAYS)
+        )
+        return
+
+    await send_message_safe(
+        context.bot,
+        update.effective_chat.id,
+        (await format_stats(days, lang))[:MAX_MESSAGE_LENGTH],
+        parse_mode=None
+    )
+
+
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
+async def search(update: Update,
+                 context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Обработчик команды /search: полнотекстовый поиск по истории (только для
+    администратора).
+    /search command handler: full-text search over the history (admin
+    only).
+    """
+    if not is_admin(update.effective_chat.id):
+        return
+
+    lang = await get_user_language(update.effective_user.id)
+    search_query = parse_search_args(context.args or [])
+    if search_query is None:
+        await send_message_safe(
+            context.bot,
+            update.effective_chat.id,
+            get_message('search_usage', lang,
+                        types='|'.join(LOCALES[lang]['message_types']))
+        )
+        return
+
+    # Запрос сохраняется для перелистывания страниц / The query is kept for
+    # paging through the results
+    context.user_data['search'] = search_query
+    text, reply_markup = await build_search_page(search_query, 0, lang)
+    await send_message_safe(
+        context.bot,
+        update.effective_chat.id,
+        text,
+        reply_markup=reply_markup
+    )
+
+
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
+async def export_history(update: Update,
+                         context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Обработчик команды /export: выгрузка истории в CSV или JSON Lines
+    документом (только для администратора).
+    /export command handler: exports the history to CSV or JSON Lines as a
+    document (admin only).
+    """
+    if not is_admin(update.effective_chat.id):
+        return
+
+    chat_id = update.effective_chat.id
+    lang = await get_user_language(update.effective_user.id)
+    options = parse_export_args(context.args or [])
+    if options is None:
+        await send_message_safe(
+            context.bot,
+            chat_id,
+            get_message('export_usage', lang,
+                        types='|'.join(LOCALES[lang]['message_types']))
+        )
+        return
+
+    await send_message_safe(context.bot, chat_id,
+                            get_message('export_started', lang))
+
+    # Выгрузка пишется во временный файл, а не в память / The export is
+    # written to a temporary file, not to memory
+    filename = export_filename(options['format'], options['gzip'])
+    with tempfile.TemporaryDirectory(prefix='feedback-export-') as workdir:
+        path = Path(workdir, filename)
+        count = await export_to_file_async(
+            str(path), options['format'], options['gzip'], options['type'],
+            options['from'], options['to'])
+
+        size = path.stat().st_size
+        if size > EXPORT_MAX_DOCUMENT_SIZE:
+            await send_message_safe(
+                context.bot,
+                chat_id,
+                get_message('export_too_large', lang,
+                            size=round(size / (1024 * 1024)))
+            )
+            return
+
+        await send_document_safe(
+            context.bot,
+            chat_id,
+            path,
+            filename=filename,
+            caption=get_message('export_done', lang, count=count)
+        )
+
+
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
+async def broadcast(update: Update,
+                    context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Обработчик команды /broadcast: рассылка сообщения всем пользователям,
+    её ход и остановка (только для администратора).
+    /broadcast command handler: sending a message to all users, its
+    progress and stopping it (admin only).
+    """
+    if not is_admin(update.effective_chat.id):
+        return
+
+    chat_id = update.effective_chat.id
+    lang = await get_user_language(update.effective_user.id)
+    # Текст берётся целиком, с переносами строк / The text is taken as a
+    # whole, with line breaks
+    parts = update.message.text.split(maxsplit=1)
+    text = parts[1].strip() if len(parts) > 1 else ''
+    running = await get_running_broadcasts()
+
+    if not text:
+        reply = get_message('broadcast_usage', lang)
+        latest = await get_latest_broadcast_id()
+        if latest is not None:
+            _, status = await get_broadcast(latest)
+            reply += '\n\n' + await format_broadcast_status(latest, status,
+                                                            lang)
+        await send_message_safe(context.bot, chat_id, reply, parse_mode=None)
+        return
+
+    if text.lower() == 'stop':
+        if not running:
+            await send_message_safe(context.bot, chat_id,
+                                    get_message('broadcast_usage', lang),
+                                    parse_mode=None)
+        for broadcast_id in running:
+            await broadcaster.cancel(broadcast_id)
+            await send_message_safe(
+                context.bot, chat_id,
+                get_message('broadcast_stopped', lang, id=broadcast_id))
+        return
+
+    if running:
+        await send_message_safe(
+            context.bot, chat_id,
+            get_message('broadcast_running', lang, id=running[0]))
+        return
+
+    broadcast_id, count = await create_broadcast(text[:MAX_MESSAGE_LENGTH])
+    broadcaster.start(context.bot, broadcast_id)
+    await send_message_safe(
+        context.bot, chat_id,
+        get_message('broadcast_started', lang, id=broadcast_id, count=count))
+
+
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
 async def language_callback(update: Update,
                             context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Обработчик callback для смены языка.
     Callback handler for changing language.
     """
+    if await reject_flood(update, context, 'callback'):
+        return
+
     query = update.callback_query
     await query.answer()
 
@@ -103,9 +510,9 @@ async def language_callback(update: Update,
     # selected language (format: 'set_lang_ru' -> 'ru')
     lang = query.data.split('_')[-1]
     user_id = query.from_user.id
-    update_user_language(user_id, lang)
+    await update_user_language(user_id, lang)
 
-    new_lang = get_user_language(user_id)
+    new_lang = await get_user_language(user_id)
 
     try:
         await query.delete_message()
@@ -128,7 +535,7 @@ async def language_callback(update: Update,
                 reply_markup=get_message_type_keyboard(new_lang)
             )
     except Exception as e:
-        logger.error(f'Error in language change: {e}')
+        logger.error('Error in language change: %s', e)
         await send_message_safe(
             context.bot,
             user_id,
@@ -140,6 +547,7 @@ async def language_callback(update: Update,
         )
 
 
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
 async def handle_user_message(update: Update,
                             context: ContextTypes.DEFAULT_TYPE) -> None:
     """
@@ -155,15 +563,24 @@ async def handle_user_message(update: Update,
     if is_admin(update.effective_chat.id):
         return
 
+    # Лимит проверяется до первого обращения к базе / The limit is checked
+    # before the first database access
+    if await reject_flood(update, context, 'message'):
+        return
+
     # Получение информации о пользователе / Getting user information
     user = update.effective_user
     user_id = user.id
-    lang = get_user_language(user_id)
+    lang = await get_user_language(user_id)
     user_message = update.message.text.strip()
 
+    # Действие нажатой кнопки (если это кнопка) / Action of the pressed
+    # button (if it is a button)
+    button = get_button_action(user_message, lang)
+
     # Обработка команды смены языка / Processing the language change command
-    if user_message == get_message('change_language', lang):
-        await set_language(update, context)
+    if button and button[0] == 'change_language':
+        await send_language_choice(update, context)
         return
 
     # Валидация сообщения / Message validation
@@ -184,8 +601,9 @@ async def handle_user_message(update: Update,
         )
         return
 
-    # Проверка наличия активного сообщения / Checking for an active message
-    if user_has_active_message(user_id):
+    # Быстрая проверка по кэшу; окончательно решает submit_message / A
+    # quick check against the cache; submit_message makes the final decision
+    if await user_has_active_message(user_id):
         await send_message_safe(
             context.bot,
             update.effective_chat.id,
@@ -196,18 +614,8 @@ async def handle_user_message(update: Update,
 
     # Определение выбранного типа сообщения / Defining the selected
     # message type
-    message_type_keys = ['suggestion', 'complaint', 'message']
-    selected_type = None
-
-    button_texts = {
-        type_key: get_message(f'message_types.{type_key}.button', lang) for
-            type_key in message_type_keys
-    }
-
-    for type_key, button_text in button_texts.items():
-        if user_message == button_text:
-            selected_type = type_key
-            break
+    selected_type = (button[1] if button and button[0] == 'message_type'
+                     else None)
 
     # Если тип сообщения выбран - просим ввести сообщение / If the message
     # type is selected, please enter a message
@@ -236,30 +644,46 @@ async def handle_user_message(update: Update,
             reply_markup=get_message_type_keyboard(lang)
         )
 
+    message_id = None
     try:
         message_type = context.user_data['message_type']
-        save_message(user_id, message_type, user_message)
+        message_id, admin_lang = await asyncio.gather(
+            submit_message(user, message_type, user_message),
+            get_user_language(YOUR_CHAT_ID)
+        )
+
+        # Параллельное обновление того же пользователя успело раньше /
+        # A concurrent update from the same user got there first
+        if message_id is None:
+            await send_message_safe(
+                context.bot,
+                update.effective_chat.id,
+                get_message('active_message', lang),
+                reply_markup=None
+            )
+            return
+
         username = f'@{user.username}' if user.username else f'ID: {user.id}'
 
-        # Отправка уведомления админу / Sending notification to admin
-        await send_message_safe(
+        # Уведомление админу уходит в фоне, обработчик ждёт только
+        # подтверждения пользователю / The admin notification goes out in
+        # the background, the handler waits only for the user confirmation
+        notify_admin(
             context.bot,
-            YOUR_CHAT_ID,
+            user_id,
+            lang,
+            message_id,
             get_message(
                 'new_message',
-                get_user_language(YOUR_CHAT_ID),
+                admin_lang,
                 username=username,
                 type=get_message(f'message_types.{message_type}.display',
-                                 get_user_language(YOUR_CHAT_ID)),
+                                 admin_lang),
                 text=user_message
             ),
             parse_mode=None,
-            reply_markup=get_admin_main_keyboard(
-                get_user_language(YOUR_CHAT_ID))
+            reply_markup=get_admin_main_keyboard(admin_lang)
         )
-
-        # Подтверждение пользователю об отправке / Confirmation to the user
-        # about sending
         await send_message_safe(
             context.bot,
             update.effective_chat.id,
@@ -267,8 +691,11 @@ async def handle_user_message(update: Update,
             reply_markup=None
         )
     except Exception as e:
-        logger.error(f'Error processing message: {e}')
-        set_user_active_message(user_id, False)
+        logger.error('Error processing message: %s', e)
+        # Флаг снимается, только если его поставил этот вызов / The flag
+        # is cleared only if this call set it
+        if message_id is not None:
+            await set_user_active_message(user_id, False)
         await send_message_safe(
             context.bot,
             update.effective_chat.id,
@@ -280,6 +707,7 @@ async def handle_user_message(update: Update,
             del context.user_data['message_type']
 
 
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
 async def handle_admin_callback(update: Update,
                               context: ContextTypes.DEFAULT_TYPE) -> None:
     """
@@ -291,26 +719,35 @@ async def handle_admin_callback(update: Update,
 
     # Проверка прав администратора / Checking administrator rights
     if not is_admin(update.effective_chat.id):
-        logger.warning(
-            f'Non-admin access attempt from {update.effective_chat.id}')
+        logger.warning('Non-admin access attempt from %s',
+                       update.effective_chat.id)
         return
 
-    lang = get_user_language(query.from_user.id)
+    lang = await get_user_language(query.from_user.id)
 
     try:
         # Обработчик смены языка / Language change handler
         if query.data == 'change_language':
-            await query.edit_message_text(
+            await edit_message_safe(
+                query,
                 get_message('choose_language', lang),
                 reply_markup=get_language_keyboard(lang)
             )
             return
 
-        # Просмотр неотвеченных сообщений / View unanswered messages
-        if query.data == 'unanswered':
-            messages = get_unanswered_messages()
+        # Просмотр неотвеченных сообщений (формат: 'unanswered' - первая
+        # страница, 'unanswered_n<ID>' / 'unanswered_p<ID>' - после / перед
+        # сообщением) / View unanswered messages (format: 'unanswered' -
+        # first page, 'unanswered_n<ID>' / 'unanswered_p<ID>' - after /
+        # before the message)
+        if query.data == 'unanswered' or query.data.startswith('unanswered_'):
+            cursor_id, backward = parse_page_cursor(
+                query.data[len('unanswered_'):])
+            page, total = await get_unanswered_inbox(cursor_id, backward)
+            messages, has_prev, has_next = page
             if not messages:
-                await query.edit_message_text(
+                await edit_message_safe(
+                    query,
                     get_message('no_unanswered', lang),
                     reply_markup=get_admin_main_keyboard(lang)
                 )
@@ -320,15 +757,32 @@ async def handle_admin_callback(update: Update,
             # list of buttons with unanswered messages
             keyboard = []
             no_name_text = get_message('no_name', lang)
-            for msg in messages[:10]:
+            for msg in messages:
                 btn_text = f'{msg[2] or msg[3] or no_name_text} - {msg[4]}'
                 keyboard.append([InlineKeyboardButton(
                     btn_text,
                     callback_data=f'view_msg_{msg[0]}_{msg[1]}')
                 ])
 
-            await query.edit_message_text(
-                get_message('unanswered_messages', lang),
+            # Кнопки пагинации / Pagination buttons
+            pagination_buttons = []
+            if has_prev:
+                pagination_buttons.append(InlineKeyboardButton(
+                    get_message('prev_page', lang),
+                    callback_data=f'unanswered_p{messages[0][0]}'
+                ))
+            if has_next:
+                pagination_buttons.append(InlineKeyboardButton(
+                    get_message('next_page', lang),
+                    callback_data=f'unanswered_n{messages[-1][0]}'
+                ))
+            if pagination_buttons:
+                keyboard.append(pagination_buttons)
+
+            await edit_message_safe(
+                query,
+                get_message('unanswered_count', lang, shown=len(messages),
+                            total=f'{total:,}'),
                 reply_markup=InlineKeyboardMarkup(
                     add_back_button(keyboard, lang))
             )
@@ -339,22 +793,14 @@ async def handle_admin_callback(update: Update,
             message_id = int(parts[2])
             user_id = int(parts[3])
 
-            with db_connection() as conn:
-                cursor = conn.cursor()
-                cursor.execute('''
-                SELECT m.message_type, m.message_text, m.created_at,
-                       u.username, u.first_name
-                FROM messages m
-                JOIN users u ON m.user_id = u.user_id
-                WHERE m.id = ?
-                ''', (message_id,))
-                message = cursor.fetchone()
+            message = await get_message_details(message_id)
 
             if message:
                 # Форматируем и показываем сообщение / Format and display
                 # the message
                 no_name_text = get_message('no_name', lang)
-                await query.edit_message_text(
+                await edit_message_safe(
+                    query,
                     get_message(
                         'message_from',
                         lang,
@@ -372,99 +818,277 @@ async def handle_admin_callback(update: Update,
         elif query.data.startswith('reply_msg_'):
             message_id = int(query.data.split('_')[2])
             context.user_data['reply_to'] = {'message_id': message_id}
-            await query.edit_message_text(
+            await edit_message_safe(
+                query,
                 get_message('enter_reply', lang),
                 reply_markup=None
             )
 
         # Обработчик истории сообщений / Message history handler
         elif query.data == 'history':
-            users = get_all_users()
-            if not users:
-                await query.edit_message_text(
+            page = await get_users_page()
+            if not page[0]:
+                await edit_message_safe(
+                    query,
                     get_message('no_history', lang),
                     reply_markup=get_admin_main_keyboard(lang)
                 )
                 return
 
-            context.user_data['history_page'] = 0
-            await show_history_page(query, context, users, lang)
+            context.user_data['history_page'] = None
+            await show_history_page(query, context, page, lang)
 
-        # Навигация по страницам истории / Navigating through history pages
+        # Навигация по страницам истории (формат: 'history_page_n<ID>' -
+        # после пользователя, 'history_page_p<ID>' - перед ним) / Navigating
+        # through history pages (format: 'history_page_n<ID>' - after the
+        # user, 'history_page_p<ID>' - before them)
         elif query.data.startswith('history_page_'):
-            page = int(query.data.split('_')[2])
-            users = get_all_users()
-            await show_history_page(query, context, users, lang, page)
+            cursor_id, backward = parse_page_cursor(
+                query.data[len('history_page_'):])
+            page = await get_users_page(cursor_id, backward)
+            context.user_data['history_page'] = cursor_id
+            await show_history_page(query, context, page, lang)
+
+        # Страницы результатов поиска (формат: 'search_<номер страницы>') /
+        # Search result pages (format: 'search_<page number>')
+        elif query.data.startswith('search_'):
+            search_query = context.user_data.get('search')
+            if search_query is None:
+                await edit_message_safe(
+                    query,
+                    get_message('search_usage', lang, types='|'.join(
+                        LOCALES[lang]['message_types'])),
+                    reply_markup=get_admin_main_keyboard(lang)
+                )
+                return
 
-        # Просмотр сообщений конкретного пользователя / View messages from a
-        # specific user
+            page = int(query.data[len('search_'):])
+            text, reply_markup = await build_search_page(search_query, page,
+                                                         lang)
+            await edit_message_safe(query, text, reply_markup=reply_markup)
+
+        # Просмотр сообщений конкретного пользователя (формат: 'user_<ID>_0' -
+        # первая страница, 'user_<ID>_n<ID сообщения>' / 'user_<ID>_p<ID
+        # сообщения>' - после / перед сообщением) / View messages from a
+        # specific user (format: 'user_<ID>_0' - first page,
+        # 'user_<ID>_n<message ID>' / 'user_<ID>_p<message ID>' - after /
+        # before the message)
         elif query.data.startswith('user_'):
             parts = query.data.split('_')
             user_id = int(parts[1])
-            page = int(parts[2]) if len(parts) > 2 else 0
+            cursor_id, backward = parse_page_cursor(
+                parts[2] if len(parts) > 2 else '')
 
-            messages = get_user_messages(user_id)
-            await show_user_messages_page(query, user_id, messages, lang, page)
+            page = await get_user_messages_page(user_id, cursor_id, backward)
+            await show_user_messages_page(query, user_id, page, lang)
 
         # Обработчик ответа пользователю (из истории сообщений) / User
         # response handler (from message history)
         elif query.data.startswith('reply_'):
             user_id = int(query.data.split('_')[1])
             context.user_data['reply_to'] = {'user_id': user_id}
-            await query.edit_message_text(
+            await edit_message_safe(
+                query,
                 get_message('enter_reply', lang),
                 reply_markup=None
             )
 
         # Обработка возврата в главное меню / Processing return to main menu
         elif query.data == 'back_to_main':
-            await query.edit_message_text(
+            await edit_message_safe(
+                query,
                 get_message('start_admin', lang),
                 reply_markup=get_admin_main_keyboard(lang)
             )
 
     except Exception as e:
-        logger.error(f'Error in admin callback: {e}')
-        await query.edit_message_text(
+        logger.error('Error in admin callback: %s', e)
+        await edit_message_safe(
+            query,
             get_message('error', lang),
             reply_markup=get_admin_main_keyboard(lang)
         )
 
 
+def parse_page_cursor(cursor: str) -> Tuple[Optional[int], bool]:
+    """
+    Разбирает курсор страницы из callback-данных ('n<ID>' - после ID,
+    'p<ID>' - перед ID, иначе - первая страница).
+    Parses a page cursor from callback data ('n<ID>' - after the ID,
+    'p<ID>' - before the ID, otherwise - the first page).
+    """
+    if cursor[:1] in ('n', 'p') and cursor[1:].isdigit():
+        return int(cursor[1:]), cursor[0] == 'p'
+    return None, False
+
+
+def parse_filter(name: str, value: str) -> Optional[str]:
+    """
+    Проверяет фильтр type:, from: или to: (даты ГГГГ-ММ-ДД, to
+    включительно) и возвращает значение для запроса или None при ошибке.
+    Validates a type:, from: or to: filter (YYYY-MM-DD dates, to is
+    inclusive) and returns the value for the query or None on error.
+    """
+    if name == 'type':
+        if value not in LOCALES[DEFAULT_LANGUAGE]['message_types']:
+            return None
+        return value
+
+    try:
+        day = date.fromisoformat(value)
+    except ValueError:
+        return None
+    # Граница to хранится как начало следующего дня / The to bound is
+    # stored as the start of the next day
+    if name == 'to':
+        day += timedelta(days=1)
+    return day.isoformat()
+
+
+def parse_search_args(args: List[str]) -> Optional[Dict[str, Any]]:
+    """
+    Разбирает аргументы /search: слова и фильтры type:, from:, to:.
+    Возвращает None при ошибке.
+    Parses the /search arguments: words and the type:, from:, to: filters.
+    Returns None on error.
+    """
+    words = []
+    search_query: Dict[str, Any] = {'type': None, 'from': None, 'to': None}
+    for arg in args:
+        name, separator, value = arg.partition(':')
+        name = name.lower()
+        if not separator or name not in search_query:
+            words.append(arg)
+            continue
+
+        search_query[name] = parse_filter(name, value)
+        if search_query[name] is None:
+            return None
+
+    search_query['text'] = ' '.join(words)
+    return search_query if search_query['text'].strip() else None
+
+
+def parse_export_args(args: List[str]) -> Optional[Dict[str, Any]]:
+    """
+    Разбирает аргументы /export: формат (csv или jsonl), gz и фильтры type:,
+    from:, to:. Возвращает None при ошибке.
+    Parses the /export arguments: the format (csv or jsonl), gz and the
+    type:, from:, to: filters. Returns None on error.
+    """
+    options: Dict[str, Any] = {'format': 'csv', 'gzip': False, 'type': None,
+                               'from': None, 'to': None}
+    for arg in args:
+        name, separator, value = arg.partition(':')
+        name = name.lower()
+        if not separator:
+            if name in EXPORT_FORMATS:
+                options['format'] = name
+            elif name == 'gz':
+                options['gzip'] = True
+            else:
+                return None
+            continue
+
+        if name not in ('type', 'from', 'to'):
+            return None
+        options[name] = parse_filter(name, value)
+        if options[name] is None:
+            return None
+    return options
+
+
+async def build_search_page(
+        search_query: Dict[str, Any], page: int,
+        lang: str) -> Tuple[str, InlineKeyboardMarkup]:
+    """
+    Формирует страницу результатов поиска: текст и кнопки сообщений.
+    Страницы листаются по ключу: в запросе хранится ID, перед которым
+    начинается каждая из уже открытых страниц.
+    Builds a page of search results: the text and message buttons. Pages
+    are keyset-paged: the query keeps the ID before which each page opened
+    so far starts.
+    """
+    cursors = search_query.setdefault('cursors', [None])
+    page = min(page, len(cursors) - 1)
+    rows, has_next = await search_messages(
+        search_query['text'], search_query['type'], search_query['from'],
+        search_query['to'], cursors[page])
+    if has_next:
+        del cursors[page + 1:]
+        cursors.append(rows[-1][0])
+    if not rows:
+        return (get_message('search_nothing', lang,
+                            query=search_query['text']),
+                get_admin_main_keyboard(lang))
+
+    # Кнопка на каждое найденное сообщение / A button for every message
+    # found
+    keyboard = []
+    no_name_text = get_message('no_name', lang)
+    for row in rows:
+        preview = ' '.join((row[5] or '').split())
+        name = row[3] or row[2] or no_name_text
+        label = f'{name} · {row[6][:10]} · {preview}'
+        if len(label) > SEARCH_BUTTON_LENGTH:
+            label = label[:SEARCH_BUTTON_LENGTH - 1] + '…'
+        keyboard.append([InlineKeyboardButton(
+            label,
+            callback_data=f'view_msg_{row[0]}_{row[1]}'
+        )])
+
+    # Кнопки пагинации / Pagination buttons
+    pagination_buttons = []
+    if page > 0:
+        pagination_buttons.append(InlineKeyboardButton(
+            get_message('prev_page', lang),
+            callback_data=f'search_{page - 1}'
+        ))
+    if has_next:
+        pagination_buttons.append(InlineKeyboardButton(
+            get_message('next_page', lang),
+            callback_data=f'search_{page + 1}'
+        ))
+    if pagination_buttons:
+        keyboard.append(pagination_buttons)
+
+    return (get_message('search_results', lang, query=search_query['text'],
+                        page=page + 1),
+            InlineKeyboardMarkup(add_back_button(keyboard, lang)))
+
+
 async def show_history_page(
-        query: Any, context: ContextTypes.DEFAULT_TYPE, users: List[Tuple],
-        lang: str, page: int = 0) -> None:
+        query: Any, context: ContextTypes.DEFAULT_TYPE, page: Page,
+        lang: str) -> None:
     """
     Отображает страницу с историей пользователей с пагинацией.
     Displays a page with user history with pagination.
     """
-    # Настройки пагинации / Pagination settings
-    ITEMS_PER_PAGE = 5
-    start_idx = page * ITEMS_PER_PAGE
-    end_idx = start_idx + ITEMS_PER_PAGE
-    paginated_users = users[start_idx:end_idx]
+    users, has_prev, has_next = page
 
     # Формирует клавиатуру с пользователями / Generates a keyboard with users
     keyboard = []
     no_name_text = get_message('no_name', lang)
-    for user in paginated_users:
+    for user in users:
         name = user[2] or user[1] or f'{no_name_text} {user[0]}'
         keyboard.append([InlineKeyboardButton(
             name,
             callback_data=f'user_{user[0]}_0'
         )])
 
-    # Добавляет кнопки пагинации / Adds pagination buttons
+    # Добавляет кнопки пагинации с курсорами по первому и последнему
+    # пользователю страницы / Adds pagination buttons with cursors on the
+    # first and last user of the page
     pagination_buttons = []
-    if page > 0:
+    if has_prev and users:
         pagination_buttons.append(InlineKeyboardButton(
             get_message('prev_page', lang),
-            callback_data=f'history_page_{page-1}'
+            callback_data=f'history_page_p{users[0][0]}'
         ))
-    if end_idx < len(users):
+    if has_next and users:
         pagination_buttons.append(InlineKeyboardButton(
             get_message('next_page', lang),
-            callback_data=f'history_page_{page+1}'
+            callback_data=f'history_page_n{users[-1][0]}'
         ))
 
     if pagination_buttons:
@@ -477,30 +1101,25 @@ async def show_history_page(
         callback_data='back_to_main'
     )])
 
-    await query.edit_message_text(
+    await edit_message_safe(
+        query,
         get_message('message_history', lang).split(':')[0] + ':',
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
-    context.user_data['history_page'] = page
 
 
 async def show_user_messages_page(
-        query: Any, user_id: int, messages: List[Tuple],
-        lang: str, page: int = 0) -> None:
+        query: Any, user_id: int, page: Page, lang: str) -> None:
     """
     Отображает страницу с сообщениями конкретного пользователя с пагинацией.
     Displays a page of messages for a specific user with pagination.
     """
-    # Настройки пагинации / Pagination settings
-    ITEMS_PER_PAGE = 5
-    start_idx = page * ITEMS_PER_PAGE
-    end_idx = start_idx + ITEMS_PER_PAGE
-    paginated_messages = messages[start_idx:end_idx]
+    messages, has_prev, has_next = page
 
     # Формирует текст сообщения с историей переписки / Generates a message
     # text with the correspondence history
     text = get_message('message_history', lang) + '\n\n'
-    for msg in paginated_messages:
+    for msg in messages:
         message_type = get_message(f'message_types.{msg[0]}.display', lang)
         text += f'📌 {message_type}\n✉️ {msg[1]}\n🕒 {msg[2]}\n'
         if msg[3]:
@@ -509,17 +1128,19 @@ async def show_user_messages_page(
 
     keyboard = []
 
-    # Добавляет кнопки пагинации / Adds pagination buttons
+    # Добавляет кнопки пагинации с курсорами по первому и последнему
+    # сообщению страницы / Adds pagination buttons with cursors on the first
+    # and last message of the page
     pagination_buttons = []
-    if page > 0:
+    if has_prev and messages:
         pagination_buttons.append(InlineKeyboardButton(
             get_message('prev_page', lang),
-            callback_data=f'user_{user_id}_{page-1}'
+            callback_data=f'user_{user_id}_p{messages[0][5]}'
         ))
-    if end_idx < len(messages):
+    if has_next and messages:
         pagination_buttons.append(InlineKeyboardButton(
             get_message('next_page', lang),
-            callback_data=f'user_{user_id}_{page+1}'
+            callback_data=f'user_{user_id}_n{messages[-1][5]}'
         ))
 
     if pagination_buttons:
@@ -527,7 +1148,7 @@ async def show_user_messages_page(
 
     # Добавляет кнопку "Ответить" (если у пользователя есть активное
     # сообщение) / Adds a "Reply" button (if the user has an active message)
-    if user_has_active_message(user_id):
+    if await user_has_active_message(user_id):
         keyboard.append([InlineKeyboardButton(
             get_message('enter_reply', lang).split(':')[0],
             callback_data=f'reply_{user_id}'
@@ -540,13 +1161,15 @@ async def show_user_messages_page(
         callback_data='back_to_main'
     )])
 
-    await query.edit_message_text(
+    await edit_message_safe(
+        query,
         text,
         parse_mode='Markdown',
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
 
+@timed(HANDLER_SECONDS, HANDLER_ERRORS)
 async def handle_admin_reply(update: Update,
                            context: ContextTypes.DEFAULT_TYPE) -> None:
     """
@@ -555,9 +1178,8 @@ async def handle_admin_reply(update: Update,
     """
     # Блок проверок безопасности / Security checks
     if not is_admin(update.effective_chat.id):
-        logger.warning(
-            f'Non-admin reply attempt from {update.effective_chat.id}'
-        )
+        logger.warning('Non-admin reply attempt from %s',
+                       update.effective_chat.id)
         return
 
     if 'reply_to' not in context.user_data:
@@ -571,7 +1193,7 @@ async def handle_admin_reply(update: Update,
     # Получает данные для ответа / Receives data for response
     reply_data = context.user_data['reply_to']
     reply_text = update.message.text.strip()
-    lang = get_user_language(update.effective_user.id)
+    lang = await get_user_language(update.effective_user.id)
 
     # Валидация содержимого ответа / Reply content validation
     if not reply_text:
@@ -594,84 +1216,78 @@ async def handle_admin_reply(update: Update,
         return
 
     try:
-        with db_connection() as conn:
-            cursor = conn.cursor()
-
-            # Сценарий 1: Ответ на конкретное сообщение из истории
-            # Scenario 1: Reply to specific message from history
-            if 'message_id' in reply_data:
-                message_id = reply_data['message_id']
-                cursor.execute('''
-                SELECT user_id FROM messages WHERE id = ?
-                ''', (message_id,))
-                result = cursor.fetchone()
-
-                if result:
-                    user_id = result[0]
-                    user_lang = get_user_language(user_id)
-                    save_reply(message_id, reply_text)
-
-                    await send_message_safe(
-                        context.bot,
-                        user_id,
-                        get_message('admin_reply', user_lang, text=reply_text),
-                        parse_mode='Markdown'
-                    )
-
-                    await send_message_safe(
-                        context.bot,
-                        update.effective_chat.id,
-                        get_message('admin_reply_sent', lang),
-                        reply_markup=get_admin_main_keyboard(lang)
-                    )
-
-                else:
-                    await send_message_safe(
-                        context.bot,
-                        update.effective_chat.id,
-                        get_message('message_not_found', lang),
-                        reply_markup=get_admin_main_keyboard(lang)
-                    )
-
-            # Сценарий 2: Ответ на последнее неотвеченное сообщение
-            # Scenario 2: Reply to latest unanswered message
-            elif 'user_id' in reply_data:
-                user_id = reply_data['user_id']
-                user_lang = get_user_language(user_id)
-                cursor.execute('''
-                SELECT id FROM messages
-                WHERE user_id = ? AND is_answered = FALSE
-                ORDER BY created_at DESC LIMIT 1
-                ''', (user_id,))
-                message = cursor.fetchone()
-
-                if message:
-                    save_reply(message[0], reply_text)
-
-                    await send_message_safe(
-                        context.bot,
-                        user_id,
-                        get_message('admin_reply', user_lang, text=reply_text),
-                        parse_mode='Markdown'
-                    )
-
-                    await send_message_safe(
-                        context.bot,
-                        update.effective_chat.id,
-                        get_message('admin_reply_sent', lang),
-                        reply_markup=get_admin_main_keyboard(lang)
-                    )
-
-                else:
-                    await send_message_safe(
-                        context.bot,
-                        update.effective_chat.id,
-                        get_message('no_unanswered', lang),
-                        reply_markup=get_admin_main_keyboard(lang)
-                    )
+        # Сценарий 1: Ответ на конкретное сообщение из истории
+        # Scenario 1: Reply to specific message from history
+        if 'message_id' in reply_data:
+            message_id = reply_data['message_id']
+            user_id = await get_message_user_id(message_id)
+
+            if user_id is not None:
+                user_lang = await get_user_language(user_id)
+                await save_reply(message_id, reply_text)
+
+                # Ответ пользователю обгоняет рассылки и уведомления /
+                # The reply to the user overtakes broadcasts and notifications
+                await send_message_safe(
+                    context.bot,
+                    user_id,
+                    get_message('admin_reply', user_lang, text=reply_text),
+                    priority=PRIORITY_HIGH,
+                    parse_mode='Markdown'
+                )
+
+                await send_message_safe(
+                    context.bot,
+                    update.effective_chat.id,
+                    get_message('admin_reply_sent', lang),
+                    reply_markup=get_admin_main_keyboard(lang)
+                )
+
+            else:
+                await send_message_safe(
+                    context.bot,
+                    update.effective_chat.id,
+                    get_message('message_not_found', lang),
+                    reply_markup=get_admin_main_keyboard(lang)
+                )
+
+        # Сценарий 2: Ответ на последнее неотвеченное сообщение
+        # Scenario 2: Reply to latest unanswered message
+        elif 'user_id' in reply_data:
+            user_id = reply_data['user_id']
+            user_lang = await get_user_language(user_id)
+            message_id = await get_last_unanswered_message_id(user_id)
+
+            if message_id is not None:
+                await save_reply(message_id, reply_text)
+
+                # Ответ пользователю обгоняет рассылки и уведомления /
+                # The reply to the user overtakes broadcasts and notifications
+                await send_message_safe(
+                    context.bot,
+                    user_id,
+                    get_message('admin_reply', user_lang, text=reply_text),
+                    priority=PRIORITY_HIGH,
+                    parse_mode='Markdown'
+                )
+
+                await send_message_safe(
+                    context.bot,
+                    update.effective_chat.id,
+                    get_message('admin_reply_sent', lang),
+                    reply_markup=get_admin_main_keyboard(lang)
+                )
+
+            else:
+                await send_message_safe(
+                    context.bot,
+                    update.effective_chat.id,
+                    get_message('no_unanswered', lang),
+                    reply_markup=get_admin_main_keyboard(lang)
+                )
 
     except Exception as e:
-        logger.error(f'Error sending response: {e}')
+        logger.error('Error sending response: %s', e)
         await send_message_safe(
             context.bot,
             update.effective_chat.id,
@@ -1,9 +1,58 @@
-from typing import List, Union
+from functools import lru_cache
+from typing import Any, List, Union
 from telegram import (
     KeyboardButton, ReplyKeyboardMarkup,
     InlineKeyboardButton, InlineKeyboardMarkup
 )
-from config import get_message, LOCALES
+from config import get_message, LOCALES, KEYBOARD_CACHE_SIZE
+from metrics import register_cache
+
+
+class CachedInlineKeyboardMarkup(InlineKeyboardMarkup):
+    """
+    Неизменяемая инлайн-клавиатура с заранее сериализованным JSON.
+    Immutable inline keyboard with precomputed serialized JSON.
+    """
+    __slots__ = ('_json',)
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        with self._unfrozen():
+            self._json = self.to_json()
+
+    @property
+    def json(self) -> str:
+        return self._json
+
+
+class CachedReplyKeyboardMarkup(ReplyKeyboardMarkup):
+    """
+    Неизменяемая клавиатура ответа с заранее сериализованным JSON.
+    Immutable reply keyboard with precomputed serialized JSON.
+    """
+    __slots__ = ('_json',)
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        with self._unfrozen():
+            self._json = self.to_json()
+
+    @property
+    def json(self) -> str:
+        return self._json
+
+
+def serialize_markup(markup: Any) -> Any:
+    """
+    Возвращает готовый JSON для закэшированной клавиатуры, чтобы её не
+    сериализовать при каждой отправке. Остальное возвращается как есть.
+    Returns the ready JSON for a cached keyboard so it is not serialized on
+    every send. Anything else is returned as is.
+    """
+    if isinstance(markup, (CachedInlineKeyboardMarkup,
+                           CachedReplyKeyboardMarkup)):
+        return markup.json
+    return markup
 
 
 def add_back_button(keyboard: List[List[InlineKeyboardButton]],
@@ -26,6 +75,7 @@ def add_back_button(keyboard: List[List[InlineKeyboardButton]],
     return keyboard
 
 
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
 def get_message_type_keyboard(lang: str = 'ru') -> ReplyKeyboardMarkup:
     """
     Создает клавиатуру с типами сообщений для обычных пользователей.
@@ -40,13 +90,14 @@ def get_message_type_keyboard(lang: str = 'ru') -> ReplyKeyboardMarkup:
                                     subkey='message')['button'])],
         [KeyboardButton(get_message('change_language', lang))]
     ]
-    return ReplyKeyboardMarkup(
+    return CachedReplyKeyboardMarkup(
         buttons,
         resize_keyboard=True,
         one_time_keyboard=True
     )
 
 
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
 def get_admin_main_keyboard(lang: str = 'ru') -> InlineKeyboardMarkup:
     """
     Создает главную инлайн-клавиатуру для администратора.
@@ -66,9 +117,10 @@ def get_admin_main_keyboard(lang: str = 'ru') -> InlineKeyboardMarkup:
             callback_data='change_language'
         )]
     ]
-    return InlineKeyboardMarkup(keyboard)
+    return CachedInlineKeyboardMarkup(keyboard)
 
 
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
 def get_unanswered_message_keyboard(message_id: Union[int, str],
                                     lang: str = 'ru') -> InlineKeyboardMarkup:
     """
@@ -81,9 +133,10 @@ def get_unanswered_message_keyboard(message_id: Union[int, str],
             callback_data=f'reply_msg_{message_id}'
         )],
     ]
-    return InlineKeyboardMarkup(add_back_button(keyboard, lang))
+    return CachedInlineKeyboardMarkup(add_back_button(keyboard, lang))
 
 
+@lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
 def get_language_keyboard(lang: str = 'ru') -> InlineKeyboardMarkup:
     """
     Создает клавиатуру для выбора языка.
@@ -96,4 +149,12 @@ def get_language_keyboard(lang: str = 'ru') -> InlineKeyboardMarkup:
             name,
             callback_data=f'set_lang_{code}'
         )])
-    return InlineKeyboardMarkup(keyboard)
+    return CachedInlineKeyboardMarkup(keyboard)
+
+
+# Статистика кэшей клавиатур для метрик / Keyboard cache statistics for
+# metrics
+for _keyboard in (get_message_type_keyboard, get_admin_main_keyboard,
+                  get_unanswered_message_keyboard, get_language_keyboard):
+    register_cache(_keyboard.__name__,
+                   lambda keyboard=_keyboard: keyboard.cache_info()._asdict())
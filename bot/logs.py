@@ -0,0 +1,105 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import time
+from typing import List, Optional
+
+
+class RotatingLogFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Файл журнала, сменяемый и по размеру, и по времени: когда он превышает
+    max_bytes или когда с последней смены прошло interval секунд. Хранится
+    backup_count старых файлов (bot.log.1, bot.log.2, ...).
+    Log file rotated both by size and by time: when it exceeds max_bytes or
+    when interval seconds have passed since the last rotation. backup_count
+    old files are kept (bot.log.1, bot.log.2, ...).
+    """
+
+    def __init__(self, filename: str, max_bytes: int, interval: float,
+                 backup_count: int) -> None:
+        super().__init__(filename, maxBytes=max_bytes,
+                         backupCount=backup_count, encoding='utf-8',
+                         delay=True)
+        self._interval = interval
+        self._rollover_at = time.time() + interval
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self._interval and time.time() >= self._rollover_at:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self) -> None:
+        super().doRollover()
+        self._rollover_at = time.time() + self._interval
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Запись журнала одной строкой JSON: время, уровень, логгер, сообщение и,
+    если есть, исключение.
+    A log record as one JSON line: time, level, logger, message and the
+    exception if any.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Кладёт запись в очередь как есть: подстановка аргументов, форматирование
+    и запись в файл выполняются в потоке QueueListener, а не в вызывающем.
+    Puts the record into the queue as is: argument substitution, formatting
+    and the file write run on the QueueListener thread, not the caller's.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging(filename: str, level: int, log_format: str,
+                  max_bytes: int, interval: float, backup_count: int,
+                  json_lines: bool = False) -> None:
+    """
+    Направляет журнал через очередь в фоновый поток, который пишет в
+    сменяемый файл (текстом или строками JSON) и в консоль.
+    Routes logging through a queue to a background thread that writes to a
+    rotated file (as text or JSON lines) and to the console.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    file_handler = RotatingLogFileHandler(filename, max_bytes, interval,
+                                          backup_count)
+    file_handler.setFormatter(JsonFormatter() if json_lines
+                              else logging.Formatter(log_format))
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(log_format))
+    handlers: List[logging.Handler] = [file_handler, console_handler]
+
+    # Очередь без ограничения: вызывающий поток никогда не ждёт запись /
+    # An unbounded queue: the calling thread never waits for a write
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(DeferredQueueHandler(log_queue))
+
+    _listener = logging.handlers.QueueListener(log_queue, *handlers)
+    _listener.start()
+    # Остаток очереди записывается при выходе / The rest of the queue is
+    # written on exit
+    atexit.register(_listener.stop)
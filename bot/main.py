@@ -1,25 +1,194 @@
+import argparse
+import asyncio
+import secrets
+import signal
+from typing import List
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters, CallbackQueryHandler
 )
-from config import YOUR_CHAT_ID, TELEGRAM_BOT_TOKEN
+from config import (
+    logger, YOUR_CHAT_ID, TELEGRAM_BOT_TOKEN, BOT_MODE, CONCURRENT_UPDATES,
+    WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_URL_PATH, WEBHOOK_URL,
+    WEBHOOK_SECRET_TOKEN, WEBHOOK_MAX_CONNECTIONS, METRICS_LISTEN,
+    METRICS_PORT, DB_PROFILE_TOP, PERSISTENCE_ENABLED,
+    PERSISTENCE_UPDATE_INTERVAL, PERSISTENCE_SHARED, SEARCH_BACKFILL_CHUNK,
+    SEARCH_BACKFILL_PAUSE, ARCHIVE_AFTER_DAYS, ARCHIVE_CHUNK, ARCHIVE_INTERVAL,
+    ARCHIVE_PAUSE, ARCHIVE_VACUUM_PAGES, ACTIVE_USERS_RECONCILE_INTERVAL
+)
+import async_database
+from database import init_db, warm_user_cache, load_active_users
+from sender import outbox
+from broadcast import broadcaster
+from metrics import start_http_server, QUEUE_DEPTH
+from profiler import log_statement_stats
+from persistence import SQLitePersistence
 from handlers import (
-    start, set_language, language_callback, handle_admin_callback,
-    handle_admin_reply, handle_user_message
+    start, set_language, sqlstats, stats, search, export_history, broadcast,
+    language_callback, handle_admin_callback, handle_admin_reply,
+    handle_user_message, wait_admin_notifications
 )
 
 
-def main() -> None:
+def parse_args() -> argparse.Namespace:
     """
-    Основная функция запуска Telegram бота.
-    The main function of launching a Telegram bot.
+    Разбор аргументов командной строки.
+    Parsing command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Telegram feedback bot')
+    parser.add_argument('--mode', choices=['polling', 'webhook'],
+                        default=BOT_MODE,
+                        help='how to receive updates (default: %(default)s)')
+    parser.add_argument('--listen', default=WEBHOOK_LISTEN,
+                        help='webhook listen address')
+    parser.add_argument('--port', type=int, default=WEBHOOK_PORT,
+                        help='webhook listen port')
+    parser.add_argument('--webhook-url', default=WEBHOOK_URL,
+                        help='public URL that Telegram posts updates to')
+    parser.add_argument('--max-connections', type=int,
+                        default=WEBHOOK_MAX_CONNECTIONS,
+                        help='max simultaneous webhook connections (1-100)')
+    parser.add_argument('--metrics-port', type=int, default=METRICS_PORT,
+                        help='serve Prometheus metrics on this port')
+    return parser.parse_args()
+
+
+# Фоновые задачи, отменяемые при остановке / Background tasks cancelled on
+# shutdown
+_background_tasks: List[asyncio.Task] = []
+
+
+async def backfill_search_index() -> None:
+    """
+    Постепенно добавляет старые сообщения и ответы в поисковый индекс,
+    небольшими транзакциями, чтобы не блокировать запись надолго.
+    Gradually adds old messages and replies to the search index in small
+    transactions so that writes are not blocked for long.
+    """
+    try:
+        while await async_database.backfill_search_index(
+                SEARCH_BACKFILL_CHUNK):
+            await asyncio.sleep(SEARCH_BACKFILL_PAUSE)
+    except Exception as e:
+        logger.error('Search index backfill failed: %s', e)
+
+
+async def archive_old_messages() -> None:
+    """
+    Периодически переносит старые отвеченные сообщения в архив небольшими
+    порциями и затем освобождает место в файле базы данных.
+    Periodically moves old answered messages to the archive in small chunks
+    and then frees space in the database file.
     """
-    # Создание приложения бота с указанным токеном / Create a bot application
-    # with the specified token
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    while True:
+        try:
+            moved = 0
+            while True:
+                count = await async_database.archive_messages(
+                    ARCHIVE_AFTER_DAYS, ARCHIVE_CHUNK)
+                moved += count
+                if count < ARCHIVE_CHUNK:
+                    break
+                await asyncio.sleep(ARCHIVE_PAUSE)
+
+            if moved:
+                logger.info('Archived %d answered messages', moved)
+                while await async_database.incremental_vacuum(
+                        ARCHIVE_VACUUM_PAGES):
+                    await asyncio.sleep(ARCHIVE_PAUSE)
+        except Exception as e:
+            logger.error('Archiving failed: %s', e)
+
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+
+async def reconcile_active_users() -> None:
+    """
+    Периодически сверяет множество пользователей с активным сообщением с
+    базой; расхождение записывается в журнал и исправляется.
+    Periodically reconciles the set of users with an active message with the
+    database; drift is logged and corrected.
+    """
+    while True:
+        await asyncio.sleep(ACTIVE_USERS_RECONCILE_INTERVAL)
+        try:
+            await async_database.reconcile_active_users()
+        except Exception as e:
+            logger.error('Active user reconciliation failed: %s', e)
+
+
+async def post_init(application: Application) -> None:
+    """
+    Настройка цикла событий после запуска бота.
+    Setting up the event loop after the bot starts.
+    """
+    # SIGUSR1 выводит статистику SQL-запросов в журнал / SIGUSR1 dumps the
+    # SQL statement stats to the log
+    if hasattr(signal, 'SIGUSR1'):
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGUSR1, log_statement_stats, DB_PROFILE_TOP)
+
+    _background_tasks.append(asyncio.create_task(
+        backfill_search_index(), name='search-backfill'))
+    if ARCHIVE_AFTER_DAYS is not None:
+        _background_tasks.append(asyncio.create_task(
+            archive_old_messages(), name='archive'))
+    _background_tasks.append(asyncio.create_task(
+        reconcile_active_users(), name='active-users'))
+
+    # Рассылки, прерванные перезапуском, продолжаются / Broadcasts
+    # interrupted by a restart are resumed
+    await broadcaster.resume(application.bot)
+
+
+async def post_shutdown(application: Application) -> None:
+    """
+    Остановка фоновых задач при завершении работы бота.
+    Stopping background tasks when the bot shuts down.
+    """
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+
+    await broadcaster.stop()
+    await wait_admin_notifications()
+    await outbox.stop()
+    await async_database.shutdown()
+
+
+def build_application() -> Application:
+    """
+    Создание приложения бота и регистрация обработчиков.
+    Creating the bot application and registering handlers.
+    """
+    # Создание приложения бота с указанным токеном и параллельной обработкой
+    # обновлений / Create a bot application with the specified token and
+    # concurrent update processing
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+
+    # Состояние диалогов переживает перезапуск / Conversation state
+    # survives a restart
+    if PERSISTENCE_ENABLED:
+        builder.persistence(SQLitePersistence(
+            update_interval=PERSISTENCE_UPDATE_INTERVAL,
+            shared=PERSISTENCE_SHARED
+        ))
+    application = builder.build()
 
     # Регистрация обработчиков / Registering handlers
     application.add_handler(CommandHandler('start', start))
     application.add_handler(CommandHandler('language', set_language))
+    application.add_handler(CommandHandler('sqlstats', sqlstats))
+    application.add_handler(CommandHandler('stats', stats))
+    application.add_handler(CommandHandler('search', search))
+    application.add_handler(CommandHandler('export', export_history))
+    application.add_handler(CommandHandler('broadcast', broadcast))
     application.add_handler(CallbackQueryHandler(language_callback,
                                                  pattern='^set_lang_'))
     application.add_handler(CallbackQueryHandler(handle_admin_callback))
@@ -30,9 +199,59 @@ def main() -> None:
         filters.TEXT & ~filters.COMMAND & ~filters.Chat(YOUR_CHAT_ID),
         handle_user_message))
 
-    # Запуск бота в режиме постоянного опроса серверов Telegram / Launching
-    # a bot in continuous polling mode for Telegram servers
-    application.run_polling()
+    return application
+
+
+def run_webhook(application: Application, args: argparse.Namespace) -> None:
+    """
+    Запуск бота с локальным HTTP-сервером для приёма вебхуков.
+    Launching the bot with a local HTTP server receiving webhooks.
+    """
+    # Без заданного секрета генерируется случайный на время работы /
+    # Without a configured secret a random one is generated for this run
+    secret_token = WEBHOOK_SECRET_TOKEN or secrets.token_urlsafe(32)
+    if not WEBHOOK_SECRET_TOKEN:
+        logger.warning('WEBHOOK_SECRET_TOKEN is not set, using a random one')
+
+    logger.info('Starting webhook server on %s:%s', args.listen, args.port)
+    application.run_webhook(
+        listen=args.listen,
+        port=args.port,
+        url_path=WEBHOOK_URL_PATH,
+        webhook_url=args.webhook_url,
+        secret_token=secret_token,
+        max_connections=args.max_connections
+    )
+
+
+def main() -> None:
+    """
+    Основная функция запуска Telegram бота.
+    The main function of launching a Telegram bot.
+    """
+    args = parse_args()
+
+    # Схема базы данных доводится до текущей версии / The database schema
+    # is brought up to the current version
+    init_db()
+
+    # Прогрев кэша пользователей и загрузка активных / Warming up the user
+    # cache and loading the active users
+    warm_user_cache()
+    load_active_users()
+
+    application = build_application()
+    QUEUE_DEPTH.set_function(application.update_queue.qsize, 'updates')
+
+    if args.metrics_port:
+        start_http_server(METRICS_LISTEN, args.metrics_port)
+
+    if args.mode == 'webhook':
+        run_webhook(application, args)
+    else:
+        # Запуск бота в режиме постоянного опроса серверов Telegram /
+        # Launching a bot in continuous polling mode for Telegram servers
+        application.run_polling()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,318 @@
+import asyncio
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+from config import logger
+
+
+# Границы корзин гистограмм задержек в секундах / Latency histogram bucket
+# bounds in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = (str(value).replace('\\', '\\\\').replace('"', '\\"')
+                 .replace('\n', '\\n'))
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric:
+    """
+    Базовая метрика: значения по наборам меток и функции, вычисляемые при
+    чтении.
+    Base metric: values per label set and functions evaluated on scrape.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values: Dict[LabelValues, float] = {}
+        self._functions: Dict[LabelValues, Callable[[], float]] = {}
+
+    def set_function(self, function: Callable[[], float],
+                     *label_values: str) -> None:
+        """
+        Значение будет вычисляться функцией при каждом чтении метрик.
+        The value will be computed by the function on every scrape.
+        """
+        self._functions[label_values] = function
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        for label_values, function in self._functions.items():
+            try:
+                values[label_values] = function()
+            except Exception as e:
+                logger.error('Metric %s callback failed: %s', self.name, e)
+        return [
+            f'{self.name}{_format_labels(self.labels, label_values)} '
+            f'{_format_value(value)}'
+            for label_values, value in sorted(values.items())
+        ]
+
+
+class Counter(_Metric):
+    """
+    Монотонно растущий счётчик.
+    Monotonically increasing counter.
+    """
+    kind = 'counter'
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_values] = (self._values.get(label_values, 0)
+                                          + amount)
+
+
+class Gauge(_Metric):
+    """
+    Значение, которое может расти и уменьшаться.
+    A value that can go up and down.
+    """
+    kind = 'gauge'
+
+    def set(self, value: float, *label_values: str) -> None:
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(_Metric):
+    """
+    Гистограмма с фиксированными корзинами.
+    Histogram with fixed buckets.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Для каждого набора меток: счётчики корзин (последняя - +Inf),
+        # сумма и количество / For each label set: bucket counts (the last
+        # one is +Inf), sum and count
+        self._series: Dict[LabelValues, List[Any]] = {}
+
+    def observe(self, value: float, *label_values: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._series[label_values] = series
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            series = {key: ([*counts], total, count)
+                      for key, (counts, total, count) in self._series.items()}
+
+        lines = []
+        names = self.labels + ('le',)
+        for label_values, (counts, total, count) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),),
+                                           counts):
+                cumulative += bucket_count
+                labels = _format_labels(
+                    names, label_values + (_format_value(bound),))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Registry:
+    """
+    Набор метрик, отдаваемый в текстовом формате Prometheus.
+    A set of metrics exposed in the Prometheus text format.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> Any:
+        if metric.name in self._metrics:
+            raise ValueError(f'Duplicate metric {metric.name}')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str,
+                labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str,
+              labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str,
+                  labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labels,
+                                        buckets))
+
+    def render(self) -> str:
+        """
+        Возвращает все метрики в текстовом формате Prometheus.
+        Returns all metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.histogram(
+    'bot_handler_duration_seconds', 'Update handler latency', ('handler',))
+HANDLER_ERRORS = REGISTRY.counter(
+    'bot_handler_errors_total', 'Exceptions raised by update handlers',
+    ('handler',))
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    'bot_db_query_duration_seconds', 'Database function latency',
+    ('function',))
+DB_WRITE_BATCH_SIZE = REGISTRY.histogram(
+    'bot_db_write_batch_size', 'Write operations per group commit', (),
+    (1, 2, 5, 10, 20, 50, 100, 200))
+SEND_SECONDS = REGISTRY.histogram(
+    'bot_send_duration_seconds',
+    'Outgoing Telegram request latency including queueing', ('method',))
+SEND_ERRORS = REGISTRY.counter(
+    'bot_send_errors_total', 'Failed outgoing Telegram requests',
+    ('method', 'error'))
+ADMIN_NOTIFY_FAILURES = REGISTRY.counter(
+    'bot_admin_notify_failures_total',
+    'New message notifications that did not reach the admin', ('error',))
+RATE_LIMITED = REGISTRY.counter(
+    'bot_rate_limited_total', 'Updates rejected by the per-user rate limit',
+    ('handler',))
+QUEUE_DEPTH = REGISTRY.gauge(
+    'bot_queue_depth', 'Items waiting in internal queues', ('queue',))
+OUTBOX_SENDS = REGISTRY.counter(
+    'bot_outbox_sends_total', 'Outbound queue jobs by result', ('result',))
+OUTBOX_CHATS = REGISTRY.gauge(
+    'bot_outbox_chats', 'Chats with jobs waiting in the outbound queue')
+OUTBOX_LATENCY = REGISTRY.gauge(
+    'bot_outbox_latency_seconds',
+    'Outbound queue latency over the recent jobs', ('quantile',))
+CACHE_HITS = REGISTRY.counter(
+    'bot_cache_hits_total', 'Cache hits', ('cache',))
+CACHE_MISSES = REGISTRY.counter(
+    'bot_cache_misses_total', 'Cache misses', ('cache',))
+CACHE_HIT_RATIO = REGISTRY.gauge(
+    'bot_cache_hit_ratio', 'Cache hits divided by lookups', ('cache',))
+
+
+def register_cache(name: str, stats: Callable[[], Dict[str, int]]) -> None:
+    """
+    Регистрирует кэш: stats() должна возвращать словарь с hits и misses.
+    Registers a cache: stats() must return a dict with hits and misses.
+    """
+    def ratio() -> float:
+        values = stats()
+        lookups = values['hits'] + values['misses']
+        return values['hits'] / lookups if lookups else 0.0
+
+    CACHE_HITS.set_function(lambda: stats()['hits'], name)
+    CACHE_MISSES.set_function(lambda: stats()['misses'], name)
+    CACHE_HIT_RATIO.set_function(ratio, name)
+
+
+def timed(histogram: Histogram,
+          errors: Optional[Counter] = None) -> Callable[[Callable], Callable]:
+    """
+    Декоратор: записывает время выполнения функции (обычной или
+    асинхронной) в гистограмму с меткой по имени функции.
+    Decorator: records the run time of a function (plain or async) into the
+    histogram labelled with the function name.
+    """
+    def decorator(func: Callable) -> Callable:
+        label = func.__name__.lstrip('_')
+
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc(label)
+                    raise
+                finally:
+                    histogram.observe(time.perf_counter() - started, label)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(label)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, label)
+        return wrapper
+
+    return decorator
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type',
+                         'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+def start_http_server(listen: str, port: int) -> ThreadingHTTPServer:
+    """
+    Запускает HTTP-сервер метрик (/metrics) в фоновом потоке.
+    Starts the metrics HTTP server (/metrics) in a background thread.
+    """
+    server = ThreadingHTTPServer((listen, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics-http', daemon=True)
+    thread.start()
+    logger.info('Metrics available at http://%s:%s/metrics', listen, port)
+    return server
@@ -0,0 +1,480 @@
+import sqlite3
+from typing import Callable, Dict, List
+from config import logger
+
+
+# Таблицы с полнотекстовым поиском и их индексируемые столбцы / Tables with
+# full-text search and their indexed columns
+SEARCH_SOURCES = {'messages': 'message_text', 'replies': 'reply_text'}
+
+# Верхние границы корзин гистограммы времени ответа в секундах; последняя
+# корзина - всё, что дольше. Изменение требует новой миграции, пересчитывающей
+# гистограмму / Upper bounds of the response time histogram buckets in
+# seconds; the last bucket is everything slower. Changing them requires a new
+# migration rebuilding the histogram
+RESPONSE_TIME_BOUNDS = (60, 300, 900, 1800, 3600, 3 * 3600, 6 * 3600,
+                        12 * 3600, 86400, 2 * 86400, 7 * 86400)
+
+Migration = Callable[[sqlite3.Cursor], None]
+
+
+def response_time_bucket(replied_at: str, created_at: str) -> str:
+    """
+    SQL-выражение номера корзины гистограммы для времени ответа между двумя
+    метками времени.
+    SQL expression of the histogram bucket number for the response time
+    between two timestamps.
+    """
+    seconds = f'(julianday({replied_at}) - julianday({created_at})) * 86400'
+    cases = ' '.join(f'WHEN {seconds} <= {bound} THEN {number}'
+                     for number, bound in enumerate(RESPONSE_TIME_BOUNDS))
+    return f'CASE {cases} ELSE {len(RESPONSE_TIME_BOUNDS)} END'
+
+
+def _create_search_index(cursor: sqlite3.Cursor) -> None:
+    """
+    Создаёт индексы FTS5 над текстами сообщений и ответов с триггерами.
+    Строки, существовавшие до создания, добавляются в индекс постепенно
+    (см. database._backfill_search_index); пока строка не добавлена,
+    триггеры её не трогают.
+    Creates FTS5 indexes over message and reply texts with triggers. Rows
+    that existed before are added to the index gradually (see
+    database._backfill_search_index); triggers leave a row alone until it
+    is added.
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS search_backfill (
+        source TEXT PRIMARY KEY,
+        next_id INTEGER NOT NULL,
+        end_id INTEGER NOT NULL
+    )
+    ''')
+
+    for source, column in SEARCH_SOURCES.items():
+        pending = f'''
+        NOT EXISTS (SELECT 1 FROM search_backfill WHERE source = '{source}'
+                    AND old.id BETWEEN next_id AND end_id)'''
+
+        cursor.execute(f'''
+        CREATE VIRTUAL TABLE {source}_fts USING fts5(
+            {column}, content='{source}', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        ''')
+        cursor.execute(f'''
+        CREATE TRIGGER {source}_fts_insert AFTER INSERT ON {source} BEGIN
+            INSERT INTO {source}_fts (rowid, {column})
+            VALUES (new.id, new.{column});
+        END
+        ''')
+        cursor.execute(f'''
+        CREATE TRIGGER {source}_fts_delete AFTER DELETE ON {source}
+        WHEN {pending}
+        BEGIN
+            INSERT INTO {source}_fts ({source}_fts, rowid, {column})
+            VALUES ('delete', old.id, old.{column});
+        END
+        ''')
+        cursor.execute(f'''
+        CREATE TRIGGER {source}_fts_update AFTER UPDATE OF {column}
+        ON {source} WHEN {pending}
+        BEGIN
+            INSERT INTO {source}_fts ({source}_fts, rowid, {column})
+            VALUES ('delete', old.id, old.{column});
+            INSERT INTO {source}_fts (rowid, {column})
+            VALUES (new.id, new.{column});
+        END
+        ''')
+        cursor.execute(f'''
+        INSERT INTO search_backfill (source, next_id, end_id)
+        SELECT '{source}', MIN(id), MAX(id) FROM {source}
+        HAVING COUNT(*) > 0
+        ''')
+
+
+def _initial_schema(cursor: sqlite3.Cursor) -> None:
+    """
+    Схема на момент появления миграций. Базы, созданные раньше, имеют
+    версию 0 и уже содержат часть объектов, поэтому все операторы
+    идемпотентны.
+    The schema as of the introduction of migrations. Databases created
+    earlier have version 0 and already contain some of the objects, so all
+    statements are idempotent.
+    """
+    # Таблица "пользователи" / Table "users"
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        language TEXT DEFAULT 'ru',
+        has_active_message BOOLEAN DEFAULT FALSE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        is_blocked BOOLEAN DEFAULT FALSE
+    )
+    ''')
+
+    # Столбец is_blocked в базах, созданных до рассылок / The is_blocked
+    # column in databases created before broadcasts
+    cursor.execute('PRAGMA table_info(users)')
+    if 'is_blocked' not in {row[1] for row in cursor.fetchall()}:
+        cursor.execute('''
+        ALTER TABLE users ADD COLUMN is_blocked BOOLEAN DEFAULT FALSE
+        ''')
+
+    # Таблица "сообщения" / Table "messages"
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        message_type TEXT,
+        message_text TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        is_answered BOOLEAN DEFAULT FALSE,
+        FOREIGN KEY (user_id) REFERENCES users (user_id)
+    )
+    ''')
+
+    # Таблица "ответы" / Table "replies"
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS replies (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message_id INTEGER,
+        reply_text TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (message_id) REFERENCES messages (id)
+    )
+    ''')
+
+    # Индексы для оптимизации / Indexes for optimization
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_users_user_id
+                   ON users(user_id)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_messages_user_id
+                   ON messages(user_id)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_messages_created_at
+                   ON messages(created_at)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_replies_message_id
+                   ON replies(message_id)
+    ''')
+
+    # Частичный индекс только по неотвеченным сообщениям заменяет
+    # индекс по is_answered / A partial index over unanswered messages
+    # only replaces the index on is_answered
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_messages_unanswered
+                   ON messages(created_at) WHERE is_answered = FALSE
+    ''')
+    cursor.execute('DROP INDEX IF EXISTS idx_messages_is_answered')
+
+    # Индексы для постраничного просмотра истории / Indexes for paging
+    # through the history
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_users_first_name
+                   ON users(COALESCE(first_name, ''), user_id)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_messages_user_created
+                   ON messages(user_id, created_at)
+    ''')
+
+    # Состояние диалогов (user_data/chat_data), по строке на ключ /
+    # Conversation state (user_data/chat_data), one row per key
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS persistence (
+        kind TEXT NOT NULL,
+        key INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        version INTEGER NOT NULL DEFAULT 1,
+        PRIMARY KEY (kind, key)
+    ) WITHOUT ROWID
+    ''')
+
+    # Рассылки и состояние доставки каждому получателю; необработанные
+    # получатели служат точкой продолжения после перезапуска /
+    # Broadcasts and the delivery state of every recipient; pending
+    # recipients are the checkpoint to resume from after a restart
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'running',
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        broadcast_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        error TEXT,
+        PRIMARY KEY (broadcast_id, user_id)
+    ) WITHOUT ROWID
+    ''')
+
+    # Полнотекстовый поиск / Full-text search
+    cursor.execute('''
+    SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'
+    ''')
+    if cursor.fetchone() is None:
+        _create_search_index(cursor)
+
+
+def _drop_redundant_indexes(cursor: sqlite3.Cursor) -> None:
+    """
+    Удаляет индексы, дублирующие другие: users(user_id) повторяет
+    первичный ключ, а messages(user_id) - начало индекса
+    messages(user_id, created_at).
+    Drops indexes that duplicate others: users(user_id) repeats the primary
+    key, and messages(user_id) is a prefix of the messages(user_id,
+    created_at) index.
+    """
+    cursor.execute('DROP INDEX IF EXISTS idx_users_user_id')
+    cursor.execute('DROP INDEX IF EXISTS idx_messages_user_id')
+
+
+def _index_active_users(cursor: sqlite3.Cursor) -> None:
+    """
+    Частичный индекс по пользователям с активным сообщением: загрузка и
+    сверка множества активных читают только их.
+    A partial index over users with an active message: loading and
+    reconciling the active set read only those.
+    """
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_users_active
+                   ON users(user_id) WHERE has_active_message = TRUE
+    ''')
+
+
+def _create_stats_rollups(cursor: sqlite3.Cursor) -> None:
+    """
+    Сводные таблицы статистики: число сообщений и ответов по дням и типам и
+    гистограмма времени первого ответа по дням. Дальше они обновляются при
+    каждой записи, а здесь заполняются по существующей истории обоих уровней
+    хранения.
+    Statistics rollup tables: message and answer counts per day and type and
+    a per-day histogram of the first response time. They are updated on
+    every write from then on and are filled here from the existing history
+    of both storage tiers.
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stats_daily (
+        day TEXT NOT NULL,
+        message_type TEXT NOT NULL,
+        messages INTEGER NOT NULL DEFAULT 0,
+        answered INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, message_type)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stats_response_times (
+        day TEXT NOT NULL,
+        bucket INTEGER NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, bucket)
+    ) WITHOUT ROWID
+    ''')
+
+    # Архив есть, если его схема уже создана / The archive is there if its
+    # schema has already been created
+    messages = 'SELECT id, message_type, created_at FROM main.messages'
+    replies = 'SELECT message_id, created_at FROM main.replies'
+    cursor.execute('''
+    SELECT 1 FROM archive.sqlite_master WHERE name = 'messages'
+    ''')
+    if cursor.fetchone() is not None:
+        messages += '''
+        UNION ALL
+        SELECT id, message_type, created_at FROM archive.messages a
+        WHERE NOT EXISTS (SELECT 1 FROM main.messages h WHERE h.id = a.id)'''
+        replies += '''
+        UNION ALL
+        SELECT message_id, created_at FROM archive.replies a
+        WHERE NOT EXISTS (SELECT 1 FROM main.replies h WHERE h.id = a.id)'''
+
+    cursor.execute(f'''
+    INSERT INTO stats_daily (day, message_type, messages)
+    SELECT date(created_at), COALESCE(message_type, ''), COUNT(*)
+    FROM ({messages})
+    GROUP BY 1, 2
+    ''')
+    first_replies = f'''
+    WITH first_replies AS (
+        SELECT message_id, MIN(created_at) AS replied_at FROM ({replies})
+        GROUP BY message_id
+    )'''
+    cursor.execute(f'''
+    {first_replies}
+    INSERT INTO stats_daily (day, message_type, answered)
+    SELECT date(f.replied_at), COALESCE(m.message_type, ''), COUNT(*)
+    FROM first_replies f JOIN ({messages}) m ON m.id = f.message_id
+    WHERE true
+    GROUP BY 1, 2
+    ON CONFLICT (day, message_type) DO UPDATE SET answered = excluded.answered
+    ''')
+    bucket = response_time_bucket('f.replied_at', 'm.created_at')
+    cursor.execute(f'''
+    {first_replies}
+    INSERT INTO stats_response_times (day, bucket, count)
+    SELECT date(f.replied_at), {bucket}, COUNT(*)
+    FROM first_replies f JOIN ({messages}) m ON m.id = f.message_id
+    GROUP BY 1, 2
+    ''')
+
+
+def _initial_archive_schema(cursor: sqlite3.Cursor) -> None:
+    """
+    Таблицы архива в подключённом файле archive.
+    Archive tables in the attached archive file.
+    """
+    # Архив: отвеченные сообщения и ответы старше ARCHIVE_AFTER_DAYS /
+    # Archive: answered messages and replies older than
+    # ARCHIVE_AFTER_DAYS
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS archive.messages (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        message_type TEXT,
+        message_text TEXT,
+        created_at TIMESTAMP,
+        is_answered BOOLEAN
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS archive.replies (
+        id INTEGER PRIMARY KEY,
+        message_id INTEGER,
+        reply_text TEXT,
+        created_at TIMESTAMP
+    )
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS archive.idx_archive_messages_user_created
+                   ON messages(user_id, created_at)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS archive.idx_archive_replies_message_id
+                   ON replies(message_id)
+    ''')
+
+
+def _create_archive_search_index(cursor: sqlite3.Cursor) -> None:
+    """
+    Индексы FTS5 над текстами архива, чтобы поиск находил и перенесённые
+    сообщения. Строки архива только добавляются, поэтому достаточно
+    триггера на вставку. Уже перенесённые строки добавляются в индекс
+    постепенно, как и в основной базе; своя таблица search_backfill нужна
+    потому, что триггер архива видит только таблицы архива.
+    FTS5 indexes over the archive texts so that search also finds moved
+    messages. Archive rows are only ever inserted, so an insert trigger is
+    enough. Rows moved earlier are added to the index gradually, as in the
+    main database; the archive has its own search_backfill table because
+    an archive trigger only sees archive tables.
+    """
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS archive.search_backfill (
+        source TEXT PRIMARY KEY,
+        next_id INTEGER NOT NULL,
+        end_id INTEGER NOT NULL
+    )
+    ''')
+
+    for source, column in SEARCH_SOURCES.items():
+        cursor.execute(f'''
+        CREATE VIRTUAL TABLE archive.{source}_fts USING fts5(
+            {column}, content='{source}', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        ''')
+        # Перенос старого сообщения может попасть в ещё не проиндексированный
+        # диапазон, его добавит дозаполнение / Moving an old message may land
+        # in the range not indexed yet, the backfill adds it
+        cursor.execute(f'''
+        CREATE TRIGGER archive.{source}_fts_insert AFTER INSERT ON {source}
+        WHEN NOT EXISTS (SELECT 1 FROM search_backfill
+                         WHERE source = '{source}'
+                         AND new.id BETWEEN next_id AND end_id)
+        BEGIN
+            INSERT INTO {source}_fts (rowid, {column})
+            VALUES (new.id, new.{column});
+        END
+        ''')
+        cursor.execute(f'''
+        INSERT INTO archive.search_backfill (source, next_id, end_id)
+        SELECT '{source}', MIN(id), MAX(id) FROM archive.{source}
+        HAVING COUNT(*) > 0
+        ''')
+
+
+# Миграции по схемам в порядке применения; номер версии - позиция в списке,
+# начиная с 1. Применённые миграции не меняются, изменения схемы
+# добавляются новыми / Migrations per schema in the order they are applied;
+# the version number is the position in the list starting from 1. Applied
+# migrations never change, schema changes are added as new ones
+MIGRATIONS: Dict[str, List[Migration]] = {
+    'main': [
+        _initial_schema,
+        _drop_redundant_indexes,
+        _index_active_users,
+        _create_stats_rollups,
+    ],
+    'archive': [
+        _initial_archive_schema,
+        _create_archive_search_index,
+    ],
+}
+
+
+def _migrate_schema(conn: sqlite3.Connection, schema: str,
+                    migrations: List[Migration]) -> None:
+    """
+    Применяет к схеме недостающие миграции в одной транзакции.
+    Applies the missing migrations to a schema in one transaction.
+    """
+    target = len(migrations)
+    cursor = conn.cursor()
+    cursor.execute(f'PRAGMA {schema}.user_version')
+    if cursor.fetchone()[0] == target:
+        return
+
+    # Блокировка записи не даёт двум процессам применить миграции
+    # одновременно / The write lock keeps two processes from applying
+    # migrations at the same time
+    cursor.execute('BEGIN IMMEDIATE')
+    try:
+        cursor.execute(f'PRAGMA {schema}.user_version')
+        version = cursor.fetchone()[0]
+        if version > target:
+            raise RuntimeError(
+                f'The {schema} database has schema version {version}, '
+                f'newer than the supported {target}')
+
+        for number in range(version + 1, target + 1):
+            migration = migrations[number - 1]
+            migration(cursor)
+            logger.info('Applied %s migration %d: %s', schema, number,
+                        migration.__name__.lstrip('_'))
+        cursor.execute(f'PRAGMA {schema}.user_version = {target}')
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def migrate(conn: sqlite3.Connection) -> None:
+    """
+    Доводит все схемы до текущей версии. Если схема уже актуальна, DDL не
+    выполняется.
+    Brings all schemas up to the current version. If a schema is already
+    current, no DDL runs.
+    """
+    for schema, migrations in MIGRATIONS.items():
+        _migrate_schema(conn, schema, migrations)
@@ -0,0 +1,215 @@
+import json
+from typing import Any, Dict, Optional, Tuple
+from telegram.ext import BasePersistence, PersistenceInput
+from config import logger
+from async_database import (
+    load_persistent_data, get_newer_persistent_data, save_persistent_data,
+    delete_persistent_data
+)
+
+
+# Виды хранимых данных / Kinds of stored data
+USER_DATA = 'user'
+CHAT_DATA = 'chat'
+
+# Сколько раз повторять запись, если другой процесс успел изменить те же
+# данные / How many times to retry a write if another process changed the
+# same data first
+MAX_WRITE_ATTEMPTS = 3
+
+
+def _merge(base: Dict[str, Any], ours: Dict[str, Any],
+           theirs: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Трёхстороннее слияние по ключам верхнего уровня: ключи, которые этот
+    процесс изменил или удалил относительно base, берутся из ours, остальные
+    - из сохранённых другим процессом данных theirs.
+    Three-way merge by top-level keys: the keys this process changed or
+    removed relative to base are taken from ours, the rest from the data
+    theirs stored by another process.
+    """
+    merged = dict(theirs)
+    for name in base.keys() | ours.keys():
+        if name in ours and (name not in base or ours[name] != base[name]):
+            merged[name] = ours[name]
+        elif name not in ours:
+            merged.pop(name, None)
+    return merged
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Хранение user_data и chat_data в основной базе SQLite: по строке JSON на
+    пользователя или чат. Записываются только изменившиеся данные, а записи
+    от одного прохода сохранения объединяются групповой фиксацией.
+    С shared=True перед каждым обновлением данные перечитываются, если их
+    изменил другой процесс бота.
+    Stores user_data and chat_data in the main SQLite database: one JSON row
+    per user or chat. Only changed data is written, and the writes of one
+    persistence run are merged by the group commit. With shared=True the
+    data is re-read before every update if another bot process changed it.
+    """
+
+    def __init__(self, update_interval: float = 60,
+                 shared: bool = False) -> None:
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=True,
+                                        user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self._shared = shared
+        # Последние сохранённые JSON и версии по (вид, ключ) / The last
+        # stored JSON and versions by (kind, key)
+        self._snapshots: Dict[Tuple[str, int], str] = {}
+        self._versions: Dict[Tuple[str, int], int] = {}
+
+    async def _load(self, kind: str) -> Dict[int, Dict[str, Any]]:
+        """
+        Загружает все данные указанного вида.
+        Loads all data of the given kind.
+        """
+        result = {}
+        for key, (data, version) in (await load_persistent_data(kind)).items():
+            self._snapshots[(kind, key)] = data
+            self._versions[(kind, key)] = version
+            result[key] = json.loads(data)
+        return result
+
+    async def _update(self, kind: str, key: int, data: Dict[str, Any]) -> None:
+        """
+        Сохраняет данные, если они изменились с последней записи.
+        Stores the data if it changed since the last write.
+        """
+        if not data:
+            await self._drop(kind, key)
+            return
+
+        try:
+            serialized = json.dumps(data, sort_keys=True)
+        except (TypeError, ValueError) as e:
+            logger.error('Cannot persist %s data for %s: %s', kind, key, e)
+            return
+        if self._snapshots.get((kind, key)) == serialized:
+            return
+
+        # Запись проходит, только если с последнего чтения данные никто не
+        # менял; иначе изменения этого процесса сливаются со свежей версией
+        # / The write only succeeds if nobody changed the data since it was
+        # last read; otherwise this process's changes are merged into the
+        # fresh version
+        base = self._snapshots.get((kind, key))
+        version = self._versions.get((kind, key))
+        pending = serialized
+        for _ in range(MAX_WRITE_ATTEMPTS):
+            written = await save_persistent_data(kind, key, pending, version)
+            if written is not None:
+                break
+            stored = await get_newer_persistent_data(kind, key, 0)
+            theirs, version = (json.loads(stored[0]), stored[1]) \
+                if stored is not None else ({}, None)
+            pending = json.dumps(
+                _merge(json.loads(base) if base is not None else {},
+                       json.loads(pending), theirs),
+                sort_keys=True)
+            base = stored[0] if stored is not None else None
+        else:
+            logger.error('Cannot persist %s data for %s: changed by another '
+                         'process %d times in a row', kind, key,
+                         MAX_WRITE_ATTEMPTS)
+            return
+
+        self._snapshots[(kind, key)] = serialized
+        # После слияния в базе больше, чем в памяти: запоминается версия до
+        # слияния, чтобы следующее обновление перечитало итог / After a merge
+        # the database holds more than memory: the version before the merge
+        # is kept so that the next refresh re-reads the result
+        self._versions[(kind, key)] = \
+            written if pending == serialized else version
+
+    async def _drop(self, kind: str, key: int) -> None:
+        """
+        Удаляет сохранённые данные, если другой процесс их не изменил.
+        Deletes the stored data unless another process changed it.
+        """
+        if self._snapshots.pop((kind, key), None) is None:
+            return
+        version = self._versions.pop((kind, key), None)
+        if version is None or \
+                not await delete_persistent_data(kind, key, version):
+            logger.info('Kept %s data for %s: changed by another process',
+                        kind, key)
+
+    async def _refresh(self, kind: str, key: int,
+                       data: Dict[str, Any]) -> None:
+        """
+        Подменяет данные на месте, если другой процесс сохранил более новые.
+        Replaces the data in place if another process stored newer data.
+        """
+        if not self._shared:
+            return
+
+        newer = await get_newer_persistent_data(
+            kind, key, self._versions.get((kind, key), 0))
+        if newer is None:
+            return
+
+        serialized, version = newer
+        data.clear()
+        data.update(json.loads(serialized))
+        self._snapshots[(kind, key)] = serialized
+        self._versions[(kind, key)] = version
+
+    async def get_user_data(self) -> Dict[int, Dict[str, Any]]:
+        return await self._load(USER_DATA)
+
+    async def get_chat_data(self) -> Dict[int, Dict[str, Any]]:
+        return await self._load(CHAT_DATA)
+
+    async def get_bot_data(self) -> Dict[str, Any]:
+        return {}
+
+    async def get_callback_data(self) -> Optional[Any]:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[Any, Any]:
+        return {}
+
+    async def update_conversation(self, name: str, key: Any,
+                                  new_state: Optional[object]) -> None:
+        pass
+
+    async def update_user_data(self, user_id: int,
+                               data: Dict[str, Any]) -> None:
+        await self._update(USER_DATA, user_id, data)
+
+    async def update_chat_data(self, chat_id: int,
+                               data: Dict[str, Any]) -> None:
+        await self._update(CHAT_DATA, chat_id, data)
+
+    async def update_bot_data(self, data: Dict[str, Any]) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await self._drop(USER_DATA, user_id)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await self._drop(CHAT_DATA, chat_id)
+
+    async def refresh_user_data(self, user_id: int,
+                                user_data: Dict[str, Any]) -> None:
+        await self._refresh(USER_DATA, user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id: int,
+                                chat_data: Dict[str, Any]) -> None:
+        await self._refresh(CHAT_DATA, chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data: Dict[str, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        # Каждое обновление уже зафиксировано к моменту возврата /
+        # Every update is already committed by the time it returns
+        pass
@@ -0,0 +1,212 @@
+import itertools
+import re
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from config import logger, DB_SLOW_QUERY_MS
+
+
+class StatementStats:
+    """
+    Суммарная статистика выполнения SQL-запросов по их тексту.
+    Aggregate SQL statement run statistics keyed by statement text.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        # Для каждого запроса: количество, суммарное и максимальное время /
+        # For each statement: count, total and maximum time
+        self._stats: Dict[str, List[float]] = {}
+
+    def record(self, sql: str, elapsed: float) -> None:
+        with self._lock:
+            entry = self._stats.get(sql)
+            if entry is None:
+                self._stats[sql] = [1, elapsed, elapsed]
+            else:
+                entry[0] += 1
+                entry[1] += elapsed
+                if elapsed > entry[2]:
+                    entry[2] = elapsed
+
+    def extend(self, sql: str, elapsed: float, run_elapsed: float) -> None:
+        """
+        Добавляет время чтения строк к последнему выполнению запроса;
+        run_elapsed - полное время этого выполнения.
+        Adds row fetch time to the latest run of the statement; run_elapsed
+        is the full time of that run.
+        """
+        with self._lock:
+            entry = self._stats.get(sql)
+            if entry is None:
+                return
+            entry[1] += elapsed
+            if run_elapsed > entry[2]:
+                entry[2] = run_elapsed
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+    def top(self, limit: int) -> List[Tuple[str, int, float, float]]:
+        """
+        Возвращает самые затратные запросы по суммарному времени:
+        (запрос, количество, всего, максимум).
+        Returns the most expensive statements by total time:
+        (statement, count, total, max).
+        """
+        with self._lock:
+            rows = [(sql, int(count), total, longest)
+                    for sql, (count, total, longest) in self._stats.items()]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows[:limit]
+
+    def format(self, limit: int) -> str:
+        """
+        Форматирует самые затратные запросы в текстовую таблицу.
+        Formats the most expensive statements as a text table.
+        """
+        lines = []
+        for sql, count, total, longest in self.top(limit):
+            lines.append(f'{count:>7} x  total {total * 1000:>9.1f} ms  '
+                         f'max {longest * 1000:>7.1f} ms  {sql}')
+        return '\n'.join(lines)
+
+
+statement_stats = StatementStats()
+
+_whitespace = re.compile(r'\s+')
+
+
+def _normalize(sql: str) -> str:
+    return _whitespace.sub(' ', sql).strip()
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """
+    Курсор, замеряющий каждый запрос вместе с чтением его строк (SQLite
+    вычисляет строки по мере чтения) и записывающий медленные в журнал
+    вместе с планом выполнения.
+    Cursor that times every statement together with fetching its rows
+    (SQLite computes rows as they are fetched) and logs slow ones together
+    with their query plan.
+    """
+
+    def __init__(self, connection: sqlite3.Connection) -> None:
+        super().__init__(connection)
+        # Текущий запрос курсора и время его выполнения / The cursor's
+        # current statement and its run time
+        self._sql: Optional[str] = None
+        self._statement: Optional[str] = None
+        self._parameters: Any = ()
+        self._elapsed = 0.0
+        self._logged = False
+
+    def _profile(self, sql: str, parameters: Any, started: float) -> None:
+        self._sql = sql
+        self._statement = _normalize(sql)
+        self._parameters = parameters
+        self._elapsed = time.perf_counter() - started
+        self._logged = False
+        statement_stats.record(self._statement, self._elapsed)
+        self._log_if_slow()
+
+    def _log_if_slow(self) -> None:
+        if self._logged or self._elapsed * 1000 < DB_SLOW_QUERY_MS:
+            return
+        self._logged = True
+        logger.warning('Slow query (%.1f ms): %s\n%s', self._elapsed * 1000,
+                       self._statement,
+                       self._explain(self._sql, self._parameters))
+
+    def _fetch(self, fetch: Callable[..., Any], *args: Any) -> Any:
+        """
+        Читает строки, добавляя время чтения к текущему запросу.
+        Fetches rows adding the fetch time to the current statement.
+        """
+        started = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            if self._statement is not None:
+                elapsed = time.perf_counter() - started
+                self._elapsed += elapsed
+                statement_stats.extend(self._statement, elapsed,
+                                       self._elapsed)
+                self._log_if_slow()
+
+    def _explain(self, sql: str, parameters: Any) -> str:
+        """
+        Возвращает EXPLAIN QUERY PLAN для запроса.
+        Returns EXPLAIN QUERY PLAN for the statement.
+        """
+        if not sql.lstrip().upper().startswith(
+                ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE')):
+            return '  (no plan)'
+        try:
+            plan = sqlite3.Cursor.execute(
+                self.connection.cursor(), f'EXPLAIN QUERY PLAN {sql}',
+                parameters).fetchall()
+        except sqlite3.Error as e:
+            return f'  (plan unavailable: {e})'
+        return '\n'.join(f'  {row[-1]}' for row in plan) or '  (no plan)'
+
+    def execute(self, sql: str, parameters: Any = ()) -> 'ProfilingCursor':
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._profile(sql, parameters, started)
+
+    def executemany(self, sql: str,
+                    seq_of_parameters: Iterable[Any]) -> 'ProfilingCursor':
+        # План строится по первому набору параметров / The plan is built
+        # with the first parameter set
+        rows = iter(seq_of_parameters)
+        first = next(rows, None)
+        started = time.perf_counter()
+        try:
+            return super().executemany(
+                sql, itertools.chain([first], rows) if first is not None
+                else [])
+        finally:
+            self._profile(sql, () if first is None else first, started)
+
+    def fetchone(self) -> Any:
+        return self._fetch(super().fetchone)
+
+    def fetchmany(self, size: Optional[int] = None) -> List[Any]:
+        return self._fetch(super().fetchmany,
+                           self.arraysize if size is None else size)
+
+    def fetchall(self) -> List[Any]:
+        return self._fetch(super().fetchall)
+
+    def __next__(self) -> Any:
+        return self._fetch(super().__next__)
+
+
+class ProfilingConnection(sqlite3.Connection):
+    """
+    Соединение, все запросы которого идут через ProfilingCursor.
+    Connection whose statements all go through ProfilingCursor.
+    """
+
+    def cursor(self, factory: Any = ProfilingCursor) -> sqlite3.Cursor:
+        return super().cursor(factory)
+
+    def execute(self, sql: str, parameters: Any = ()) -> sqlite3.Cursor:
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str,
+                    seq_of_parameters: Iterable[Any]) -> sqlite3.Cursor:
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def log_statement_stats(limit: int = 20) -> None:
+    """
+    Записывает в журнал самые затратные запросы.
+    Logs the most expensive statements.
+    """
+    logger.info('SQL statement stats:\n%s', statement_stats.format(limit))
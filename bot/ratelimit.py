@@ -0,0 +1,145 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Set, Tuple
+
+
+class TokenBucket:
+    """
+    Корзина токенов: не больше rate операций в секунду со всплесками до
+    capacity.
+    Token bucket: at most rate operations per second with bursts up to
+    capacity.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.capacity,
+                               self._tokens + elapsed * self.rate)
+            self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """
+        Забирает токены, если они есть. Возвращает 0 при успехе, иначе
+        время в секундах до появления нужного количества токенов.
+        Takes tokens if available. Returns 0 on success, otherwise the time
+        in seconds until enough tokens are available.
+        """
+        self._refill(time.monotonic())
+        if self._tokens >= tokens:
+            self._tokens -= tokens
+            return 0.0
+        return (tokens - self._tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1) -> None:
+        """
+        Ожидает появления токенов и забирает их.
+        Waits until tokens are available and takes them.
+        """
+        delay = self.try_acquire(tokens)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.try_acquire(tokens)
+
+    def is_full(self) -> bool:
+        """
+        Проверяет, накопилась ли корзина полностью.
+        Checks whether the bucket has fully refilled.
+        """
+        self._refill(time.monotonic())
+        return self._tokens >= self.capacity
+
+    def drain(self, seconds: float) -> None:
+        """
+        Запрещает операции на указанное время (например, после RetryAfter).
+        Blocks operations for the given time (for example after RetryAfter).
+        """
+        now = time.monotonic()
+        self._refill(now)
+        # Через seconds секунд будет ровно один токен / After seconds
+        # seconds there will be exactly one token
+        self._tokens = min(self._tokens, 1.0) - seconds * self.rate
+
+
+class KeyedRateLimiter:
+    """
+    Отдельная корзина токенов на каждый ключ (например, пользователя).
+    Корзины, не использованные idle_timeout секунд, удаляются: к этому
+    времени они заведомо полны и неотличимы от новых.
+    A separate token bucket per key (for example a user). Buckets unused for
+    idle_timeout seconds are evicted: by then they are certainly full and no
+    different from new ones.
+    """
+
+    def __init__(self, rate: float, capacity: float,
+                 idle_timeout: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        # Не меньше времени полного наполнения корзины / No less than the
+        # time a bucket takes to refill completely
+        self._idle_timeout = max(idle_timeout, capacity / rate)
+        # Порядок - по последнему использованию, старые в начале / Ordered
+        # by last use, the oldest first
+        self._buckets: Dict[Hashable, Tuple[TokenBucket, float]] = (
+            OrderedDict())
+        self._next_sweep = time.monotonic() + self._idle_timeout
+        # Ключи, уже предупреждённые о превышении лимита / Keys already
+        # warned about exceeding the limit
+        self._warned: Set[Hashable] = set()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def try_acquire(self, key: Hashable) -> float:
+        """
+        Забирает токен из корзины ключа. Возвращает 0 при успехе, иначе
+        время в секундах до появления токена.
+        Takes a token from the key's bucket. Returns 0 on success, otherwise
+        the time in seconds until a token is available.
+        """
+        now = time.monotonic()
+        if now >= self._next_sweep:
+            self._evict(now)
+
+        entry = self._buckets.pop(key, None)
+        bucket = (entry[0] if entry is not None
+                  else TokenBucket(self.rate, self.capacity))
+        self._buckets[key] = (bucket, now)
+
+        delay = bucket.try_acquire()
+        if delay == 0:
+            self._warned.discard(key)
+        return delay
+
+    def should_warn(self, key: Hashable) -> bool:
+        """
+        Возвращает True один раз за серию отказов по ключу, чтобы
+        предупреждение о лимите не отправлялось на каждое обновление.
+        Returns True once per run of rejections for a key, so the limit
+        warning is not sent for every update.
+        """
+        if key in self._warned:
+            return False
+        self._warned.add(key)
+        return True
+
+    def _evict(self, now: float) -> None:
+        """
+        Удаляет корзины, не использованные idle_timeout секунд.
+        Evicts buckets unused for idle_timeout seconds.
+        """
+        deadline = now - self._idle_timeout
+        while self._buckets:
+            key, (_, used) = next(iter(self._buckets.items()))
+            if used > deadline:
+                break
+            del self._buckets[key]
+            self._warned.discard(key)
+        self._next_sweep = now + self._idle_timeout
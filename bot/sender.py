@@ -0,0 +1,280 @@
+import asyncio
+import itertools
+import time
+from collections import deque
+from datetime import timedelta
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Set
+from telegram.error import RetryAfter
+from config import (
+    logger, SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_WORKERS,
+    SEND_MAX_RETRIES
+)
+from ratelimit import TokenBucket
+from metrics import (
+    QUEUE_DEPTH, OUTBOX_SENDS, OUTBOX_CHATS, OUTBOX_LATENCY
+)
+
+
+# Приоритеты отправки (меньше - важнее) / Send priorities (lower is more
+# important)
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Сколько последних задержек хранить для перцентилей / How many recent
+# latencies to keep for percentiles
+LATENCY_WINDOW = 1000
+
+# После скольких корзин чатов удалять неиспользуемые / After how many chat
+# buckets to remove the unused ones
+BUCKETS_PRUNE_THRESHOLD = 10000
+
+
+class _SendJob:
+    """
+    Отложенная отправка в очереди.
+    A pending send in the queue.
+    """
+    __slots__ = ('operation', 'priority', 'seq', 'future', 'enqueued_at',
+                 'attempts')
+
+    def __init__(self, operation: Callable[[], Awaitable[Any]], priority: int,
+                 seq: int, future: asyncio.Future) -> None:
+        self.operation = operation
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+
+class OutboundQueue:
+    """
+    Очередь исходящих запросов к Telegram с глобальным и поштучным для
+    каждого чата ограничением скорости. Запросы в один чат выполняются по
+    порядку, в разные чаты - параллельно.
+    Queue of outgoing Telegram requests with a global and a per-chat rate
+    limit. Requests to one chat run in order, to different chats in
+    parallel.
+    """
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float,
+                 workers: int, max_retries: int) -> None:
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._workers_count = workers
+        self._max_retries = max_retries
+
+        self._seq = itertools.count()
+        self._chats: Dict[int, Deque[_SendJob]] = {}
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._scheduled: Set[int] = set()
+        self._ready: Optional[asyncio.PriorityQueue] = None
+        self._workers: List[asyncio.Task] = []
+
+        self._depth = 0
+        self._sent = 0
+        self._failed = 0
+        self._retried = 0
+        self._latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    def _ensure_started(self) -> None:
+        """
+        Запускает обработчики очереди в текущем цикле событий.
+        Starts the queue workers in the current event loop.
+        """
+        if self._workers:
+            return
+        self._ready = asyncio.PriorityQueue()
+        self._workers = [
+            asyncio.create_task(self._worker(), name=f'sender-{i}')
+            for i in range(self._workers_count)
+        ]
+
+    async def stop(self) -> None:
+        """
+        Останавливает обработчики очереди.
+        Stops the queue workers.
+        """
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        for jobs in self._chats.values():
+            for job in jobs:
+                job.future.cancel()
+        self._workers = []
+        self._ready = None
+        self._chats.clear()
+        self._scheduled.clear()
+        self._depth = 0
+
+    @property
+    def depth(self) -> int:
+        """
+        Количество запросов в очереди.
+        Number of queued requests.
+        """
+        return self._depth
+
+    async def send(self, chat_id: int,
+                   operation: Callable[[], Awaitable[Any]],
+                   priority: int = PRIORITY_NORMAL) -> Any:
+        """
+        Ставит запрос в очередь и ждёт его выполнения.
+        Queues a request and waits for it to complete.
+        """
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        job = _SendJob(operation, priority, next(self._seq), future)
+
+        self._chats.setdefault(chat_id, deque()).append(job)
+        self._depth += 1
+        if chat_id not in self._scheduled:
+            self._schedule(chat_id)
+        return await future
+
+    def _schedule(self, chat_id: int) -> None:
+        """
+        Помещает чат в очередь готовых по приоритету его первого запроса.
+        Puts the chat into the ready queue by the priority of its first
+        request.
+        """
+        head = self._chats[chat_id][0]
+        self._scheduled.add(chat_id)
+        self._ready.put_nowait((head.priority, head.seq, chat_id))
+
+    def _reschedule_later(self, chat_id: int, delay: float) -> None:
+        """
+        Возвращает чат в очередь готовых после задержки.
+        Returns the chat to the ready queue after a delay.
+        """
+        asyncio.get_running_loop().call_later(delay, self._wake, chat_id)
+
+    def _wake(self, chat_id: int) -> None:
+        if self._ready is not None and chat_id in self._chats:
+            self._schedule(chat_id)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self._chat_rate, self._chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    async def _worker(self) -> None:
+        """
+        Обрабатывает чаты из очереди готовых.
+        Processes chats from the ready queue.
+        """
+        while True:
+            _, _, chat_id = await self._ready.get()
+            jobs = self._chats[chat_id]
+            job = jobs[0]
+
+            # Чат упёрся в свой лимит - вернём его позже, не занимая
+            # обработчик / The chat hit its limit - bring it back later
+            # without blocking a worker
+            delay = self._chat_bucket(chat_id).try_acquire()
+            if delay > 0:
+                self._reschedule_later(chat_id, delay)
+                continue
+
+            await self._global_bucket.acquire()
+            job.attempts += 1
+            try:
+                result = await job.operation()
+            except RetryAfter as e:
+                retry_after = (e.retry_after.total_seconds()
+                               if isinstance(e.retry_after, timedelta)
+                               else float(e.retry_after))
+                if job.attempts <= self._max_retries:
+                    logger.warning(
+                        'Flood control for chat %s, retrying in %ss',
+                        chat_id, retry_after)
+                    self._retried += 1
+                    self._chat_bucket(chat_id).drain(retry_after)
+                    self._reschedule_later(chat_id, retry_after)
+                    continue
+                self._finish(chat_id, job, error=e)
+            except Exception as e:
+                self._finish(chat_id, job, error=e)
+            else:
+                self._finish(chat_id, job, result=result)
+
+    def _finish(self, chat_id: int, job: _SendJob, result: Any = None,
+                error: Optional[BaseException] = None) -> None:
+        """
+        Завершает запрос и планирует следующий запрос того же чата.
+        Completes a request and schedules the next request of the same chat.
+        """
+        jobs = self._chats[chat_id]
+        jobs.popleft()
+        self._depth -= 1
+        self._latencies.append(time.monotonic() - job.enqueued_at)
+
+        if not job.future.done():
+            if error is None:
+                self._sent += 1
+                job.future.set_result(result)
+            else:
+                self._failed += 1
+                job.future.set_exception(error)
+
+        if jobs:
+            self._schedule(chat_id)
+        else:
+            del self._chats[chat_id]
+            self._scheduled.discard(chat_id)
+            # Полную корзину можно забыть / A full bucket can be forgotten
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is not None and bucket.is_full():
+                del self._chat_buckets[chat_id]
+            if len(self._chat_buckets) > BUCKETS_PRUNE_THRESHOLD:
+                self._prune_buckets()
+
+    def _prune_buckets(self) -> None:
+        """
+        Удаляет восполнившиеся корзины чатов без запросов в очереди.
+        Removes refilled buckets of chats with no queued requests.
+        """
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if chat_id not in self._chats and bucket.is_full():
+                del self._chat_buckets[chat_id]
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Возвращает статистику очереди: глубину, счётчики и задержки.
+        Returns queue statistics: depth, counters and latencies.
+        """
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float) -> float:
+            if not latencies:
+                return 0.0
+            return latencies[min(len(latencies) - 1,
+                                 int(p * len(latencies)))]
+
+        return {
+            'depth': self._depth,
+            'chats': len(self._chats),
+            'sent': self._sent,
+            'failed': self._failed,
+            'retried': self._retried,
+            'latency_p50': percentile(0.50),
+            'latency_p95': percentile(0.95),
+            'latency_max': latencies[-1] if latencies else 0.0
+        }
+
+
+outbox = OutboundQueue(SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST,
+                       SEND_WORKERS, SEND_MAX_RETRIES)
+QUEUE_DEPTH.set_function(lambda: outbox.depth, 'outbox')
+OUTBOX_CHATS.set_function(lambda: outbox.stats()['chats'])
+for _result in ('sent', 'failed', 'retried'):
+    OUTBOX_SENDS.set_function(
+        lambda result=_result: outbox.stats()[result], _result)
+for _quantile, _key in (('0.5', 'latency_p50'), ('0.95', 'latency_p95'),
+                        ('1', 'latency_max')):
+    OUTBOX_LATENCY.set_function(lambda key=_key: outbox.stats()[key],
+                                _quantile)
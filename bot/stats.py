@@ -0,0 +1,99 @@
+from typing import Dict, List, Optional
+from config import get_message, LOCALES
+from migrations import RESPONSE_TIME_BOUNDS
+from async_database import get_stats
+
+
+# Единицы длительности от крупной к мелкой / Duration units from the largest
+# to the smallest
+DURATION_UNITS = (('d', 86400), ('h', 3600), ('m', 60), ('s', 1))
+
+
+def format_duration(seconds: int, lang: str) -> str:
+    """
+    Длительность в самой крупной единице, в которой она целая.
+    A duration in the largest unit that divides it evenly.
+    """
+    for unit, size in DURATION_UNITS:
+        if seconds % size == 0:
+            return get_message(f'duration_units.{unit}', lang,
+                               n=seconds // size)
+    return get_message('duration_units.s', lang, n=seconds)
+
+
+def histogram_percentile(histogram: Dict[int, int],
+                         fraction: float) -> Optional[int]:
+    """
+    Номер корзины, в которую попадает заданная доля значений, или None для
+    пустой гистограммы.
+    The number of the bucket holding the given fraction of values, or None
+    for an empty histogram.
+    """
+    total = sum(histogram.values())
+    if not total:
+        return None
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen >= fraction * total:
+            return bucket
+    return max(histogram)
+
+
+def format_bucket(bucket: int, lang: str) -> str:
+    """
+    Подпись корзины гистограммы времени ответа по её верхней границе.
+    A response time histogram bucket label by its upper bound.
+    """
+    if bucket < len(RESPONSE_TIME_BOUNDS):
+        return get_message('duration_within', lang, duration=format_duration(
+            RESPONSE_TIME_BOUNDS[bucket], lang))
+    return get_message('duration_over', lang, duration=format_duration(
+        RESPONSE_TIME_BOUNDS[-1], lang))
+
+
+async def format_stats(days: int, lang: str) -> str:
+    """
+    Формирует текст статистики за последние days дней.
+    Builds the statistics text for the last days days.
+    """
+    daily, histogram, unanswered = await get_stats(days)
+
+    by_type: Dict[str, int] = {}
+    by_day: Dict[str, List[int]] = {}
+    for day, message_type, messages, answered in daily:
+        by_type[message_type] = by_type.get(message_type, 0) + messages
+        totals = by_day.setdefault(day, [0, 0])
+        totals[0] += messages
+        totals[1] += answered
+
+    lines = [get_message(
+        'stats_header', lang, days=days,
+        messages=sum(totals[0] for totals in by_day.values()),
+        answered=sum(totals[1] for totals in by_day.values()),
+        unanswered=unanswered)]
+
+    known_types = LOCALES[lang]['message_types']
+    for message_type, messages in sorted(by_type.items()):
+        name = (get_message(f'message_types.{message_type}.display', lang)
+                if message_type in known_types else message_type or '-')
+        lines.append(get_message('stats_type', lang, type=name,
+                                 messages=messages))
+
+    percentiles = {name: histogram_percentile(histogram, fraction)
+                   for name, fraction in (('p50', 0.5), ('p90', 0.9),
+                                          ('p99', 0.99))}
+    if percentiles['p50'] is None:
+        lines.append(get_message('stats_no_replies', lang))
+    else:
+        lines.append(get_message(
+            'stats_response_time', lang,
+            **{name: format_bucket(bucket, lang)
+               for name, bucket in percentiles.items()}))
+
+    if by_day:
+        lines.append(get_message('stats_days', lang))
+        for day, (messages, answered) in sorted(by_day.items()):
+            lines.append(get_message('stats_day', lang, day=day,
+                                     messages=messages, answered=answered))
+    return '\n'.join(lines)
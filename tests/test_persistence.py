@@ -0,0 +1,100 @@
+import os
+import sys
+import tempfile
+import unittest
+
+# Модули бота импортируются как плоские / The bot modules are imported flat
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'bot'))
+
+_tmp = tempfile.TemporaryDirectory()
+import config  # noqa: E402
+config.DATABASE_PATH = os.path.join(_tmp.name, 'feedback.db')
+config.ARCHIVE_DATABASE_PATH = os.path.join(_tmp.name, 'archive.db')
+
+import async_database  # noqa: E402
+from database import init_db, _pool  # noqa: E402
+from persistence import SQLitePersistence  # noqa: E402
+
+
+def tearDownModule() -> None:
+    _pool.close()
+    _tmp.cleanup()
+
+
+class ConcurrentUpdateTest(unittest.IsolatedAsyncioTestCase):
+    """
+    Два процесса бота с общей базой обновляют данные одного пользователя.
+    Two bot processes sharing a database update the same user's data.
+    """
+
+    user_id = 0
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        init_db()
+
+    async def asyncSetUp(self) -> None:
+        ConcurrentUpdateTest.user_id += 1
+        self.first = SQLitePersistence(shared=True)
+        self.second = SQLitePersistence(shared=True)
+        await self.first.update_user_data(self.user_id, {'page': 0})
+        self.first_data = (await self.first.get_user_data())[self.user_id]
+        self.second_data = (await self.second.get_user_data())[self.user_id]
+
+    async def asyncTearDown(self) -> None:
+        await async_database.shutdown()
+
+    async def stored(self) -> dict:
+        return (await SQLitePersistence().get_user_data())[self.user_id]
+
+    async def test_concurrent_updates_are_merged(self) -> None:
+        await self.first.update_user_data(
+            self.user_id, {**self.first_data, 'message_type': 'complaint'})
+        await self.second.update_user_data(
+            self.user_id, {**self.second_data, 'reply_to': 42})
+
+        self.assertEqual(await self.stored(), {
+            'page': 0, 'message_type': 'complaint', 'reply_to': 42})
+
+    async def test_refresh_loads_merged_data(self) -> None:
+        await self.first.update_user_data(
+            self.user_id, {**self.first_data, 'page': 1})
+        second = {**self.second_data, 'reply_to': 42}
+        await self.second.update_user_data(self.user_id, second)
+
+        await self.second.refresh_user_data(self.user_id, second)
+        self.assertEqual(second, {'page': 1, 'reply_to': 42})
+        await self.first.refresh_user_data(self.user_id, self.first_data)
+        self.assertEqual(self.first_data, {'page': 1, 'reply_to': 42})
+
+    async def test_write_before_refresh_keeps_merged_keys(self) -> None:
+        await self.first.update_user_data(
+            self.user_id, {**self.first_data, 'message_type': 'complaint'})
+        await self.second.update_user_data(
+            self.user_id, {**self.second_data, 'reply_to': 42})
+        await self.second.update_user_data(
+            self.user_id, {**self.second_data, 'reply_to': 43})
+
+        self.assertEqual(await self.stored(), {
+            'page': 0, 'message_type': 'complaint', 'reply_to': 43})
+
+    async def test_removed_key_stays_removed(self) -> None:
+        await self.first.update_user_data(
+            self.user_id, {**self.first_data, 'reply_to': 42})
+        await self.second.update_user_data(
+            self.user_id, {**self.second_data, 'message_type': 'complaint'})
+        await self.first.update_user_data(self.user_id, {'page': 0})
+
+        self.assertEqual(await self.stored(), {
+            'page': 0, 'message_type': 'complaint'})
+
+    async def test_drop_keeps_data_changed_elsewhere(self) -> None:
+        await self.second.update_user_data(
+            self.user_id, {**self.second_data, 'reply_to': 42})
+        await self.first.drop_user_data(self.user_id)
+
+        self.assertEqual(await self.stored(), {'page': 0, 'reply_to': 42})
+
+
+if __name__ == '__main__':
+    unittest.main()